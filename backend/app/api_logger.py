@@ -1,31 +1,61 @@
 """
 API 日志记录模块
 
-将每个 API 的完整请求和响应记录到日志文件，便于调试分析。
-日志文件位置：backend/logs/api_YYYYMMDD.log
+将每个 API 的请求和响应以单行 JSON（NDJSON）记录到日志文件，便于调试分析。
+写入由后台任务批量完成，请求处理不会等待磁盘。
+日志文件位置：backend/logs/api_YYYYMMDD_p{进程号}_NNNN.log（每个 worker 写自己的分段，按天、按大小滚动，旧分段压缩为 .gz）
 """
 import json
+import random
 from datetime import datetime
 from pathlib import Path
 from typing import Any
 
+from app.config import get_settings
+from app.core.log_writer import SegmentWriter
+
 # 日志目录（延迟创建）
 LOG_DIR = Path(__file__).parent.parent / "logs"
 
+_writer: SegmentWriter | None = None
 
-def _ensure_log_dir() -> None:
-    """确保日志目录存在"""
-    try:
-        LOG_DIR.mkdir(exist_ok=True)
-    except Exception as e:
-        print(f"[API_LOGGER] 创建日志目录失败: {e}")
 
+def _get_writer() -> SegmentWriter:
+    """获取日志写入器（懒加载）"""
+    global _writer
+    if _writer is None:
+        settings = get_settings()
+        _writer = SegmentWriter(
+            name="api",
+            directory=LOG_DIR,
+            prefix="api",
+            max_queue=settings.api_log_queue_size,
+            max_segment_bytes=settings.api_log_segment_mb * 1024 * 1024,
+            rotate_daily=True,
+            retain_segments=settings.api_log_retain_segments
+        )
+    return _writer
 
-def get_log_file() -> Path:
-    """获取当天的日志文件路径"""
-    _ensure_log_dir()
-    today = datetime.now().strftime("%Y%m%d")
-    return LOG_DIR / f"api_{today}.log"
+
+def _truncate(value: Any, max_chars: int, max_history: int) -> Any:
+    """
+    截断超长字段：字符串保留前 max_chars 个字符，history 列表只保留最近 max_history 条
+    """
+    if isinstance(value, str):
+        if max_chars > 0 and len(value) > max_chars:
+            return f"{value[:max_chars]}...(+{len(value) - max_chars} chars)"
+        return value
+    if isinstance(value, list):
+        return [_truncate(v, max_chars, max_history) for v in value]
+    if isinstance(value, dict):
+        result = {}
+        for key, v in value.items():
+            if key == "history" and isinstance(v, list) and max_history >= 0 and len(v) > max_history:
+                result["history_total"] = len(v)
+                v = v[len(v) - max_history:]
+            result[key] = _truncate(v, max_chars, max_history)
+        return result
+    return value
 
 
 def log_api_call(
@@ -35,54 +65,41 @@ def log_api_call(
     error: str | None = None
 ) -> None:
     """
-    记录 API 调用日志
-    
+    记录 API 调用日志（只入队，不阻塞）
+
     Args:
         endpoint: API 端点名称（如 "narrate/stream", "judge/stream"）
         request_data: 请求数据
         response_data: 响应数据（流式输出的完整文本或 JSON 响应）
         error: 错误信息（如果有）
     """
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    log_file = get_log_file()
-    
+    settings = get_settings()
+    # 错误日志始终记录，成功日志按端点采样
+    if error is None:
+        rate = settings.api_log_sample_rates.get(endpoint, 1.0)
+        if random.random() >= rate:
+            return
+
     # 构建日志条目
     log_entry = {
-        "timestamp": timestamp,
+        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
         "endpoint": endpoint,
-        "request": request_data,
+        "request": _truncate(request_data, settings.api_log_max_field_chars, settings.api_log_max_history),
     }
-    
+
     if response_data is not None:
         log_entry["response"] = response_data
-    
+
     if error is not None:
         log_entry["error"] = error
-    
-    # 写入日志文件（异常不影响主流程）
+
+    # 序列化异常不影响主流程
     try:
-        with open(log_file, "a", encoding="utf-8") as f:
-            f.write("=" * 80 + "\n")
-            f.write(f"[{timestamp}] {endpoint}\n")
-            f.write("-" * 80 + "\n")
-            f.write("【请求】\n")
-            f.write(json.dumps(request_data, ensure_ascii=False, indent=2) + "\n")
-            f.write("-" * 80 + "\n")
-            
-            if response_data is not None:
-                f.write("【响应】\n")
-                if isinstance(response_data, dict):
-                    f.write(json.dumps(response_data, ensure_ascii=False, indent=2) + "\n")
-                else:
-                    f.write(str(response_data) + "\n")
-            
-            if error is not None:
-                f.write("【错误】\n")
-                f.write(error + "\n")
-            
-            f.write("\n")
+        line = json.dumps(log_entry, ensure_ascii=False, default=str)
     except Exception as e:
-        print(f"[API_LOGGER] 写入日志失败: {e}")
+        print(f"[API_LOGGER] 序列化日志失败: {e}")
+        return
+    _get_writer().submit(line)
 
 
 def format_request_for_log(request) -> dict[str, Any]:
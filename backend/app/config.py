@@ -3,6 +3,7 @@
 """
 from pydantic_settings import BaseSettings
 from functools import lru_cache
+from urllib.parse import urlparse
 
 
 class Settings(BaseSettings):
@@ -12,34 +13,134 @@ class Settings(BaseSettings):
     openai_api_key: str = ""
     openai_base_url: str = "https://api.openai.com/v1"
     openai_model: str = "gpt-4o-mini"
+    # 通用端点池（JSON 数组，可选），格式见 get_model_endpoints
+    openai_endpoints: list[dict] = []
     
     # Narrator（叙事者）专用配置
     narrator_api_key: str = ""
     narrator_base_url: str = ""
     narrator_model: str = ""
+    narrator_endpoints: list[dict] = []
+    narrator_ttft_timeout: float = 0  # 0 表示使用通用配置
+    narrator_stall_timeout: float = 0
+    narrator_max_tokens: int = 0  # 0 表示使用通用配置
     
     # Judge（裁判）专用配置
     judge_api_key: str = ""
     judge_base_url: str = ""
     judge_model: str = ""
+    judge_endpoints: list[dict] = []
+    judge_ttft_timeout: float = 0  # 0 表示使用通用配置
+    judge_stall_timeout: float = 0
+    judge_max_tokens: int = 0  # 0 表示使用通用配置
     
     # Ending（结局评论员）专用配置
     ending_api_key: str = ""
     ending_base_url: str = ""
     ending_model: str = ""
+    ending_endpoints: list[dict] = []
+    ending_ttft_timeout: float = 0  # 0 表示使用通用配置
+    ending_stall_timeout: float = 0
+    ending_max_tokens: int = 0  # 0 表示使用通用配置
     
     # Moderator（内容审核）专用配置
     moderator_api_key: str = ""
     moderator_base_url: str = ""
     moderator_model: str = ""
+    moderator_endpoints: list[dict] = []
+    moderator_ttft_timeout: float = 0  # 0 表示使用通用配置
+    moderator_stall_timeout: float = 0
+    moderator_max_tokens: int = 0  # 0 表示使用通用配置
     
     # 应用配置
     debug: bool = False
     environment: str = "development"  # development 或 production
     
+    # 请求上下文转储（仅非生产环境）
+    llm_context_sample_rate: float = 1.0  # 采样率 0-1
+    llm_context_queue_size: int = 1000  # 待写队列上限，满时丢弃
+    llm_context_segment_mb: int = 64  # 单个分段文件大小上限
+    llm_context_retain_segments: int = 50  # 最多保留的压缩分段数，0 表示不限
+    
+    # API 日志（NDJSON，后台批量写入）
+    api_log_sample_rates: dict[str, float] = {}  # 按端点的成功日志采样率，如 {"narrate/stream": 0.1}；错误始终记录
+    api_log_max_field_chars: int = 4000  # 请求中单个字符串字段的最大长度
+    api_log_max_history: int = 3  # 请求中 history 列表保留的最近条数
+    api_log_queue_size: int = 5000
+    api_log_segment_mb: int = 64
+    api_log_retain_segments: int = 0  # 0 表示不限
+    
     # 流量控制配置
     MAX_PUBLIC_USERS: int = 5
     SESSION_TIMEOUT_SECONDS: int = 600
+    SESSION_REAP_INTERVAL_SECONDS: float = 30.0  # 后台回收过期会话的间隔
+    SESSION_STORE: str = "memory"  # 会话存储：memory（单进程）、sqlite（同机多 worker）、redis（多机）
+    SESSION_STORE_URL: str = ""  # SQLite 文件路径（默认 data/sessions.sqlite3）或 redis:// 地址
+    WORKER_ROUTING: str = ""  # 部署方式：single（单 worker）或 sticky（多 worker，按 token 粘性路由），见 core/deployment
+    WAITING_ROOM_ENABLED: bool = True  # 名额已满时允许排队（/api/game/access?queue=true）
+    WAITING_ROOM_MAX_SIZE: int = 1000  # 排队人数上限
+    WAITING_ROOM_TICKET_TTL_SECONDS: float = 30.0  # 票据多久没有连接/轮询就过期；已放行但未领取的名额同样在此之后收回
+    ADMISSION_ADAPTIVE: bool = False  # 按上游承载能力（AIMD）动态调整公共名额，MAX_PUBLIC_USERS 作为初始容量
+    ADMISSION_MIN_CAPACITY: float = 2.0  # 容量下限（活跃会话当量）
+    ADMISSION_MAX_CAPACITY: float = 200.0  # 容量上限
+    ADMISSION_INCREASE_STEP: float = 1.0  # 名额占满且上游健康时每个窗口增加的容量
+    ADMISSION_DECREASE_FACTOR: float = 0.7  # 出现限流/超时/延迟超标时容量乘以该系数
+    ADMISSION_INTERVAL_SECONDS: float = 5.0  # 调整窗口
+    ADMISSION_TARGET_TTFT_SECONDS: float = 5.0  # 窗口内首 token 平均延迟超过该值视为上游拥塞
+    ADMISSION_IDLE_WEIGHT: float = 0.25  # 空闲（阅读中）会话占用的容量，活跃会话计 1
+    ADMISSION_ACTIVE_WINDOW_SECONDS: float = 60.0  # 最近多久内有过生成的会话算活跃
+    
+    # 内容审核配置
+    moderation_skip_presets: bool = True  # 玩家选择预设选项时跳过审核
+    moderation_cache_size: int = 2048  # 审核结论缓存条数，0 表示关闭
+    moderation_cache_ttl: float = 3600.0  # 缓存有效期（秒）
+    moderation_blocklist_path: str = ""  # 为空时使用 data/moderation/blocklist.txt
+    moderation_allowlist_path: str = ""  # 为空时使用 data/moderation/allowlist.txt
+    moderation_trivial_length: int = 2  # 归一化后不超过该长度且未命中黑名单的输入直接放行
+    moderation_allow_coverage: float = 0.9  # 白名单词覆盖比例达到该值时直接放行，0 表示关闭
+    judge_speculative_moderation: bool = False  # 判定生成与审核并行，审核通过后再放行
+    
+    # 上游连接池配置（所有角色共享一个 httpx 连接池）
+    llm_http2: bool = True  # 安装了 h2 时启用 HTTP/2
+    llm_max_connections: int = 100
+    llm_max_keepalive_connections: int = 20
+    llm_keepalive_expiry: float = 60.0  # 空闲连接保活时间（秒）
+    llm_connect_timeout: float = 10.0
+    llm_request_timeout: float = 600.0
+    
+    llm_session_affinity: bool = True  # 同一会话固定路由到同一端点，提高前缀缓存命中率
+    llm_stream_usage: bool = True  # 流式请求携带 stream_options.include_usage（上游不支持时关闭）
+    
+    # 多端点路由与故障转移配置
+    llm_failover_attempts: int = 3  # 首 token 之前最多尝试的次数（含首次）
+    llm_endpoint_failure_threshold: int = 3  # 连续失败多少次后熔断
+    llm_endpoint_cooldown_seconds: float = 30.0  # 熔断冷却时间（秒）
+    
+    # 流式超时配置（秒，0 表示不限制），可按角色覆盖，如 NARRATOR_TTFT_TIMEOUT
+    llm_ttft_timeout: float = 30.0  # 首 token 最长等待时间
+    llm_stall_timeout: float = 30.0  # 相邻两个 chunk 的最大间隔
+    
+    # 输出长度与结构化停止配置
+    llm_max_tokens: int = 0  # 单次输出 token 上限，0 表示不限制；可按角色覆盖，如 JUDGE_MAX_TOKENS
+    llm_stop_sequences: bool = True  # 向上游传递结构化停止序列（上游不支持 stop 参数时关闭）
+    
+    # 可续传 SSE 配置（断线后带 Last-Event-ID 重连，补发错过的事件并跟随原生成）
+    sse_replay_enabled: bool = True
+    sse_replay_ttl: float = 120.0  # 生成结束后保留事件的时间（秒）
+    sse_replay_stream_kb: int = 256  # 单次生成的事件缓冲上限，超出时丢弃最早的事件
+    sse_replay_streams_per_session: int = 2  # 每个会话保留的最近生成数
+    sse_replay_max_total_mb: int = 64  # 所有缓冲的总上限，超出时先淘汰已结束的旧流
+    sse_disconnect_grace: float = 10.0  # 客户端全部断开后等待重连的时间（秒），超时取消生成并关闭上游；不可续传时立即取消
+    # 同一会话、同一接口、同一请求体的并发重复请求合并为一次上游调用（流式接口依赖可续传 SSE）
+    single_flight_enabled: bool = True
+    
+    # JSON 请求对冲配置（结局生成、内容审核）
+    llm_hedge_enabled: bool = False
+    llm_hedge_percentile: float = 95.0  # 超过近期该分位延迟仍未返回时发出对冲请求
+    llm_hedge_min_samples: int = 20  # 样本不足时使用默认延迟
+    llm_hedge_default_delay: float = 3.0
+    llm_hedge_min_delay: float = 0.5
+    llm_hedge_max_delay: float = 15.0
     
     class Config:
         env_file = ".env"
@@ -85,6 +186,58 @@ class Settings(BaseSettings):
             model = self.openai_model
         
         return api_key, base_url, model
+    
+    def get_role_option(self, role: str | None, name: str):
+        """
+        获取角色级配置项，未配置（为空或0）时回退到 llm_ 开头的通用配置
+        
+        例：get_role_option("narrator", "ttft_timeout") 依次读取
+        narrator_ttft_timeout、llm_ttft_timeout
+        """
+        value = getattr(self, f"{role.lower()}_{name}", None) if role else None
+        return value or getattr(self, f"llm_{name}")
+    
+    def get_model_endpoints(self, role: str | None) -> list[dict]:
+        """
+        获取指定角色的上游端点池
+        
+        端点池通过 {ROLE}_ENDPOINTS 环境变量配置（JSON 数组），每个端点可包含：
+            name, api_key, base_url, model, weight
+        缺省字段回退到 get_model_config 的单一配置。
+        角色未配置端点池、且没有专用 API Key / Base URL 时，使用 OPENAI_ENDPOINTS。
+        两者都未配置时，返回只包含单一配置的端点池。
+        
+        Args:
+            role: 角色名称，None 表示通用配置
+            
+        Returns:
+            端点配置字典列表
+        """
+        role = (role or "").lower()
+        if role in ("narrator", "judge", "ending", "moderator"):
+            api_key, base_url, model = self.get_model_config(role)
+            pool = getattr(self, f"{role}_endpoints")
+            has_own_config = getattr(self, f"{role}_api_key") or getattr(self, f"{role}_base_url")
+            if not pool and not has_own_config:
+                pool = self.openai_endpoints
+        else:
+            api_key, base_url, model = self.openai_api_key, self.openai_base_url, self.openai_model
+            pool = self.openai_endpoints
+        
+        if not pool:
+            pool = [{}]
+        
+        endpoints = []
+        for index, entry in enumerate(pool):
+            entry_base_url = entry.get("base_url") or base_url
+            endpoints.append({
+                "name": entry.get("name") or f"{urlparse(entry_base_url).netloc or entry_base_url}#{index}",
+                "api_key": entry.get("api_key") or api_key,
+                "base_url": entry_base_url,
+                "model": entry.get("model") or model,
+                "weight": float(entry.get("weight", 1.0)),
+            })
+        return endpoints
 
 
 @lru_cache()
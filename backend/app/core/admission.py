@@ -0,0 +1,179 @@
+"""
+自适应准入模块
+公共名额不再是固定人数，而是按上游实际承载能力动态调整：
+- 跟踪各角色进行中的 chat_stream / chat_json 调用，以及各会话最近是否在生成
+- 容量以“活跃会话当量”计：正在生成（或刚生成过）的会话计 1，阅读中的空闲会话只计 ADMISSION_IDLE_WEIGHT
+- 按 AIMD 调整容量：窗口内出现限流（429）、首 token 超时或首 token 平均延迟超过目标时乘性减小；
+  名额被占满（有人被拒绝或在排队）且上游健康时加性增大
+容量只影响新会话的准入，已加入的会话不会被踢出。未开启 ADMISSION_ADAPTIVE 时只统计各角色进行中的调用，
+不记录会话活跃状态。统计在进程内，自适应准入只能用于单 worker 部署（启动时由 deployment 检查）
+"""
+import logging
+import math
+import time
+from collections import defaultdict
+
+import openai
+
+from app.config import get_settings
+from app.core.metrics import metrics
+from app.core.upstream import LLMStallError
+
+logger = logging.getLogger(__name__)
+
+
+def is_congestion_error(error: BaseException) -> bool:
+    """上游拥塞信号：限流（429）或首 token 超时"""
+    if isinstance(error, LLMStallError):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code == 429
+
+
+class AdmissionController:
+    """AIMD 准入控制（进程内）"""
+
+    def __init__(self):
+        self._in_flight: dict[str, int] = defaultdict(int)  # 角色 -> 进行中的调用数
+        self._session_calls: dict[str, int] = {}  # 会话 -> 进行中的调用数
+        self._last_active: dict[str, float] = {}  # 会话 -> 最近一次调用结束（或加入）的时间
+        self._capacity: float | None = None
+        self._window_started = time.monotonic()
+        self._ttft: dict[str, list[float]] = defaultdict(lambda: [0.0, 0])  # 角色 -> [延迟之和, 样本数]
+        self._congestion = 0
+        self._saturated = False
+        self._peak_in_flight = 0
+        self._last_pruned = time.monotonic()
+
+    @property
+    def capacity(self) -> float:
+        """当前容量（活跃会话当量），首次使用时以 MAX_PUBLIC_USERS 为初始值"""
+        if self._capacity is None:
+            settings = get_settings()
+            self._capacity = self._clamp(float(settings.MAX_PUBLIC_USERS))
+        return self._capacity
+
+    @staticmethod
+    def _clamp(capacity: float) -> float:
+        settings = get_settings()
+        return max(settings.ADMISSION_MIN_CAPACITY, min(capacity, settings.ADMISSION_MAX_CAPACITY))
+
+    def begin(self, role: str, session: str | None) -> None:
+        """一次上游调用开始"""
+        self._in_flight[role] += 1
+        self._peak_in_flight = max(self._peak_in_flight, sum(self._in_flight.values()))
+        if session and get_settings().ADMISSION_ADAPTIVE:
+            self._session_calls[session] = self._session_calls.get(session, 0) + 1
+
+    def end(self, role: str, session: str | None) -> None:
+        """一次上游调用结束"""
+        self._in_flight[role] = max(0, self._in_flight[role] - 1)
+        if session and session in self._session_calls:
+            self._session_calls[session] -= 1
+            if self._session_calls[session] <= 0:
+                del self._session_calls[session]
+            self._last_active[session] = time.monotonic()
+            self._prune(self._last_active[session])
+
+    def record_ttft(self, role: str, ttft: float) -> None:
+        """记录流式调用的首 token 延迟（排队越深延迟越高，作为负载信号）"""
+        sample = self._ttft[role]
+        sample[0] += ttft
+        sample[1] += 1
+
+    def record_error(self, role: str, error: BaseException) -> None:
+        """记录上游错误，限流和首 token 超时计为拥塞"""
+        if is_congestion_error(error):
+            self._congestion += 1
+            metrics.incr("admission_congestion_total", role=role)
+
+    def mark_active(self, session: str) -> None:
+        """新加入的会话马上会开始生成，按活跃计，避免突发加入时按空闲权重超额放行"""
+        if get_settings().ADMISSION_ADAPTIVE:
+            self._last_active[session] = time.monotonic()
+            self._prune(self._last_active[session])
+
+    def mark_saturated(self) -> None:
+        """名额已满、有人被拒绝（含排队中的放行尝试）"""
+        self._saturated = True
+
+    def _prune(self, now: float) -> None:
+        """清理早已不活跃的会话（每个活跃窗口最多一次），不依赖是否有人读取名额上限"""
+        window = get_settings().ADMISSION_ACTIVE_WINDOW_SECONDS
+        if now - self._last_pruned < window:
+            return
+        self._last_active = {s: at for s, at in self._last_active.items() if now - at <= window}
+        self._last_pruned = now
+
+    def active_sessions(self, now: float | None = None) -> int:
+        """正在生成或最近 ADMISSION_ACTIVE_WINDOW_SECONDS 内生成过的会话数"""
+        now = now or time.monotonic()
+        window = get_settings().ADMISSION_ACTIVE_WINDOW_SECONDS
+        recent = sum(
+            1 for session, at in self._last_active.items()
+            if now - at <= window and session not in self._session_calls
+        )
+        return len(self._session_calls) + recent
+
+    def _update(self, now: float) -> None:
+        """每个调整窗口结束时按 AIMD 调整一次容量（每窗口最多减小一次）"""
+        settings = get_settings()
+        if now - self._window_started < settings.ADMISSION_INTERVAL_SECONDS:
+            return
+        capacity = self.capacity
+        slow = [
+            role for role, (total, count) in self._ttft.items()
+            if count and total / count > settings.ADMISSION_TARGET_TTFT_SECONDS
+        ]
+        if self._congestion or slow:
+            self._capacity = self._clamp(capacity * settings.ADMISSION_DECREASE_FACTOR)
+            metrics.incr("admission_adjust_total", outcome="decrease")
+            logger.warning(
+                f"[Admission] 上游拥塞（限流/超时 {self._congestion} 次，延迟超标: {slow or '无'}），"
+                f"容量 {capacity:.1f} -> {self._capacity:.1f}"
+            )
+        elif self._saturated:
+            self._capacity = self._clamp(capacity + settings.ADMISSION_INCREASE_STEP)
+            metrics.incr("admission_adjust_total", outcome="increase")
+            logger.info(f"[Admission] 名额已满且上游健康，容量 {capacity:.1f} -> {self._capacity:.1f}")
+
+        # 开始新窗口
+        self._ttft.clear()
+        self._congestion = 0
+        self._saturated = False
+        self._peak_in_flight = sum(self._in_flight.values())
+        self._window_started = now
+
+    def session_limit(self) -> int:
+        """
+        当前允许的公共会话数
+
+        活跃会话 a 各计 1，其余会话计权重 w，总负载不超过容量 C：a + w × (N - a) ≤ C
+        """
+        now = time.monotonic()
+        self._update(now)
+        active = self.active_sessions(now)
+        weight = max(get_settings().ADMISSION_IDLE_WEIGHT, 0.01)
+        return active + math.floor(max(0.0, self.capacity - active) / weight)
+
+    def load(self, online: int) -> float:
+        """按活跃程度加权的负载（活跃会话当量）"""
+        active = min(self.active_sessions(), online)
+        return active + get_settings().ADMISSION_IDLE_WEIGHT * (online - active)
+
+    def stats(self, online: int) -> dict:
+        return {
+            "capacity": round(self.capacity, 2),
+            "load": round(self.load(online), 2),
+            "session_limit": self.session_limit(),
+            "active_sessions": self.active_sessions(),
+            "in_flight": {role: count for role, count in self._in_flight.items() if count},
+            "peak_in_flight": self._peak_in_flight,
+        }
+
+    def reset(self):
+        """重置状态（仅用于测试）"""
+        self.__init__()
+
+
+# 全局单例
+admission_controller = AdmissionController()
@@ -0,0 +1,68 @@
+"""
+部署检查模块
+会话、名额和排队放在 SESSION_STORE 中，可以在多个 worker 间共享；以下状态仍在各进程内存中：
+- 可续传 SSE 的事件缓冲（sse_replay）：续传请求必须回到原 worker
+- 流式请求的重复合并（sse_replay / single_flight）：重复请求必须落到同一个 worker 才能合并
+- 已下发的预设选项（moderator_service）：落到别的 worker 时预设选项照常走审核（安全，但更慢）
+- 自适应准入的容量和活跃会话统计（admission）：各 worker 只看得到自己的上游调用
+
+因此多 worker 部署必须由负载均衡按会话令牌粘性路由，并且不能开启自适应准入（各 worker 各自调整的名额上限
+与共享存储中的全局在线数不一致）。部署方式通过 WORKER_ROUTING 声明，启动时检查，配置不一致时拒绝启动
+"""
+import os
+
+from app.config import Settings
+
+# 部署方式
+ROUTING_SINGLE = "single"  # 单个 worker 进程
+ROUTING_STICKY = "sticky"  # 多个 worker/实例，负载均衡按会话令牌（token 参数或 X-Game-Token 请求头）粘性路由
+
+SHARED_STORES = ("sqlite", "redis")
+
+
+def declared_workers() -> int:
+    """uvicorn/gunicorn 通过 WEB_CONCURRENCY 环境变量声明的 worker 数（未设置时为 1）"""
+    try:
+        return max(1, int(os.environ.get("WEB_CONCURRENCY", "1")))
+    except ValueError:
+        return 1
+
+
+def check_deployment(settings: Settings) -> None:
+    """
+    检查部署方式与进程内状态是否相容（应用启动时调用）
+
+    Raises:
+        RuntimeError: 配置不一致
+    """
+    routing = settings.WORKER_ROUTING.strip().lower()
+    store = settings.SESSION_STORE.strip().lower()
+    if routing not in ("", ROUTING_SINGLE, ROUTING_STICKY):
+        raise RuntimeError(f"未知的 WORKER_ROUTING: {settings.WORKER_ROUTING}（可选 single / sticky）")
+
+    if not routing:
+        if store in SHARED_STORES:
+            raise RuntimeError(
+                f"SESSION_STORE={store} 用于多个 worker 共享会话，但可续传 SSE、重复请求合并、预设选项记录和"
+                "自适应准入仍在进程内。多 worker 部署请让负载均衡按会话令牌粘性路由并设置 WORKER_ROUTING=sticky；"
+                "只运行一个 worker 时设置 WORKER_ROUTING=single"
+            )
+        routing = ROUTING_SINGLE
+
+    workers = declared_workers()
+    if routing == ROUTING_SINGLE and workers > 1:
+        raise RuntimeError(
+            f"WEB_CONCURRENCY={workers} 表示多个 worker，但部署方式为单 worker。"
+            "请使用共享的 SESSION_STORE 并设置 WORKER_ROUTING=sticky"
+        )
+    if routing == ROUTING_STICKY:
+        if store not in SHARED_STORES:
+            raise RuntimeError(
+                "WORKER_ROUTING=sticky 需要共享的会话存储（SESSION_STORE=sqlite 或 redis），"
+                "memory 存储的会话令牌在其他 worker 上无效"
+            )
+        if settings.ADMISSION_ADAPTIVE:
+            raise RuntimeError(
+                "ADMISSION_ADAPTIVE 的容量在进程内调整，多 worker 时与共享存储中的在线数不一致；"
+                "WORKER_ROUTING=sticky 时请关闭自适应准入，用 MAX_PUBLIC_USERS 限制名额"
+            )
@@ -0,0 +1,193 @@
+"""
+关键词预审核模块
+基于 Aho–Corasick 多模式匹配，对黑名单命中直接拒绝、对明显无害的短输入直接放行，
+只有模棱两可的内容才交给 LLM 审核
+"""
+import logging
+import time
+from collections import Counter, deque
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# 默认词表目录
+DEFAULT_LIST_DIR = Path(__file__).parent.parent.parent / "data" / "moderation"
+
+
+class AhoCorasick:
+    """Aho–Corasick 自动机：一次扫描匹配全部模式串"""
+
+    def __init__(self, patterns: list[str]):
+        self._goto: list[dict[str, int]] = [{}]
+        self._fail: list[int] = [0]
+        self._output: list[list[str]] = [[]]
+        for pattern in patterns:
+            if pattern:
+                self._insert(pattern)
+        self._build()
+
+    def _insert(self, pattern: str) -> None:
+        node = 0
+        for ch in pattern:
+            nxt = self._goto[node].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[node][ch] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+            node = nxt
+        self._output[node].append(pattern)
+
+    def _build(self) -> None:
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, child in self._goto[node].items():
+                queue.append(child)
+                fail = self._fail[node]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                target = self._goto[fail].get(ch, 0)
+                self._fail[child] = target if target != child else 0
+                self._output[child] = self._output[child] + self._output[self._fail[child]]
+
+    def find_all(self, text: str) -> list[tuple[int, str]]:
+        """
+        返回所有匹配
+
+        Returns:
+            [(起始位置, 模式串), ...]
+        """
+        matches = []
+        node = 0
+        for index, ch in enumerate(text):
+            while node and ch not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(ch, 0)
+            for pattern in self._output[node]:
+                matches.append((index - len(pattern) + 1, pattern))
+        return matches
+
+
+class KeywordVerdict:
+    """预审核结论"""
+
+    def __init__(self, decision: str, hits: list[str] | None = None):
+        self.decision = decision  # "block" / "allow" / "unknown"
+        self.hits = hits or []
+
+
+class KeywordFilter:
+    """
+    黑名单/白名单关键词过滤器
+
+    词表文件每行一个词，# 开头为注释；文件修改后自动重新加载。
+    输入和词表都先经过归一化（见 normalize），避免空格、标点、全半角绕过
+    """
+
+    def __init__(self, blocklist_path: Path, allowlist_path: Path, normalize, check_interval: float = 5.0):
+        self.blocklist_path = blocklist_path
+        self.allowlist_path = allowlist_path
+        self.normalize = normalize
+        self.check_interval = check_interval
+        self.match_counts: Counter = Counter()
+        self._mtimes: tuple[float, float] = (-1.0, -1.0)
+        self._last_check = 0.0
+        self._block = AhoCorasick([])
+        self._allow = AhoCorasick([])
+        self._sizes = (0, 0)
+        self.reload()
+
+    def _read_list(self, path: Path) -> list[str]:
+        if not path.exists():
+            return []
+        patterns = []
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                normalized = self.normalize(line)
+                if normalized:
+                    patterns.append(normalized)
+        return patterns
+
+    def _current_mtimes(self) -> tuple[float, float]:
+        def mtime(path: Path) -> float:
+            return path.stat().st_mtime if path.exists() else 0.0
+        return mtime(self.blocklist_path), mtime(self.allowlist_path)
+
+    def reload(self) -> None:
+        """重新加载词表"""
+        try:
+            mtimes = self._current_mtimes()
+            block = self._read_list(self.blocklist_path)
+            allow = self._read_list(self.allowlist_path)
+        except OSError as e:
+            logger.error(f"[KeywordFilter] 加载词表失败: {e}")
+            return
+        self._block = AhoCorasick(block)
+        self._allow = AhoCorasick(allow)
+        self._sizes = (len(block), len(allow))
+        self._mtimes = mtimes
+        logger.info(f"[KeywordFilter] 词表已加载: 黑名单 {len(block)} 条，白名单 {len(allow)} 条")
+
+    def _maybe_reload(self) -> None:
+        now = time.monotonic()
+        if now - self._last_check < self.check_interval:
+            return
+        self._last_check = now
+        try:
+            changed = self._current_mtimes() != self._mtimes
+        except OSError:
+            return
+        if changed:
+            self.reload()
+
+    def check(self, text: str, trivial_length: int, allow_coverage: float) -> KeywordVerdict:
+        """
+        预审核
+
+        Args:
+            text: 原始输入
+            trivial_length: 归一化后不超过该长度、且未命中黑名单的输入直接放行
+            allow_coverage: 白名单词覆盖的字符比例达到该值时直接放行
+
+        Returns:
+            KeywordVerdict
+        """
+        self._maybe_reload()
+        normalized = self.normalize(text)
+        if not normalized:
+            return KeywordVerdict("allow")
+
+        block_hits = self._block.find_all(normalized)
+        if block_hits:
+            hits = sorted({pattern for _, pattern in block_hits})
+            self.match_counts["block"] += 1
+            return KeywordVerdict("block", hits)
+
+        if len(normalized) <= trivial_length:
+            self.match_counts["trivial"] += 1
+            return KeywordVerdict("allow")
+
+        allow_hits = self._allow.find_all(normalized)
+        if allow_hits and allow_coverage > 0:
+            covered = [False] * len(normalized)
+            for start, pattern in allow_hits:
+                for i in range(start, start + len(pattern)):
+                    covered[i] = True
+            if sum(covered) / len(normalized) >= allow_coverage:
+                self.match_counts["allow"] += 1
+                return KeywordVerdict("allow", sorted({p for _, p in allow_hits}))
+
+        self.match_counts["unknown"] += 1
+        return KeywordVerdict("unknown")
+
+    def stats(self) -> dict:
+        return {
+            "blocklist_size": self._sizes[0],
+            "allowlist_size": self._sizes[1],
+            "matches": dict(self.match_counts),
+        }
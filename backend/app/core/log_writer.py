@@ -0,0 +1,225 @@
+"""
+后台日志写入模块
+请求处理只把日志行放进有界队列，由后台任务批量追加到分段文件；
+分段按大小（可选按天）滚动，滚动后的旧分段压缩为 .gz
+"""
+import asyncio
+import contextlib
+import gzip
+import logging
+import os
+import re
+import shutil
+from datetime import datetime
+from pathlib import Path
+
+from app.core.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+# 所有已创建的写入器，关闭服务时统一刷盘
+_writers: list["SegmentWriter"] = []
+
+# 分段名中的写入进程号；旧版分段名（{prefix}_{YYYYMMDD}_{序号}.log）不含进程号，视为已退出进程遗留
+_SEGMENT_PID = re.compile(r"_p(\d+)_\d+\.log$")
+
+
+def _pid_alive(pid: int) -> bool:
+    """进程是否仍在运行（无法判断时按仍在运行处理，不去动它的分段）"""
+    if pid == os.getpid():
+        return False  # 进程号被复用：同名分段是上一个进程留下的
+    if os.name != "posix":
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True
+    return True
+
+
+class SegmentWriter:
+    """
+    有界队列 + 后台批量写入的分段日志
+
+    分段文件名为 {prefix}_{YYYYMMDD}_p{进程号}_{序号}.log，滚动后压缩为 .log.gz。
+    多个 worker 写同一目录时各自写自己的分段，互不覆盖。
+    submit() 从不阻塞：队列满时丢弃并计数
+    """
+
+    def __init__(
+        self,
+        name: str,
+        directory: Path,
+        prefix: str,
+        max_queue: int = 1000,
+        max_segment_bytes: int = 64 * 1024 * 1024,
+        batch_size: int = 200,
+        rotate_daily: bool = False,
+        retain_segments: int = 0,
+    ):
+        self.name = name
+        self.directory = Path(directory)
+        self.prefix = prefix
+        self.max_queue = max_queue
+        self.max_segment_bytes = max_segment_bytes
+        self.batch_size = batch_size
+        self.rotate_daily = rotate_daily
+        self.retain_segments = retain_segments  # 最多保留的压缩分段数，0 表示不限
+        self.written = 0
+        self.dropped = 0
+
+        self._queue: asyncio.Queue | None = None
+        self._task: asyncio.Task | None = None
+        # 以下状态只在写入线程中访问
+        self._file = None
+        self._path: Path | None = None
+        self._day: str | None = None
+        self._seq = 0
+        _writers.append(self)
+
+    def submit(self, line: str) -> bool:
+        """
+        提交一行日志（不含换行符），不阻塞
+
+        Returns:
+            是否成功入队；队列已满或不在事件循环中时返回 False
+        """
+        if self._queue is None:
+            try:
+                asyncio.get_running_loop()
+            except RuntimeError:
+                return self._drop()
+            self._queue = asyncio.Queue(maxsize=self.max_queue)
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        try:
+            self._queue.put_nowait(line)
+        except asyncio.QueueFull:
+            return self._drop()
+        return True
+
+    def _drop(self) -> bool:
+        self.dropped += 1
+        metrics.incr("log_writer_dropped_total", writer=self.name)
+        return False
+
+    async def _run(self) -> None:
+        """后台任务：攒批后在线程中写盘"""
+        queue = self._queue
+        stopping = False
+        while not stopping:
+            item = await queue.get()
+            batch = []
+            while True:
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+                if len(batch) >= self.batch_size or queue.empty():
+                    break
+                item = queue.get_nowait()
+            if batch:
+                try:
+                    await asyncio.to_thread(self._write_batch, batch)
+                    self.written += len(batch)
+                    metrics.incr("log_writer_written_total", len(batch), writer=self.name)
+                except Exception as e:
+                    # 写盘失败不影响请求，只记录丢弃数
+                    self.dropped += len(batch)
+                    metrics.incr("log_writer_dropped_total", len(batch), writer=self.name)
+                    logger.error(f"[LogWriter] {self.name} 写入失败: {e}")
+        await asyncio.to_thread(self._close_file)
+
+    def _write_batch(self, lines: list[str]) -> None:
+        today = datetime.now().strftime("%Y%m%d")
+        if self._file is None:
+            self._open_segment(today)
+        elif self.rotate_daily and today != self._day:
+            self._rotate(today)
+        self._file.write("".join(line + "\n" for line in lines))
+        self._file.flush()
+        if self._file.tell() >= self.max_segment_bytes:
+            self._rotate(today)
+
+    def _open_segment(self, day: str) -> None:
+        """
+        打开新分段；首次打开时接着本进程号已有的分段编号，
+        并压缩已退出进程遗留的未压缩分段（仍在运行的 worker 正在写的分段不动）
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        pid = os.getpid()
+        if self._path is None:
+            pattern = re.compile(rf"^{re.escape(self.prefix)}_{day}_p{pid}_(\d+)\.log(\.gz)?$")
+            for path in self.directory.iterdir():
+                match = pattern.match(path.name)
+                if match:
+                    self._seq = max(self._seq, int(match.group(1)))
+            for path in self.directory.glob(f"{self.prefix}_*.log"):
+                owner = _SEGMENT_PID.search(path.name)
+                if owner is None or not _pid_alive(int(owner.group(1))):
+                    self._compress(path)
+        elif day != self._day:
+            self._seq = 0
+        self._seq += 1
+        self._day = day
+        self._path = self.directory / f"{self.prefix}_{day}_p{pid}_{self._seq:04d}.log"
+        self._file = open(self._path, "a", encoding="utf-8")
+
+    def _rotate(self, day: str) -> None:
+        self._file.close()
+        self._file = None
+        self._compress(self._path)
+        self._prune()
+        self._open_segment(day)
+
+    def _compress(self, path: Path) -> None:
+        target = path.with_name(path.name + ".gz")
+        with open(path, "rb") as src, gzip.open(target, "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(path)
+
+    def _prune(self) -> None:
+        if self.retain_segments <= 0:
+            return
+        # 多个 worker 的分段交错，按修改时间而不是文件名排序
+        segments = sorted(self.directory.glob(f"{self.prefix}_*.log.gz"), key=lambda p: p.stat().st_mtime)
+        for path in segments[:-self.retain_segments]:
+            with contextlib.suppress(OSError):
+                path.unlink()
+
+    def _close_file(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    async def close(self) -> None:
+        """写完队列中剩余的日志后停止后台任务"""
+        if self._task is None or self._task.done():
+            return
+        await self._queue.put(_STOP)
+        await self._task
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize() if self._queue else 0,
+            "written": self.written,
+            "dropped": self.dropped,
+            "segment": self._path.name if self._path else None,
+        }
+
+
+async def close_all_writers() -> None:
+    """关闭所有写入器（服务关闭时调用）"""
+    for writer in _writers:
+        try:
+            await writer.close()
+        except Exception as e:
+            logger.error(f"[LogWriter] {writer.name} 关闭失败: {e}")
+
+
+def writers_stats() -> dict:
+    return {writer.name: writer.stats() for writer in _writers}
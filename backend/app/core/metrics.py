@@ -0,0 +1,77 @@
+"""
+运行指标模块
+进程内的计数器和滑动窗口分位数统计，通过 /api/system/metrics 导出
+"""
+import math
+from collections import deque
+
+# 每个直方图保留的最近样本数
+WINDOW_SIZE = 512
+
+LabelKey = tuple[tuple[str, str], ...]
+
+
+def _label_key(labels: dict) -> LabelKey:
+    return tuple(sorted((k, str(v)) for k, v in labels.items() if v is not None))
+
+
+class Metrics:
+    """计数器 + 滑动窗口直方图"""
+
+    def __init__(self):
+        self._counters: dict[str, dict[LabelKey, float]] = {}
+        self._histograms: dict[str, dict[LabelKey, deque]] = {}
+
+    def incr(self, name: str, value: float = 1, **labels) -> None:
+        """计数器累加"""
+        series = self._counters.setdefault(name, {})
+        key = _label_key(labels)
+        series[key] = series.get(key, 0) + value
+
+    def get(self, name: str, **labels) -> float:
+        """读取计数器当前值"""
+        return self._counters.get(name, {}).get(_label_key(labels), 0)
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        """记录一个观测值（如延迟，单位秒）"""
+        series = self._histograms.setdefault(name, {})
+        key = _label_key(labels)
+        window = series.get(key)
+        if window is None:
+            window = series[key] = deque(maxlen=WINDOW_SIZE)
+        window.append(value)
+
+    def percentile(self, name: str, pct: float, min_samples: int = 1, **labels) -> float | None:
+        """计算最近窗口内的分位数，样本不足时返回 None"""
+        window = self._histograms.get(name, {}).get(_label_key(labels))
+        if not window or len(window) < min_samples:
+            return None
+        ordered = sorted(window)
+        rank = max(0, min(len(ordered) - 1, math.ceil(pct / 100 * len(ordered)) - 1))
+        return ordered[rank]
+
+    def snapshot(self) -> dict:
+        """导出所有指标"""
+        counters = {
+            name: [{**dict(key), "value": value} for key, value in series.items()]
+            for name, series in self._counters.items()
+        }
+        histograms = {}
+        for name, series in self._histograms.items():
+            rows = []
+            for key, window in series.items():
+                ordered = sorted(window)
+                def pick(pct: float) -> float:
+                    return round(ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)], 4)
+                rows.append({**dict(key), "count": len(ordered), "p50": pick(50), "p95": pick(95), "p99": pick(99)})
+            histograms[name] = rows
+        return {"counters": counters, "histograms": histograms}
+
+    def reset(self):
+        """清空所有指标（仅用于测试）"""
+        self._counters.clear()
+        self._histograms.clear()
+
+
+# 全局单例
+metrics = Metrics()
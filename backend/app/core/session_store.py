@@ -0,0 +1,809 @@
+"""
+会话存储模块
+TrafficController 的会话数据可以放在进程内存、SQLite 文件（WAL 模式，同一台机器的多个 worker 共享）
+或 Redis 协议服务器（多台机器共享）中。名额检查和加入在各存储内原子完成，多个 worker 不会超额放行
+
+排队票据和队伍顺序（见 waiting_room）也放在同一个存储中，多个 worker 共享同一个 FIFO 队伍；
+放行队首（检查名额、加入会话、出队）和收回无人领取的名额同样在存储内原子完成
+
+选择方式：SESSION_STORE=memory|sqlite|redis，SESSION_STORE_URL 为 SQLite 文件路径或 redis:// 地址
+
+存储接口是异步的：SQLite 的加锁事务放到线程池执行，Redis 使用异步客户端，网络往返和锁等待不会阻塞事件循环
+"""
+import asyncio
+import heapq
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from pathlib import Path
+
+try:
+    import redis.asyncio as redis
+except ImportError:  # 未安装 redis 时不能使用 Redis 存储
+    redis = None
+
+# 会话类型
+SESSION_TYPES = ("public", "vip")
+
+# 默认 SQLite 文件位置
+DEFAULT_SQLITE_PATH = Path(__file__).parent.parent.parent / "data" / "sessions.sqlite3"
+
+
+class SessionData:
+    def __init__(self, session_type: str, created_at: float | None = None, last_active: float | None = None):
+        self.type = session_type
+        self.created_at = created_at if created_at is not None else time.time()
+        self.last_active = last_active if last_active is not None else self.created_at
+
+
+class TicketData:
+    """
+    排队票据
+
+    status: waiting（排队中）/ admitted（已分配名额，token 为会话令牌）/ expired / left；
+    claimed 表示客户端已取走令牌，未取走的名额过期后收回
+    """
+
+    def __init__(
+        self,
+        ticket_id: str,
+        seq: int,
+        created_at: float,
+        last_seen: float | None = None,
+        status: str = "waiting",
+        token: str | None = None,
+        admitted_at: float | None = None,
+        claimed: bool = False,
+    ):
+        self.id = ticket_id
+        self.seq = seq  # 入队顺序
+        self.created_at = created_at
+        self.last_seen = last_seen if last_seen is not None else created_at
+        self.status = status
+        self.token = token
+        self.admitted_at = admitted_at
+        self.claimed = claimed
+
+
+class SessionStore(ABC):
+    """
+    会话存储接口
+
+    timeout 为会话超时秒数，last_active 早于 now - timeout 的会话视为过期；
+    ttl 为排队票据超时秒数，last_seen 早于 now - ttl 的票据过期，结束的票据再保留一个 ttl 供客户端查询
+    """
+
+    @abstractmethod
+    async def try_add(self, token: str, session: SessionData, limit: int, timeout: float) -> bool:
+        """原子地检查该类型的在线数是否小于 limit，是则加入；返回是否加入"""
+
+    @abstractmethod
+    async def touch(self, token: str, now: float, timeout: float) -> SessionData | None:
+        """会话有效时刷新活跃时间并返回；不存在或已过期（顺带移除）时返回 None"""
+
+    @abstractmethod
+    async def get(self, token: str) -> SessionData | None:
+        """读取会话（不刷新活跃时间）"""
+
+    @abstractmethod
+    async def remove(self, token: str) -> bool:
+        """移除会话，返回会话是否存在"""
+
+    @abstractmethod
+    async def count(self, session_type: str, now: float, timeout: float) -> int:
+        """该类型的在线会话数（不含过期会话）"""
+
+    @abstractmethod
+    async def cleanup(self, now: float, timeout: float) -> int:
+        """移除过期会话，返回移除数量"""
+
+    @abstractmethod
+    async def enqueue_ticket(self, ticket_id: str, now: float, max_size: int) -> TicketData | None:
+        """排队人数小于 max_size 时把票据加到队尾并返回，否则返回 None"""
+
+    @abstractmethod
+    async def get_ticket(self, ticket_id: str) -> TicketData | None:
+        """读取票据"""
+
+    @abstractmethod
+    async def touch_ticket(self, ticket_id: str, now: float) -> TicketData | None:
+        """刷新票据的最后活跃时间并返回，不存在时返回 None"""
+
+    @abstractmethod
+    async def ticket_position(self, ticket: TicketData) -> int:
+        """排队位置（从 1 开始），不在队伍中时返回 0"""
+
+    @abstractmethod
+    async def waiting_count(self) -> int:
+        """排队人数"""
+
+    @abstractmethod
+    async def admit_head(self, token: str, session: SessionData, limit: int, timeout: float) -> TicketData | None:
+        """
+        原子地放行队首：队伍不空且该类型在线数小于 limit 时加入会话，队首票据改为 admitted 并记下 token
+
+        Returns:
+            放行的票据；队伍为空或名额已满时返回 None
+        """
+
+    @abstractmethod
+    async def claim_ticket(self, ticket_id: str) -> tuple[TicketData | None, bool]:
+        """客户端取走令牌：admitted 的票据标记为已领取；返回 (票据, 是否本次领取)"""
+
+    @abstractmethod
+    async def leave_ticket(self, ticket_id: str) -> bool:
+        """排队中的票据离开队伍，返回是否离开"""
+
+    @abstractmethod
+    async def expire_tickets(self, now: float, ttl: float) -> tuple[int, int]:
+        """
+        原子地处理超时票据：排队中的出队；已放行但未领取的改为 expired 并移除其会话（名额收回）；
+        结束超过 2 * ttl 的票据删除
+
+        Returns:
+            (出队的排队票据数, 收回的名额数)
+        """
+
+    @abstractmethod
+    async def reset(self) -> None:
+        """清空所有会话和排队票据"""
+
+    async def close(self) -> None:
+        pass
+
+
+class MemorySessionStore(SessionStore):
+    """
+    进程内存储
+
+    按会话类型增量计数；过期会话由 (last_active, token) 最小堆找出，
+    刷新活跃时间时压入新条目，旧条目在弹出时按 last_active 识别并跳过。
+    排队中票据的入队序号保存在有序列表中，排队位置用二分查找得到
+    """
+
+    def __init__(self):
+        self._sessions: dict[str, SessionData] = {}
+        self._counts: dict[str, int] = {}
+        self._expiry: list[tuple[float, str]] = []
+        self._tickets: dict[str, TicketData] = {}
+        self._queue: list[int] = []  # 排队中票据的入队序号（递增有序）
+        self._by_seq: dict[int, TicketData] = {}
+        self._next_seq = 0
+
+    async def try_add(self, token: str, session: SessionData, limit: int, timeout: float) -> bool:
+        return self._add(token, session, limit, timeout)
+
+    def _add(self, token: str, session: SessionData, limit: int, timeout: float) -> bool:
+        self._cleanup(session.created_at, timeout)
+        if self._counts.get(session.type, 0) >= limit:
+            return False
+        self._sessions[token] = session
+        self._counts[session.type] = self._counts.get(session.type, 0) + 1
+        self._push(token, session)
+        return True
+
+    async def touch(self, token: str, now: float, timeout: float) -> SessionData | None:
+        session = self._sessions.get(token)
+        if session is None:
+            return None
+        if now - session.last_active > timeout:
+            self._remove(token)
+            return None
+        session.last_active = now
+        self._push(token, session)
+        return session
+
+    async def get(self, token: str) -> SessionData | None:
+        return self._sessions.get(token)
+
+    async def remove(self, token: str) -> bool:
+        existed = token in self._sessions
+        self._remove(token)
+        return existed
+
+    async def count(self, session_type: str, now: float, timeout: float) -> int:
+        # 没有过期会话时只查看堆顶
+        self._cleanup(now, timeout)
+        return self._counts.get(session_type, 0)
+
+    def _remove(self, token: str) -> None:
+        session = self._sessions.pop(token, None)
+        if session is not None:
+            self._counts[session.type] -= 1
+
+    def _push(self, token: str, session: SessionData) -> None:
+        heapq.heappush(self._expiry, (session.last_active, token))
+        # 频繁刷新会留下大量旧条目，超过在线数两倍时重建堆
+        if len(self._expiry) > 2 * len(self._sessions) + 64:
+            self._expiry = [(s.last_active, t) for t, s in self._sessions.items()]
+            heapq.heapify(self._expiry)
+
+    async def cleanup(self, now: float, timeout: float) -> int:
+        return self._cleanup(now, timeout)
+
+    def _cleanup(self, now: float, timeout: float) -> int:
+        deadline = now - timeout
+        expired = 0
+        while self._expiry and self._expiry[0][0] < deadline:
+            last_active, token = heapq.heappop(self._expiry)
+            session = self._sessions.get(token)
+            # 会话已移除，或之后刷新过活跃时间（堆里有更新的条目）
+            if session is None or session.last_active != last_active:
+                continue
+            self._remove(token)
+            expired += 1
+        return expired
+
+    async def enqueue_ticket(self, ticket_id: str, now: float, max_size: int) -> TicketData | None:
+        if len(self._queue) >= max_size:
+            return None
+        ticket = TicketData(ticket_id, self._next_seq, created_at=now)
+        self._next_seq += 1
+        self._tickets[ticket_id] = ticket
+        self._queue.append(ticket.seq)
+        self._by_seq[ticket.seq] = ticket
+        return ticket
+
+    async def get_ticket(self, ticket_id: str) -> TicketData | None:
+        return self._tickets.get(ticket_id)
+
+    async def touch_ticket(self, ticket_id: str, now: float) -> TicketData | None:
+        ticket = self._tickets.get(ticket_id)
+        if ticket is not None:
+            ticket.last_seen = now
+        return ticket
+
+    async def ticket_position(self, ticket: TicketData) -> int:
+        if ticket.status != "waiting":
+            return 0
+        return bisect_left(self._queue, ticket.seq) + 1
+
+    async def waiting_count(self) -> int:
+        return len(self._queue)
+
+    async def admit_head(self, token: str, session: SessionData, limit: int, timeout: float) -> TicketData | None:
+        if not self._queue or not self._add(token, session, limit, timeout):
+            return None
+        head = self._by_seq[self._queue[0]]
+        self._dequeue(head, "admitted")
+        head.token = token
+        head.admitted_at = session.created_at
+        return head
+
+    async def claim_ticket(self, ticket_id: str) -> tuple[TicketData | None, bool]:
+        ticket = self._tickets.get(ticket_id)
+        if ticket is None or ticket.status != "admitted" or ticket.claimed:
+            return ticket, False
+        ticket.claimed = True
+        return ticket, True
+
+    async def leave_ticket(self, ticket_id: str) -> bool:
+        ticket = self._tickets.get(ticket_id)
+        if ticket is None or ticket.status != "waiting":
+            return False
+        self._dequeue(ticket, "left")
+        return True
+
+    async def expire_tickets(self, now: float, ttl: float) -> tuple[int, int]:
+        expired = reclaimed = 0
+        for ticket in list(self._tickets.values()):
+            if now - ticket.last_seen <= ttl:
+                continue
+            if ticket.status == "waiting":
+                self._dequeue(ticket, "expired")
+                expired += 1
+            elif ticket.status == "admitted" and not ticket.claimed:
+                ticket.status = "expired"
+                self._remove(ticket.token)
+                reclaimed += 1
+            elif now - ticket.last_seen > 2 * ttl:
+                del self._tickets[ticket.id]
+        return expired, reclaimed
+
+    def _dequeue(self, ticket: TicketData, status: str) -> None:
+        index = bisect_left(self._queue, ticket.seq)
+        if index < len(self._queue) and self._queue[index] == ticket.seq:
+            del self._queue[index]
+        self._by_seq.pop(ticket.seq, None)
+        ticket.status = status
+
+    async def reset(self) -> None:
+        self._sessions.clear()
+        self._counts.clear()
+        self._expiry.clear()
+        self._tickets.clear()
+        self._queue.clear()
+        self._by_seq.clear()
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    SQLite 文件存储（WAL 模式），同一台机器上的多个 worker 共享
+
+    名额检查在 BEGIN IMMEDIATE 事务中完成，同一时刻只有一个 worker 能写入；
+    等待写锁可能长达数秒，所有操作都在线程池中执行
+    """
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            " token TEXT PRIMARY KEY, type TEXT NOT NULL, created_at REAL NOT NULL, last_active REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS sessions_type_active ON sessions (type, last_active)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS sessions_active ON sessions (last_active)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS tickets ("
+            " seq INTEGER PRIMARY KEY AUTOINCREMENT, id TEXT UNIQUE NOT NULL, created_at REAL NOT NULL,"
+            " last_seen REAL NOT NULL, status TEXT NOT NULL, token TEXT, admitted_at REAL,"
+            " claimed INTEGER NOT NULL DEFAULT 0)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS tickets_status_seq ON tickets (status, seq)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS tickets_seen ON tickets (last_seen)")
+
+    def _run_transaction(self, fn):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(self._conn)
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+            return result
+
+    async def _transaction(self, fn):
+        return await asyncio.to_thread(self._run_transaction, fn)
+
+    def _query_one(self, sql: str, params: tuple):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchone()
+
+    @staticmethod
+    def _add(conn: sqlite3.Connection, token: str, session: SessionData, limit: int, timeout: float) -> bool:
+        conn.execute("DELETE FROM sessions WHERE last_active < ?", (session.created_at - timeout,))
+        (count,) = conn.execute("SELECT COUNT(*) FROM sessions WHERE type = ?", (session.type,)).fetchone()
+        if count >= limit:
+            return False
+        conn.execute(
+            "INSERT INTO sessions (token, type, created_at, last_active) VALUES (?, ?, ?, ?)",
+            (token, session.type, session.created_at, session.last_active),
+        )
+        return True
+
+    async def try_add(self, token: str, session: SessionData, limit: int, timeout: float) -> bool:
+        return await self._transaction(lambda conn: self._add(conn, token, session, limit, timeout))
+
+    async def touch(self, token: str, now: float, timeout: float) -> SessionData | None:
+        def refresh(conn: sqlite3.Connection) -> SessionData | None:
+            row = conn.execute(
+                "SELECT type, created_at, last_active FROM sessions WHERE token = ?", (token,)
+            ).fetchone()
+            if row is None:
+                return None
+            if now - row[2] > timeout:
+                conn.execute("DELETE FROM sessions WHERE token = ?", (token,))
+                return None
+            conn.execute("UPDATE sessions SET last_active = ? WHERE token = ?", (now, token))
+            return SessionData(row[0], created_at=row[1], last_active=now)
+        return await self._transaction(refresh)
+
+    async def get(self, token: str) -> SessionData | None:
+        row = await asyncio.to_thread(
+            self._query_one, "SELECT type, created_at, last_active FROM sessions WHERE token = ?", (token,)
+        )
+        return SessionData(row[0], created_at=row[1], last_active=row[2]) if row else None
+
+    async def remove(self, token: str) -> bool:
+        return await self._transaction(
+            lambda conn: conn.execute("DELETE FROM sessions WHERE token = ?", (token,)).rowcount > 0
+        )
+
+    async def count(self, session_type: str, now: float, timeout: float) -> int:
+        (count,) = await asyncio.to_thread(
+            self._query_one,
+            "SELECT COUNT(*) FROM sessions WHERE type = ? AND last_active >= ?", (session_type, now - timeout)
+        )
+        return count
+
+    async def cleanup(self, now: float, timeout: float) -> int:
+        return await self._transaction(
+            lambda conn: conn.execute("DELETE FROM sessions WHERE last_active < ?", (now - timeout,)).rowcount
+        )
+
+    _TICKET_COLUMNS = "id, seq, created_at, last_seen, status, token, admitted_at, claimed"
+
+    @staticmethod
+    def _ticket(row) -> TicketData | None:
+        if row is None:
+            return None
+        ticket_id, seq, created_at, last_seen, status, token, admitted_at, claimed = row
+        return TicketData(ticket_id, seq, created_at, last_seen, status, token, admitted_at, bool(claimed))
+
+    def _select_ticket(self, conn: sqlite3.Connection, ticket_id: str) -> TicketData | None:
+        return self._ticket(
+            conn.execute(f"SELECT {self._TICKET_COLUMNS} FROM tickets WHERE id = ?", (ticket_id,)).fetchone()
+        )
+
+    async def enqueue_ticket(self, ticket_id: str, now: float, max_size: int) -> TicketData | None:
+        def enqueue(conn: sqlite3.Connection) -> TicketData | None:
+            (waiting,) = conn.execute("SELECT COUNT(*) FROM tickets WHERE status = 'waiting'").fetchone()
+            if waiting >= max_size:
+                return None
+            conn.execute(
+                "INSERT INTO tickets (id, created_at, last_seen, status) VALUES (?, ?, ?, 'waiting')",
+                (ticket_id, now, now),
+            )
+            return self._select_ticket(conn, ticket_id)
+        return await self._transaction(enqueue)
+
+    async def get_ticket(self, ticket_id: str) -> TicketData | None:
+        row = await asyncio.to_thread(
+            self._query_one, f"SELECT {self._TICKET_COLUMNS} FROM tickets WHERE id = ?", (ticket_id,)
+        )
+        return self._ticket(row)
+
+    async def touch_ticket(self, ticket_id: str, now: float) -> TicketData | None:
+        def touch(conn: sqlite3.Connection) -> TicketData | None:
+            conn.execute("UPDATE tickets SET last_seen = ? WHERE id = ?", (now, ticket_id))
+            return self._select_ticket(conn, ticket_id)
+        return await self._transaction(touch)
+
+    async def ticket_position(self, ticket: TicketData) -> int:
+        if ticket.status != "waiting":
+            return 0
+        (position,) = await asyncio.to_thread(
+            self._query_one, "SELECT COUNT(*) FROM tickets WHERE status = 'waiting' AND seq <= ?", (ticket.seq,)
+        )
+        return position
+
+    async def waiting_count(self) -> int:
+        (count,) = await asyncio.to_thread(
+            self._query_one, "SELECT COUNT(*) FROM tickets WHERE status = 'waiting'", ()
+        )
+        return count
+
+    async def admit_head(self, token: str, session: SessionData, limit: int, timeout: float) -> TicketData | None:
+        def admit(conn: sqlite3.Connection) -> TicketData | None:
+            row = conn.execute("SELECT id FROM tickets WHERE status = 'waiting' ORDER BY seq LIMIT 1").fetchone()
+            if row is None or not self._add(conn, token, session, limit, timeout):
+                return None
+            conn.execute(
+                "UPDATE tickets SET status = 'admitted', token = ?, admitted_at = ? WHERE id = ?",
+                (token, session.created_at, row[0]),
+            )
+            return self._select_ticket(conn, row[0])
+        return await self._transaction(admit)
+
+    async def claim_ticket(self, ticket_id: str) -> tuple[TicketData | None, bool]:
+        def claim(conn: sqlite3.Connection) -> tuple[TicketData | None, bool]:
+            claimed = conn.execute(
+                "UPDATE tickets SET claimed = 1 WHERE id = ? AND status = 'admitted' AND claimed = 0", (ticket_id,)
+            ).rowcount > 0
+            return self._select_ticket(conn, ticket_id), claimed
+        return await self._transaction(claim)
+
+    async def leave_ticket(self, ticket_id: str) -> bool:
+        return await self._transaction(
+            lambda conn: conn.execute(
+                "UPDATE tickets SET status = 'left' WHERE id = ? AND status = 'waiting'", (ticket_id,)
+            ).rowcount > 0
+        )
+
+    async def expire_tickets(self, now: float, ttl: float) -> tuple[int, int]:
+        def expire(conn: sqlite3.Connection) -> tuple[int, int]:
+            deadline = now - ttl
+            expired = conn.execute(
+                "UPDATE tickets SET status = 'expired' WHERE status = 'waiting' AND last_seen < ?", (deadline,)
+            ).rowcount
+            unclaimed = "status = 'admitted' AND claimed = 0 AND last_seen < ?"
+            tokens = [row[0] for row in conn.execute(f"SELECT token FROM tickets WHERE {unclaimed}", (deadline,))]
+            conn.execute(f"UPDATE tickets SET status = 'expired' WHERE {unclaimed}", (deadline,))
+            conn.executemany("DELETE FROM sessions WHERE token = ?", [(token,) for token in tokens])
+            conn.execute("DELETE FROM tickets WHERE status != 'waiting' AND last_seen < ?", (now - 2 * ttl,))
+            return expired, len(tokens)
+        return await self._transaction(expire)
+
+    async def reset(self) -> None:
+        def clear(conn: sqlite3.Connection) -> None:
+            conn.execute("DELETE FROM sessions")
+            conn.execute("DELETE FROM tickets")
+        await self._transaction(clear)
+
+    async def close(self) -> None:
+        def close():
+            with self._lock:
+                self._conn.close()
+        await asyncio.to_thread(close)
+
+
+# KEYS[1]: 该类型的在线集合（ZSET，score 为 last_active），KEYS[2]: 会话 HASH
+# ARGV: token, type, created_at, last_active, limit, timeout
+_REDIS_ADD = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', '(' .. (tonumber(ARGV[4]) - tonumber(ARGV[6])))
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[5]) then
+    return 0
+end
+redis.call('ZADD', KEYS[1], ARGV[4], ARGV[1])
+redis.call('HSET', KEYS[2], 'type', ARGV[2], 'created_at', ARGV[3], 'last_active', ARGV[4])
+redis.call('EXPIRE', KEYS[2], math.ceil(tonumber(ARGV[6])))
+return 1
+"""
+
+# KEYS[1]: 会话 HASH；ARGV: token, now, timeout, 在线集合键前缀
+_REDIS_TOUCH = """
+local session = redis.call('HMGET', KEYS[1], 'type', 'created_at', 'last_active')
+if not session[1] then
+    return nil
+end
+local active = ARGV[4] .. session[1]
+if tonumber(ARGV[2]) - tonumber(session[3]) > tonumber(ARGV[3]) then
+    redis.call('DEL', KEYS[1])
+    redis.call('ZREM', active, ARGV[1])
+    return nil
+end
+redis.call('HSET', KEYS[1], 'last_active', ARGV[2])
+redis.call('EXPIRE', KEYS[1], math.ceil(tonumber(ARGV[3])))
+redis.call('ZADD', active, ARGV[2], ARGV[1])
+return {session[1], session[2]}
+"""
+
+# 排队：{prefix}:queue 为排队中的票据（ZSET，score 为入队序号），{prefix}:ticket_seen 为所有票据（ZSET，score 为 last_seen），
+# {prefix}:ticket:{id} 为票据详情（HASH），{prefix}:ticket_seq 为入队序号计数器
+TICKET_FIELDS = ("seq", "created_at", "last_seen", "status", "token", "admitted_at", "claimed")
+
+# KEYS[1]: queue, KEYS[2]: ticket_seq, KEYS[3]: ticket_seen, KEYS[4]: 票据 HASH；ARGV: id, now, max_size
+_REDIS_ENQUEUE = """
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[3]) then
+    return nil
+end
+local seq = redis.call('INCR', KEYS[2])
+redis.call('ZADD', KEYS[1], seq, ARGV[1])
+redis.call('ZADD', KEYS[3], ARGV[2], ARGV[1])
+redis.call('HSET', KEYS[4], 'seq', seq, 'created_at', ARGV[2], 'last_seen', ARGV[2], 'status', 'waiting', 'claimed', 0)
+return seq
+"""
+
+# KEYS[1]: 票据 HASH, KEYS[2]: ticket_seen；ARGV: id, now
+_REDIS_TICKET_TOUCH = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'last_seen', ARGV[2])
+redis.call('ZADD', KEYS[2], ARGV[2], ARGV[1])
+return 1
+"""
+
+# KEYS[1]: queue, KEYS[2]: 该类型的在线集合, KEYS[3]: 新会话 HASH
+# ARGV: token, type, created_at, limit, timeout, 票据键前缀
+_REDIS_ADMIT = """
+local head = redis.call('ZRANGE', KEYS[1], 0, 0)
+if #head == 0 then
+    return nil
+end
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', '(' .. (tonumber(ARGV[3]) - tonumber(ARGV[5])))
+if redis.call('ZCARD', KEYS[2]) >= tonumber(ARGV[4]) then
+    return nil
+end
+redis.call('ZADD', KEYS[2], ARGV[3], ARGV[1])
+redis.call('HSET', KEYS[3], 'type', ARGV[2], 'created_at', ARGV[3], 'last_active', ARGV[3])
+redis.call('EXPIRE', KEYS[3], math.ceil(tonumber(ARGV[5])))
+redis.call('ZREM', KEYS[1], head[1])
+redis.call('HSET', ARGV[6] .. head[1], 'status', 'admitted', 'token', ARGV[1], 'admitted_at', ARGV[3])
+return head[1]
+"""
+
+# KEYS[1]: 票据 HASH
+_REDIS_CLAIM = """
+local ticket = redis.call('HMGET', KEYS[1], 'status', 'claimed')
+if ticket[1] ~= 'admitted' or ticket[2] ~= '0' then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'claimed', 1)
+return 1
+"""
+
+# KEYS[1]: 票据 HASH, KEYS[2]: queue；ARGV: id
+_REDIS_LEAVE = """
+if redis.call('HGET', KEYS[1], 'status') ~= 'waiting' then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'status', 'left')
+redis.call('ZREM', KEYS[2], ARGV[1])
+return 1
+"""
+
+# KEYS[1]: ticket_seen, KEYS[2]: queue；ARGV: now, ttl, 票据键前缀, 会话键前缀, 在线集合键前缀
+_REDIS_EXPIRE = """
+local now, ttl = tonumber(ARGV[1]), tonumber(ARGV[2])
+local expired, reclaimed = 0, 0
+for _, id in ipairs(redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', '(' .. (now - ttl))) do
+    local key = ARGV[3] .. id
+    local ticket = redis.call('HMGET', key, 'status', 'token', 'claimed', 'last_seen')
+    if not ticket[1] then
+        redis.call('ZREM', KEYS[1], id)
+    elseif ticket[1] == 'waiting' then
+        redis.call('ZREM', KEYS[2], id)
+        redis.call('HSET', key, 'status', 'expired')
+        expired = expired + 1
+    elseif ticket[1] == 'admitted' and ticket[3] == '0' then
+        redis.call('HSET', key, 'status', 'expired')
+        local session = ARGV[4] .. ticket[2]
+        local session_type = redis.call('HGET', session, 'type')
+        if session_type then
+            redis.call('ZREM', ARGV[5] .. session_type, ticket[2])
+            redis.call('DEL', session)
+        end
+        reclaimed = reclaimed + 1
+    elseif tonumber(ticket[4]) < now - 2 * ttl then
+        redis.call('DEL', key)
+        redis.call('ZREM', KEYS[1], id)
+    end
+end
+return {expired, reclaimed}
+"""
+
+
+class RedisSessionStore(SessionStore):
+    """
+    Redis 协议存储，多台机器共享（任何兼容 Redis 协议的服务器均可），使用异步客户端
+
+    每个会话类型一个 ZSET 记录在线会话，会话详情存在带过期时间的 HASH 中；
+    名额检查和加入在一个 Lua 脚本中原子完成；排队票据的入队、放行、过期回收同样各是一个 Lua 脚本
+    """
+
+    def __init__(self, url: str, prefix: str = "doomsday:sessions"):
+        if redis is None:
+            raise RuntimeError("SESSION_STORE=redis 需要安装 redis 包（pip install \"redis>=5.0.1\"）")
+        self.prefix = prefix
+        self._client = redis.Redis.from_url(url, decode_responses=True)
+        self._add = self._client.register_script(_REDIS_ADD)
+        self._touch = self._client.register_script(_REDIS_TOUCH)
+        self._enqueue = self._client.register_script(_REDIS_ENQUEUE)
+        self._ticket_touch = self._client.register_script(_REDIS_TICKET_TOUCH)
+        self._admit = self._client.register_script(_REDIS_ADMIT)
+        self._claim = self._client.register_script(_REDIS_CLAIM)
+        self._leave = self._client.register_script(_REDIS_LEAVE)
+        self._expire = self._client.register_script(_REDIS_EXPIRE)
+
+    def _active_key(self, session_type: str) -> str:
+        return f"{self.prefix}:active:{session_type}"
+
+    def _session_key(self, token: str) -> str:
+        return f"{self.prefix}:session:{token}"
+
+    def _ticket_key(self, ticket_id: str) -> str:
+        return f"{self.prefix}:ticket:{ticket_id}"
+
+    @property
+    def _queue_key(self) -> str:
+        return f"{self.prefix}:queue"
+
+    @property
+    def _seen_key(self) -> str:
+        return f"{self.prefix}:ticket_seen"
+
+    async def try_add(self, token: str, session: SessionData, limit: int, timeout: float) -> bool:
+        added = await self._add(
+            keys=[self._active_key(session.type), self._session_key(token)],
+            args=[token, session.type, session.created_at, session.last_active, limit, timeout],
+        )
+        return bool(added)
+
+    async def touch(self, token: str, now: float, timeout: float) -> SessionData | None:
+        result = await self._touch(
+            keys=[self._session_key(token)],
+            args=[token, now, timeout, f"{self.prefix}:active:"],
+        )
+        if not result:
+            return None
+        return SessionData(result[0], created_at=float(result[1]), last_active=now)
+
+    async def get(self, token: str) -> SessionData | None:
+        values = await self._client.hmget(self._session_key(token), "type", "created_at", "last_active")
+        if values[0] is None:
+            return None
+        return SessionData(values[0], created_at=float(values[1]), last_active=float(values[2]))
+
+    async def remove(self, token: str) -> bool:
+        session_type = await self._client.hget(self._session_key(token), "type")
+        if session_type is None:
+            return False
+        async with self._client.pipeline() as pipe:
+            pipe.zrem(self._active_key(session_type), token)
+            pipe.delete(self._session_key(token))
+            await pipe.execute()
+        return True
+
+    async def count(self, session_type: str, now: float, timeout: float) -> int:
+        return await self._client.zcount(self._active_key(session_type), now - timeout, "+inf")
+
+    async def cleanup(self, now: float, timeout: float) -> int:
+        # 会话 HASH 自带过期时间，这里只清理在线集合
+        async with self._client.pipeline() as pipe:
+            for session_type in SESSION_TYPES:
+                pipe.zremrangebyscore(self._active_key(session_type), "-inf", f"({now - timeout}")
+            return sum(await pipe.execute())
+
+    async def enqueue_ticket(self, ticket_id: str, now: float, max_size: int) -> TicketData | None:
+        seq = await self._enqueue(
+            keys=[self._queue_key, f"{self.prefix}:ticket_seq", self._seen_key, self._ticket_key(ticket_id)],
+            args=[ticket_id, now, max_size],
+        )
+        return TicketData(ticket_id, int(seq), created_at=now) if seq is not None else None
+
+    async def get_ticket(self, ticket_id: str) -> TicketData | None:
+        values = await self._client.hmget(self._ticket_key(ticket_id), *TICKET_FIELDS)
+        if values[0] is None:
+            return None
+        seq, created_at, last_seen, status, token, admitted_at, claimed = values
+        return TicketData(
+            ticket_id, int(seq), float(created_at), float(last_seen), status, token,
+            float(admitted_at) if admitted_at else None, claimed == "1",
+        )
+
+    async def touch_ticket(self, ticket_id: str, now: float) -> TicketData | None:
+        if not await self._ticket_touch(keys=[self._ticket_key(ticket_id), self._seen_key], args=[ticket_id, now]):
+            return None
+        return await self.get_ticket(ticket_id)
+
+    async def ticket_position(self, ticket: TicketData) -> int:
+        rank = await self._client.zrank(self._queue_key, ticket.id)
+        return rank + 1 if rank is not None else 0
+
+    async def waiting_count(self) -> int:
+        return await self._client.zcard(self._queue_key)
+
+    async def admit_head(self, token: str, session: SessionData, limit: int, timeout: float) -> TicketData | None:
+        ticket_id = await self._admit(
+            keys=[self._queue_key, self._active_key(session.type), self._session_key(token)],
+            args=[token, session.type, session.created_at, limit, timeout, f"{self.prefix}:ticket:"],
+        )
+        return await self.get_ticket(ticket_id) if ticket_id else None
+
+    async def claim_ticket(self, ticket_id: str) -> tuple[TicketData | None, bool]:
+        claimed = bool(await self._claim(keys=[self._ticket_key(ticket_id)]))
+        return await self.get_ticket(ticket_id), claimed
+
+    async def leave_ticket(self, ticket_id: str) -> bool:
+        return bool(await self._leave(keys=[self._ticket_key(ticket_id), self._queue_key], args=[ticket_id]))
+
+    async def expire_tickets(self, now: float, ttl: float) -> tuple[int, int]:
+        expired, reclaimed = await self._expire(
+            keys=[self._seen_key, self._queue_key],
+            args=[now, ttl, f"{self.prefix}:ticket:", f"{self.prefix}:session:", f"{self.prefix}:active:"],
+        )
+        return int(expired), int(reclaimed)
+
+    async def reset(self) -> None:
+        keys = [key async for key in self._client.scan_iter(match=f"{self.prefix}:*")]
+        if keys:
+            await self._client.delete(*keys)
+
+    async def close(self) -> None:
+        await self._client.aclose()
+
+
+def create_session_store(kind: str, url: str = "") -> SessionStore:
+    """
+    按配置创建会话存储
+
+    Args:
+        kind: memory / sqlite / redis
+        url: SQLite 文件路径（为空时使用 data/sessions.sqlite3）或 redis:// 地址
+    """
+    kind = kind.lower()
+    if kind == "memory":
+        return MemorySessionStore()
+    if kind == "sqlite":
+        return SQLiteSessionStore(url or DEFAULT_SQLITE_PATH)
+    if kind == "redis":
+        return RedisSessionStore(url or "redis://localhost:6379/0")
+    raise ValueError(f"未知的会话存储类型: {kind}")
@@ -0,0 +1,69 @@
+"""
+重复请求合并模块（single-flight）
+连点、客户端重试会产生同一会话、同一接口、同一请求体的并发请求。
+非流式接口（结局）的重复请求共享同一次上游调用的结果；
+流式接口的重复请求由 sse_replay 作为额外订阅者接到进行中的生成上
+"""
+import asyncio
+import hashlib
+from typing import Awaitable, Callable, TypeVar
+
+from pydantic import BaseModel
+
+from app.config import get_settings
+from app.core.metrics import metrics
+
+T = TypeVar("T")
+
+
+def flight_key(session: str | None, endpoint: str, request: BaseModel, *extra) -> str | None:
+    """
+    重复请求的合并键：会话令牌 + 接口 + 请求体（及影响输出格式的参数）的哈希
+
+    Returns:
+        合并键；没有会话令牌或未启用合并时返回 None（不合并）
+    """
+    if not session or not get_settings().single_flight_enabled:
+        return None
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(request.model_dump_json().encode("utf-8"))
+    for value in extra:
+        digest.update(f"|{value}".encode("utf-8"))
+    return f"{endpoint}:{session}:{digest.hexdigest()}"
+
+
+class SingleFlight:
+    """
+    同一合并键同时只有一次调用在进行，其余调用方等待并共享结果（包括异常）
+
+    调用在独立任务中执行，发起者被取消不影响其他等待者
+    """
+
+    def __init__(self):
+        self._calls: dict[str, asyncio.Task] = {}
+
+    async def do(self, key: str | None, fn: Callable[[], Awaitable[T]], endpoint: str = "") -> T:
+        if key is None:
+            return await fn()
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.get_running_loop().create_task(fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda t: self._done(key, t))
+            metrics.incr("single_flight_total", endpoint=endpoint, outcome="leader")
+        else:
+            metrics.incr("single_flight_total", endpoint=endpoint, outcome="shared")
+        return await asyncio.shield(task)
+
+    def _done(self, key: str, task: asyncio.Task) -> None:
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            task.exception()  # 等待者都已离开时避免 "exception was never retrieved"
+
+    def in_flight(self) -> int:
+        return len(self._calls)
+
+
+# 全局单例
+single_flight = SingleFlight()
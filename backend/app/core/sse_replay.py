@@ -0,0 +1,362 @@
+"""
+可续传 SSE 模块
+生成在后台任务中进行，每个事件带 id（{stream_id}:{序号}）写入该次生成的有界环形缓冲；
+客户端断线后带 Last-Event-ID 重新请求同一接口时，先补发错过的事件，再接着跟随仍在进行的生成，
+不会重新调用 LLM。已结束的流保留一段时间供补发，按时间和内存占用淘汰。
+无法续传（流不在本进程、已淘汰、缓冲已丢弃或续传关闭）时只返回一个 reset 事件，不会悄悄开始新的生成；
+客户端清空已收到的内容后不带 Last-Event-ID 重新请求。注册表在进程内，多 worker 部署时负载均衡必须按
+会话令牌粘性路由，否则续传请求落到别的 worker 上只会收到 reset。
+同一合并键（见 single_flight.flight_key）的重复请求作为额外订阅者接到进行中的生成上，从第一个事件开始补发。
+所有订阅者都断开且在宽限期内没有重连时，取消后台生成并关闭上游连接
+"""
+import asyncio
+import contextlib
+import json
+import logging
+import time
+import uuid
+from collections import OrderedDict, deque
+from typing import AsyncGenerator, Callable
+
+from fastapi import Request
+from fastapi.responses import StreamingResponse
+
+from app.config import get_settings
+from app.core.metrics import metrics
+from app.core.streaming import CANCEL_CLIENT_GONE
+
+logger = logging.getLogger(__name__)
+
+# 等待新事件时检查客户端是否断开的间隔（秒）
+DISCONNECT_POLL_SECONDS = 1.0
+
+# reset 事件的原因
+RESET_UNKNOWN_STREAM = "unknown_stream"  # 本进程没有这个流（已淘汰、服务重启或请求落到了别的 worker）
+RESET_NOT_RESUMABLE = "not_resumable"  # 流存在，但会话/接口不匹配或错过的事件已被环形缓冲丢弃
+RESET_DISABLED = "replay_disabled"  # 未开启续传
+
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "Connection": "keep-alive",
+    "X-Accel-Buffering": "no",
+}
+
+
+def sse_response(events: AsyncGenerator[str, None], stream_id: str | None = None) -> StreamingResponse:
+    """构造 SSE 响应，stream_id 通过 X-Stream-Id 响应头返回"""
+    headers = dict(SSE_HEADERS)
+    if stream_id:
+        headers["X-Stream-Id"] = stream_id
+    return StreamingResponse(events, media_type="text/event-stream", headers=headers)
+
+
+class ReplayStream:
+    """
+    一次生成的事件缓冲
+
+    环形缓冲按字节数限制，超出时丢弃最早的事件；丢弃后早于缓冲起点的 Last-Event-ID 无法续传
+    """
+
+    def __init__(self, stream_id: str, session: str | None, endpoint: str, max_bytes: int, key: str | None = None):
+        self.id = stream_id
+        self.session = session
+        self.endpoint = endpoint
+        self.key = key  # 重复请求合并键
+        self.max_bytes = max_bytes
+        self.created_at = time.monotonic()
+        self.finished_at: float | None = None
+        self.size = 0
+        self.subscribers = 0
+        self.evicted = False  # 已从注册表移除，不再接受续传
+        self.task: asyncio.Task | None = None  # 后台生成任务
+        self.on_abandoned: Callable[["ReplayStream"], None] | None = None  # 最后一个订阅者断开时回调
+        self._events: deque[tuple[int, str]] = deque()
+        self._next_seq = 1
+        self._changed = asyncio.Event()
+
+    @property
+    def finished(self) -> bool:
+        return self.finished_at is not None
+
+    def _first_seq(self) -> int:
+        return self._events[0][0] if self._events else self._next_seq
+
+    def publish(self, payload: str) -> int:
+        """
+        追加一个事件（payload 为完整的 "data: ...\\n\\n" 文本）
+
+        Returns:
+            缓冲字节数的变化量
+        """
+        seq = self._next_seq
+        self._next_seq += 1
+        event = f"id: {self.id}:{seq}\n{payload}"
+        size = len(event.encode("utf-8"))
+        self._events.append((seq, event))
+        delta = size
+        while self.size + delta > self.max_bytes and len(self._events) > 1:
+            _, dropped = self._events.popleft()
+            delta -= len(dropped.encode("utf-8"))
+        self.size += delta
+        self._notify()
+        return delta
+
+    def finish(self) -> None:
+        self.finished_at = time.monotonic()
+        self._notify()
+
+    def _notify(self) -> None:
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def can_resume(self, after: int) -> bool:
+        """序号 after 之后的事件是否都还在缓冲中"""
+        return self._first_seq() <= after + 1 <= self._next_seq
+
+    async def follow(self, after: int = 0, client: Request | None = None) -> AsyncGenerator[str, None]:
+        """
+        补发序号 after 之后的事件，然后跟随实时事件直到生成结束
+
+        Args:
+            after: 已收到的最后一个事件序号
+            client: 客户端请求，等待新事件期间通过 is_disconnected() 检测断开
+        """
+        self.subscribers += 1
+        try:
+            while True:
+                changed = self._changed
+                first = self._first_seq()
+                if after + 1 < first:
+                    # 读取太慢，未发送的事件已被环形缓冲丢弃；结束响应，由客户端重新请求
+                    metrics.incr("sse_replay_gap_total", endpoint=self.endpoint)
+                    return
+                pending = [self._events[i] for i in range(after + 1 - first, len(self._events))]
+                for seq, event in pending:
+                    after = seq
+                    yield event
+                if self.finished and after + 1 >= self._next_seq:
+                    return
+                if client is None:
+                    await changed.wait()
+                    continue
+                try:
+                    await asyncio.wait_for(changed.wait(), DISCONNECT_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    if await client.is_disconnected():
+                        return
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.finished and self.on_abandoned:
+                self.on_abandoned(self)
+
+
+class ReplayRegistry:
+    """所有可续传流的注册表（进程内）"""
+
+    def __init__(self):
+        self._streams: OrderedDict[str, ReplayStream] = OrderedDict()
+        self._flights: dict[str, ReplayStream] = {}  # 合并键 -> 进行中的生成
+        self._tasks: set[asyncio.Task] = set()
+        self._size = 0
+
+    def start(
+        self,
+        session: str | None,
+        endpoint: str,
+        source: AsyncGenerator[str, None],
+        key: str | None = None,
+        client: Request | None = None,
+    ) -> StreamingResponse:
+        """
+        在后台任务中运行 source，返回跟随该生成的 SSE 响应；
+        同一合并键已有进行中的生成时不运行 source，直接接到该生成上
+
+        Args:
+            session: 会话令牌，续传时必须一致
+            endpoint: 接口名称（如 "game/narrate"），续传时必须一致
+            source: 产生 SSE 文本的生成器
+            key: 重复请求合并键，None 表示不合并
+            client: 客户端请求，用于检测断开
+        """
+        settings = get_settings()
+        stream = ReplayStream(
+            stream_id=uuid.uuid4().hex,
+            session=session,
+            endpoint=endpoint,
+            max_bytes=settings.sse_replay_stream_kb * 1024,
+            key=key,
+        )
+        stream.on_abandoned = self._abandoned
+        if settings.sse_replay_enabled:
+            # 路由在 join() 之后可能还有 await（如内容审核），这里再检查一次
+            joined = self.join(key, endpoint, client)
+            if joined is not None:
+                return joined
+            self._streams[stream.id] = stream
+            if key:
+                self._flights[key] = stream
+                metrics.incr("single_flight_total", endpoint=endpoint, outcome="leader")
+            self._evict()
+        else:
+            # 不可续传：缓冲只用于转发给当前连接，不计入注册表
+            stream.evicted = True
+
+        stream.task = self._spawn(self._produce(stream, source))
+        return sse_response(stream.follow(client=client), stream.id)
+
+    def _spawn(self, coro) -> asyncio.Task:
+        task = asyncio.get_running_loop().create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def resume(
+        self,
+        last_event_id: str | None,
+        session: str | None,
+        endpoint: str,
+        client: Request | None = None,
+    ) -> StreamingResponse | None:
+        """
+        按 Last-Event-ID 续传
+
+        Returns:
+            没有 Last-Event-ID 时返回 None（正常的新请求）；
+            能续传时返回补发并跟随原生成的 SSE 响应，否则返回只含一个 reset 事件的 SSE 响应
+        """
+        if not last_event_id:
+            return None
+        if not get_settings().sse_replay_enabled:
+            return self._reset(endpoint, last_event_id, RESET_DISABLED)
+        stream_id, _, seq = last_event_id.strip().rpartition(":")
+        stream = self._streams.get(stream_id)
+        if stream is None:
+            return self._reset(endpoint, last_event_id, RESET_UNKNOWN_STREAM)
+        try:
+            after = int(seq)
+        except ValueError:
+            after = -1
+        if stream.session != session or stream.endpoint != endpoint or not stream.can_resume(after):
+            return self._reset(endpoint, last_event_id, RESET_NOT_RESUMABLE)
+        metrics.incr("sse_resume_total", endpoint=endpoint, outcome="hit")
+        logger.info(f"[SSE] 续传 {endpoint} 流 {stream_id[:8]}，从事件 {after} 之后开始")
+        return sse_response(stream.follow(after, client), stream.id)
+
+    def _reset(self, endpoint: str, last_event_id: str, reason: str) -> StreamingResponse:
+        """无法续传：返回只含一个 reset 事件的响应，由客户端清空内容后重新请求"""
+        metrics.incr("sse_resume_total", endpoint=endpoint, outcome="miss")
+        metrics.incr("sse_reset_total", endpoint=endpoint, reason=reason)
+        logger.info(f"[SSE] 无法续传 {last_event_id}（{reason}），要求客户端重新请求")
+        payload = json.dumps({"type": "reset", "reason": reason})
+
+        async def events():
+            yield f"data: {payload}\n\n"
+
+        return sse_response(events())
+
+    def join(
+        self,
+        key: str | None,
+        endpoint: str,
+        client: Request | None = None,
+    ) -> StreamingResponse | None:
+        """
+        重复请求合并：同一合并键有进行中的生成时，返回从第一个事件开始补发并跟随它的 SSE 响应
+
+        Returns:
+            SSE 响应；没有可合并的生成时返回 None
+        """
+        stream = self._flights.get(key) if key else None
+        if stream is None or stream.finished or not stream.can_resume(0):
+            return None
+        metrics.incr("single_flight_total", endpoint=endpoint, outcome="shared")
+        logger.info(f"[SSE] 重复请求，合并到进行中的 {endpoint} 流 {stream.id[:8]}")
+        return sse_response(stream.follow(0, client), stream.id)
+
+    async def _produce(self, stream: ReplayStream, source: AsyncGenerator[str, None]) -> None:
+        """后台任务：把 source 的事件写入缓冲，与客户端连接的断开无关"""
+        try:
+            async for payload in source:
+                delta = stream.publish(payload)
+                if not stream.evicted:
+                    self._size += delta
+                    if self._size > get_settings().sse_replay_max_total_mb * 1024 * 1024:
+                        self._evict()
+        except Exception as e:
+            # 路由的生成器自己处理并下发错误事件，这里只兜底
+            logger.error(f"[SSE] {stream.endpoint} 流 {stream.id[:8]} 异常结束: {e}")
+        finally:
+            with contextlib.suppress(Exception):
+                await source.aclose()
+            stream.finish()
+            self._forget_flight(stream)
+            self._evict()
+
+    def _abandoned(self, stream: ReplayStream) -> None:
+        """最后一个订阅者断开：宽限期内没有重连（续传或重复请求）则取消生成"""
+        settings = get_settings()
+        grace = settings.sse_disconnect_grace if settings.sse_replay_enabled else 0
+        self._spawn(self._cancel_if_abandoned(stream, grace))
+
+    async def _cancel_if_abandoned(self, stream: ReplayStream, grace: float) -> None:
+        if grace > 0:
+            await asyncio.sleep(grace)
+        if stream.subscribers or stream.finished or stream.task is None or stream.task.done():
+            return
+        metrics.incr("sse_abandoned_total", endpoint=stream.endpoint)
+        logger.info(f"[SSE] {stream.endpoint} 流 {stream.id[:8]} 的客户端已断开，取消生成")
+        stream.task.cancel(CANCEL_CLIENT_GONE)
+
+    def _forget_flight(self, stream: ReplayStream) -> None:
+        if stream.key and self._flights.get(stream.key) is stream:
+            del self._flights[stream.key]
+
+    def _remove(self, stream: ReplayStream, reason: str) -> None:
+        del self._streams[stream.id]
+        self._forget_flight(stream)
+        stream.evicted = True
+        self._size -= stream.size
+        metrics.incr("sse_replay_evicted_total", reason=reason)
+
+    def _evict(self) -> None:
+        """按时间、每会话流数和总内存淘汰，优先淘汰已结束的旧流"""
+        settings = get_settings()
+        now = time.monotonic()
+        for stream in list(self._streams.values()):
+            if stream.finished and now - stream.finished_at > settings.sse_replay_ttl:
+                self._remove(stream, "age")
+
+        per_session: dict[str | None, list[ReplayStream]] = {}
+        for stream in self._streams.values():
+            per_session.setdefault(stream.session, []).append(stream)
+        for streams in per_session.values():
+            for stream in streams[:-max(1, settings.sse_replay_streams_per_session)]:
+                self._remove(stream, "session")
+
+        max_total = settings.sse_replay_max_total_mb * 1024 * 1024
+        if self._size > max_total:
+            candidates = [s for s in self._streams.values() if s.finished]
+            candidates += [s for s in self._streams.values() if not s.finished]
+            for stream in candidates:
+                if self._size <= max_total:
+                    break
+                self._remove(stream, "memory")
+
+    async def aclose(self) -> None:
+        """取消所有后台生成（服务关闭时调用）"""
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "streams": len(self._streams),
+            "in_flight": sum(1 for s in self._streams.values() if not s.finished),
+            "coalescing": len(self._flights),
+            "subscribers": sum(s.subscribers for s in self._streams.values()),
+            "buffered_bytes": self._size,
+        }
+
+
+# 全局单例
+replay_registry = ReplayRegistry()
@@ -0,0 +1,337 @@
+"""
+流式输出解析模块
+在服务端增量扫描模型输出：叙事文本原样转发，<state_update>、<notes>、<hidden> 等标签块暂扣，
+标签闭合后解析一次并作为结构化事件下发，前端无需在每个 chunk 上重新跑正则
+"""
+import json
+import re
+
+from pydantic import ValidationError
+
+from app.models import StateUpdate, StreamEventType
+
+# 启用结构化事件的客户端协议版本（请求参数 protocol）
+STRUCTURED_STREAM_PROTOCOL = 2
+
+# 不转发给玩家的标签
+HELD_TAGS = ("state_update", "notes", "hidden")
+
+# 选项行：A. xxx / A、xxx / A．xxx
+CHOICE_LINE_PATTERN = re.compile(r"^\s*([A-D])\s*[\.．、:：]\s*(.+?)\s*$", re.MULTILINE)
+# 危机事件固定提供 A/B/C/D 四个选项
+EXPECTED_CHOICES = 4
+
+
+def parse_json_content(content: str) -> dict:
+    """
+    清理并解析JSON内容
+    处理常见的LLM输出问题：前导逗号、代码块标记等
+    """
+    text = content.strip()
+
+    # 移除可能的 markdown 代码块标记
+    if text.startswith("```json"):
+        text = text[7:]
+    if text.startswith("```"):
+        text = text[3:]
+    if text.endswith("```"):
+        text = text[:-3]
+    text = text.strip()
+
+    # 移除前导逗号（某些模型的常见问题）
+    if text.startswith(","):
+        text = text[1:].strip()
+
+    # 尝试找到JSON对象的起始位置
+    start_idx = text.find("{")
+    if start_idx > 0:
+        text = text[start_idx:]
+
+    # 尝试找到JSON对象的结束位置（处理尾部多余内容）
+    # 使用简单的括号匹配
+    brace_count = 0
+    end_idx = -1
+    for i, char in enumerate(text):
+        if char == "{":
+            brace_count += 1
+        elif char == "}":
+            brace_count -= 1
+            if brace_count == 0:
+                end_idx = i + 1
+                break
+
+    if end_idx > 0:
+        text = text[:end_idx]
+
+    return json.loads(text)
+
+
+# 句末标点（续写时从最后一个完整句子之后继续）
+SENTENCE_ENDINGS = "。！？!?…\n"
+
+
+def sentence_prefix(text: str) -> str:
+    """
+    截取到最后一个完整句子为止的叙事文本（遇到第一个标签即停止，标签内容不算叙事）
+    """
+    tag_start = text.find("<")
+    if tag_start >= 0:
+        text = text[:tag_start]
+    end = max(text.rfind(ch) for ch in SENTENCE_ENDINGS)
+    return text[:end + 1] if end >= 0 else ""
+
+
+class TagScanner:
+    """
+    增量标签扫描器
+
+    每个字符只被扫描常数次：叙事模式下只在 '<' 处判断是否为暂扣标签的开头
+    （不完整的开头留到下一个 chunk），标签内只保留可能构成闭合标签的尾部。
+    标签名不区分大小写。stream_tags 中的标签除了完整标签块，还会逐段返回标签内容
+    """
+
+    def __init__(self, held_tags: tuple[str, ...] = HELD_TAGS, stream_tags: tuple[str, ...] = ()):
+        self._opens = {f"<{tag}>": tag for tag in held_tags}
+        self._max_open = max(len(o) for o in self._opens)
+        self._stream_tags = set(stream_tags)
+        self._buf = ""
+        self._tag: str | None = None
+        self._body: list[str] = []
+
+    def feed(self, chunk: str) -> list[tuple[str, str | None, str]]:
+        """
+        输入一个 chunk
+
+        Returns:
+            [(kind, tag, text), ...]，kind 为 "text"（叙事文本）、"open"（标签开始）、
+            "body"（stream_tags 的标签内容片段）或 "block"（完整标签块）
+        """
+        self._buf += chunk
+        events: list[tuple[str, str | None, str]] = []
+        text_parts: list[str] = []
+
+        def flush_text():
+            if text_parts:
+                events.append(("text", None, "".join(text_parts)))
+                text_parts.clear()
+
+        while self._buf:
+            if self._tag is None:
+                idx = self._buf.find("<")
+                if idx < 0:
+                    text_parts.append(self._buf)
+                    self._buf = ""
+                    break
+                if idx:
+                    text_parts.append(self._buf[:idx])
+                    self._buf = self._buf[idx:]
+                head = self._buf[:self._max_open].lower()
+                opened = next((o for o in self._opens if head.startswith(o)), None)
+                if opened:
+                    flush_text()
+                    self._tag = self._opens[opened]
+                    self._buf = self._buf[len(opened):]
+                    events.append(("open", self._tag, ""))
+                    continue
+                if len(head) < self._max_open and any(o.startswith(head) for o in self._opens):
+                    break  # 可能是被切断的开始标签，等待下一个 chunk
+                text_parts.append("<")
+                self._buf = self._buf[1:]
+            else:
+                close = f"</{self._tag}>"
+                idx = self._buf.lower().find(close)
+                if idx < 0:
+                    keep = len(close) - 1
+                    if len(self._buf) > keep:
+                        self._append_body(self._buf[:-keep], events)
+                        self._buf = self._buf[-keep:]
+                    break
+                self._append_body(self._buf[:idx], events)
+                events.append(("block", self._tag, "".join(self._body)))
+                self._buf = self._buf[idx + len(close):]
+                self._tag = None
+                self._body = []
+
+        flush_text()
+        return events
+
+    def _append_body(self, fragment: str, events: list) -> None:
+        if not fragment:
+            return
+        self._body.append(fragment)
+        if self._tag in self._stream_tags:
+            events.append(("body", self._tag, fragment))
+
+    def finish(self) -> list[tuple[str, str | None, str]]:
+        """输出结束：未闭合的标签块按已收到的内容返回，残留的 '<' 前缀作为叙事文本"""
+        events = []
+        if self._tag is not None:
+            self._append_body(self._buf, events)
+            events.append(("block", self._tag, "".join(self._body)))
+        elif self._buf:
+            events.append(("text", None, self._buf))
+        self._buf = ""
+        self._tag = None
+        self._body = []
+        return events
+
+
+class ChoiceCollector:
+    """按行收集选项，每完成一行就判断是否为新的选项"""
+
+    def __init__(self):
+        self.choices: list[str] = []
+        self._line = ""
+
+    def feed(self, text: str) -> bool:
+        """输入文本片段，返回是否有新选项"""
+        self._line += text
+        *lines, self._line = self._line.split("\n")
+        added = False
+        for line in lines:
+            added = self._add(line) or added
+        return added
+
+    def flush(self) -> bool:
+        """块结束或输出结束时处理最后一行"""
+        line, self._line = self._line, ""
+        return self._add(line)
+
+    def _add(self, line: str) -> bool:
+        match = CHOICE_LINE_PATTERN.match(line)
+        if not match or len(self.choices) >= EXPECTED_CHOICES:
+            return False
+        letter, content = match.groups()
+        self.choices.append(f"{letter}. {content}")
+        return True
+
+
+class NarrativeStreamParser:
+    """
+    把叙事/判定输出转换为 SSE 事件
+
+    structured=True（protocol>=2）时：
+    - content: 叙事文本片段（不含暂扣标签）
+    - state: <state_update> 解析校验后的状态更新；解析失败时 state 为 null 并附带 error 和原文
+    - hidden: <notes>/<hidden> 标签块原文（不展示给玩家，客户端可拼回上下文供后续请求使用）
+    - crisis / choices: detect_choices=True 时，检测到选项块（<options> 或 --- 分隔）即发送 crisis，
+      每完成一行选项发送一次 choices（累计列表）。两种格式的选项都只通过 choices 下发，不再作为 content 转发；
+      为此可能是 --- 的行会暂扣到行尾再决定是否转发
+    structured=False 时内部解析相同，但只原样转发 content，用于判断输出结构是否已经完整（complete）
+
+    complete：<state_update> 已闭合，或四个选项之后的 <hidden> 已闭合。之后的输出不再有用，
+    调用方可以提前关闭上游流
+    """
+
+    def __init__(self, structured: bool = True, detect_choices: bool = False):
+        self.structured = structured
+        self.detect_choices = detect_choices
+        held = HELD_TAGS + ("options",) if detect_choices else HELD_TAGS
+        self._scanner = TagScanner(held, stream_tags=("options",) if detect_choices else ())
+        self._choices = ChoiceCollector()
+        self._options_started = False  # 已进入选项块
+        self._pending_line = ""  # 叙事文本当前行中暂扣的部分（可能是 --- 分隔符）
+        self._line_sent = False  # 当前行已经转发过（不可能是分隔符）
+        self.state: dict | None = None
+        self.complete = False
+
+    @property
+    def choices(self) -> list[str]:
+        return self._choices.choices
+
+    def feed(self, chunk: str) -> list[tuple[str, dict]]:
+        events = self._convert(self._scanner.feed(chunk))
+        if not self.structured:
+            return [(StreamEventType.CONTENT.value, {"text": chunk})]
+        return events
+
+    def finish(self) -> list[tuple[str, dict]]:
+        scanned = self._scanner.finish()
+        if self._options_started:
+            scanned.append(("end", None, ""))
+        events = self._convert(scanned)
+        if self._pending_line and not self.complete:
+            events.append((StreamEventType.CONTENT.value, {"text": self._pending_line}))
+        self._pending_line = ""
+        return events if self.structured else []
+
+    def _convert(self, scanned: list[tuple[str, str | None, str]]) -> list[tuple[str, dict]]:
+        events = []
+        for kind, tag, text in scanned:
+            if self.complete:
+                break  # 结构完整之后的内容丢弃
+            if kind == "text":
+                if self.detect_choices:
+                    events.extend(self._scan_text_line(text))
+                else:
+                    events.append((StreamEventType.CONTENT.value, {"text": text}))
+            elif kind == "open" and tag == "options":
+                if self._pending_line:
+                    events.append((StreamEventType.CONTENT.value, {"text": self._pending_line}))
+                    self._pending_line = ""
+                events.extend(self._start_options())
+            elif kind == "body" and tag == "options":
+                if self._choices.feed(text):
+                    events.append(self._choices_event())
+            elif kind == "end" or (kind == "block" and tag == "options"):
+                if self._choices.flush():
+                    events.append(self._choices_event())
+            elif kind == "block" and tag == "state_update":
+                events.append((StreamEventType.STATE.value, self._parse_state(text)))
+                self.complete = True
+            elif kind == "block":
+                events.append((StreamEventType.HIDDEN.value, {"tag": tag, "text": text}))
+                if tag == "hidden" and len(self.choices) >= EXPECTED_CHOICES:
+                    self.complete = True
+        return events
+
+    def _scan_text_line(self, text: str) -> list[tuple[str, dict]]:
+        """
+        转发叙事文本，同时识别 --- 分隔的旧格式选项
+
+        分隔符之后的文本只作为选项收集，不再转发。当前行在确定不是 --- 之前暂扣
+        （只由空白和至多三个 - 组成时），其余文本照常逐段转发
+        """
+        events = []
+        sent = []
+        lines = text.split("\n")
+        for i, part in enumerate(lines):
+            last = i == len(lines) - 1
+            if self._options_started:
+                if self._choices.feed("\n".join(lines[i:])):
+                    events.append(self._choices_event())
+                break
+            if self._line_sent:
+                sent.append(part if last else part + "\n")
+                self._line_sent = last
+                continue
+            line = self._pending_line + part
+            self._pending_line = ""
+            if not last and line.strip() == "---":
+                events.extend(self._start_options())
+                continue
+            if last and line.strip() in ("", "-", "--", "---"):
+                self._pending_line = line
+            else:
+                sent.append(line if last else line + "\n")
+                self._line_sent = last
+        if sent and "".join(sent):
+            events.insert(0, (StreamEventType.CONTENT.value, {"text": "".join(sent)}))
+        return events
+
+    def _start_options(self) -> list[tuple[str, dict]]:
+        if self._options_started:
+            return []
+        self._options_started = True
+        return [(StreamEventType.CRISIS.value, {"has_crisis": True})]
+
+    def _choices_event(self) -> tuple[str, dict]:
+        return (StreamEventType.CHOICES.value, {"choices": list(self.choices)})
+
+    def _parse_state(self, body: str) -> dict:
+        try:
+            state = StateUpdate.model_validate(parse_json_content(body))
+        except (ValueError, ValidationError) as e:
+            return {"state": None, "error": f"状态更新解析失败: {e}", "raw": body}
+        self.state = state.model_dump()
+        return {"state": self.state}
@@ -0,0 +1,72 @@
+"""
+流式输出工具模块
+"""
+import asyncio
+import contextlib
+from typing import AsyncGenerator, Awaitable
+
+_END = object()
+
+# 取消上游生成的原因（作为 Task.cancel 的 msg 传给被取消的生成，用于区分统计）
+CANCEL_CLIENT_GONE = "client_disconnected"  # 客户端断开且没有重连
+CANCEL_GATE_REJECTED = "gate_rejected"  # 放行检查（内容审核）未通过
+CANCEL_CLOSED = "closed"  # 调用方已拿到需要的内容，提前关闭
+
+
+def cancel_reason(error: BaseException) -> str | None:
+    """取消原因，没有附带原因时返回 None"""
+    return error.args[0] if error.args and isinstance(error.args[0], str) else None
+
+
+async def gated_stream(
+    stream: AsyncGenerator[str, None],
+    gate: Awaitable[None],
+) -> AsyncGenerator[str, None]:
+    """
+    投机执行：上游生成与放行检查（如内容审核）并行
+
+    生成的 chunk 先缓存在服务端，gate 正常返回后一次性放出缓冲并继续实时转发；
+    gate 抛出异常时取消上游生成（关闭上游连接），异常原样抛给调用方。
+    取消上游时附带原因：审核未通过、调用方被取消（沿用其原因）或调用方提前关闭。
+
+    Args:
+        stream: 上游文本流
+        gate: 放行检查，拒绝时抛出异常
+
+    Yields:
+        放行后的文本块
+    """
+    queue: asyncio.Queue = asyncio.Queue()
+
+    async def pump() -> None:
+        try:
+            async for chunk in stream:
+                await queue.put(chunk)
+            await queue.put(_END)
+        except Exception as e:
+            await queue.put(e)
+
+    producer = asyncio.create_task(pump())
+    reason = CANCEL_CLOSED
+    try:
+        try:
+            await gate
+        except Exception:
+            reason = CANCEL_GATE_REJECTED
+            raise
+        while True:
+            item = await queue.get()
+            if item is _END:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    except asyncio.CancelledError as e:
+        reason = cancel_reason(e)
+        raise
+    finally:
+        if not producer.done():
+            producer.cancel(reason)
+            with contextlib.suppress(asyncio.CancelledError):
+                await producer
+        await stream.aclose()
@@ -1,105 +1,162 @@
 """
 流量控制模块
 用于限制并发用户数，并支持 Access Code 绕过限制
+
+会话数据放在可替换的会话存储中（见 session_store），名额检查与加入由存储原子完成；
+后台清理任务定期回收过期会话。开启自适应准入（ADMISSION_ADAPTIVE）时，
+公共名额上限按上游承载能力动态调整（见 admission）
 """
+import asyncio
+import contextlib
 import time
 import uuid
 import logging
-from typing import Dict, Literal
 
 from app.config import get_settings
+from app.core.admission import admission_controller
+from app.core.session_store import SessionData, SessionStore, TicketData, create_session_store
 
 logger = logging.getLogger(__name__)
 
-class SessionData:
-    def __init__(self, session_type: Literal["public", "vip"]):
-        self.type = session_type
-        self.created_at = time.time()
-        self.last_active = time.time()
-
 class TrafficController:
     _instance = None
-    _sessions: Dict[str, SessionData] = {}
     
     def __new__(cls):
         if cls._instance is None:
             cls._instance = super(TrafficController, cls).__new__(cls)
+            cls._instance._store = None
+            cls._instance._reaper = None
         return cls._instance
     
     @property
-    def sessions(self) -> Dict[str, SessionData]:
-        return self._sessions
+    def store(self) -> SessionStore:
+        """会话存储（懒加载，按 SESSION_STORE 配置创建）"""
+        if self._store is None:
+            settings = get_settings()
+            self._store = create_session_store(settings.SESSION_STORE, settings.SESSION_STORE_URL)
+            logger.info(f"[Traffic] 会话存储: {settings.SESSION_STORE}")
+        return self._store
+    
+    async def public_count(self) -> int:
+        """当前在线的公开用户数量（不含过期会话）"""
+        settings = get_settings()
+        return await self.store.count("public", time.time(), settings.SESSION_TIMEOUT_SECONDS)
     
     @property
-    def public_count(self) -> int:
-        """当前在线的公开用户数量"""
-        # 先清理过期会话，确保计数准确
-        self.cleanup()
-        return sum(1 for s in self._sessions.values() if s.type == "public")
+    def max_public_users(self) -> int:
+        """当前公共名额上限：开启自适应准入时随上游承载能力变化，否则为 MAX_PUBLIC_USERS"""
+        settings = get_settings()
+        if settings.ADMISSION_ADAPTIVE:
+            return admission_controller.session_limit()
+        return settings.MAX_PUBLIC_USERS
     
-    def try_join(self) -> str:
+    async def try_join(self) -> str:
         """
         尝试加入游戏
         
         Returns:
             token: 会话令牌
-            
+        
         Raises:
             ValueError: 如果公共名额已满
         """
         settings = get_settings()
-        self.cleanup()
-            
-        # 尝试以公开用户身份加入
-        if self.public_count < settings.MAX_PUBLIC_USERS:
-            token = str(uuid.uuid4())
-            self._sessions[token] = SessionData(session_type="public")
-            logger.info(f"[Traffic] 公开用户加入: {token[:8]} (当前在线: {self.public_count}/{settings.MAX_PUBLIC_USERS})")
+        
+        # 尝试以公开用户身份加入（名额检查和加入在存储中原子完成，多个 worker 不会超额）
+        token = str(uuid.uuid4())
+        limit = self.max_public_users
+        if await self.store.try_add(token, SessionData(session_type="public"), limit, settings.SESSION_TIMEOUT_SECONDS):
+            admission_controller.mark_active(token)
+            logger.info(f"[Traffic] 公开用户加入: {token[:8]} (当前在线: {await self.public_count()}/{limit})")
             return token
-            
+        
         # 名额已满
+        admission_controller.mark_saturated()
         raise ValueError("服务器爆满，请稍后重试")
     
-    def verify_session(self, token: str) -> bool:
+    async def admit_queue_head(self) -> TicketData | None:
+        """
+        把一个公共名额分配给排队队首（名额检查、加入和出队在存储中原子完成）
+        
+        Returns:
+            放行的票据（token 为分配的会话令牌）；队伍为空或名额已满时返回 None
+        """
+        settings = get_settings()
+        token = str(uuid.uuid4())
+        ticket = await self.store.admit_head(
+            token, SessionData(session_type="public"), self.max_public_users, settings.SESSION_TIMEOUT_SECONDS
+        )
+        if ticket is not None:
+            admission_controller.mark_active(token)
+            logger.info(f"[Traffic] 排队用户加入: {token[:8]} (票据: {ticket.id[:8]})")
+        elif await self.store.waiting_count():
+            admission_controller.mark_saturated()
+        return ticket
+    
+    async def get_session(self, token: str) -> SessionData | None:
+        """读取会话（不刷新活跃时间）"""
+        return await self.store.get(token) if token else None
+    
+    async def release(self, token: str) -> bool:
+        """释放会话占用的名额（如排队分配的名额无人领取），返回会话是否存在"""
+        released = bool(token) and await self.store.remove(token)
+        if released:
+            logger.info(f"[Traffic] 会话释放: {token[:8]}")
+        return released
+    
+    async def verify_session(self, token: str) -> bool:
         """
         验证会话是否有效，并刷新活跃时间
         """
         if not token:
             return False
-            
-        session = self._sessions.get(token)
-        if not session:
-            return False
-            
-        # 检查是否超时
+        
         settings = get_settings()
-        if time.time() - session.last_active > settings.SESSION_TIMEOUT_SECONDS:
-            logger.info(f"[Traffic] 会话超时移除: {token[:8]}")
-            del self._sessions[token]
+        session = await self.store.touch(token, time.time(), settings.SESSION_TIMEOUT_SECONDS)
+        if session is None:
+            logger.info(f"[Traffic] 会话无效或已超时: {token[:8]}")
             return False
-            
-        # 刷新活跃时间
-        session.last_active = time.time()
         return True
     
-    def cleanup(self):
+    async def cleanup(self):
         """清理过期会话"""
         settings = get_settings()
-        now = time.time()
-        expired_tokens = [
-            token for token, session in self._sessions.items()
-            if now - session.last_active > settings.SESSION_TIMEOUT_SECONDS
-        ]
-        
-        for token in expired_tokens:
-            del self._sessions[token]
-            
-        if expired_tokens:
-            logger.info(f"[Traffic] 清理了 {len(expired_tokens)} 个过期会话")
-
-    def reset(self):
-        """重置所有会话（仅用于测试）"""
-        self._sessions.clear()
+        expired = await self.store.cleanup(time.time(), settings.SESSION_TIMEOUT_SECONDS)
+        if expired:
+            logger.info(f"[Traffic] 清理了 {expired} 个过期会话")
+    
+    async def _reap(self, interval: float) -> None:
+        """后台清理任务"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.cleanup()
+            except Exception as e:
+                logger.error(f"[Traffic] 清理过期会话失败: {e}")
+    
+    def start_reaper(self) -> None:
+        """启动后台清理任务（应用启动时调用）"""
+        if self._reaper is None or self._reaper.done():
+            interval = get_settings().SESSION_REAP_INTERVAL_SECONDS
+            self._reaper = asyncio.get_running_loop().create_task(self._reap(interval))
+    
+    async def stop_reaper(self) -> None:
+        """停止后台清理任务（应用关闭时调用）"""
+        if self._reaper is not None:
+            self._reaper.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._reaper
+            self._reaper = None
+    
+    async def close(self) -> None:
+        """关闭会话存储连接（应用关闭时调用）"""
+        if self._store is not None:
+            await self._store.close()
+            self._store = None
+    
+    async def reset(self):
+        """重置所有会话和排队票据（仅用于测试）"""
+        await self.store.reset()
 
 # 全局单例
 traffic_controller = TrafficController()
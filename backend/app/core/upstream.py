@@ -0,0 +1,203 @@
+"""
+上游路由模块
+为每个模型角色维护端点池，按权重 + 实时延迟/错误评分选择端点，支持熔断与健康导出
+"""
+import hashlib
+import logging
+import math
+import random
+import time
+
+import httpx
+import openai
+
+from app.config import get_settings
+
+logger = logging.getLogger(__name__)
+
+# EWMA 平滑系数
+LATENCY_ALPHA = 0.3
+ERROR_ALPHA = 0.2
+# 任何可用端点保底的权重比例，保证降级端点仍能被探测到恢复
+MIN_WEIGHT_RATIO = 0.01
+
+
+class LLMStallError(TimeoutError):
+    """上游超时未返回 token（首 token 超时或输出中途卡顿）"""
+
+
+def is_retryable_error(error: BaseException) -> bool:
+    """
+    判断错误是否可以换端点重试
+
+    卡顿、连接失败、超时、限流、5xx、鉴权失败等属于端点问题，可以故障转移；
+    400/422 等请求本身的问题换端点也无济于事
+    """
+    if isinstance(error, (LLMStallError, openai.APIConnectionError, httpx.TransportError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code >= 500 or error.status_code in (401, 403, 404, 408, 409, 429)
+    return False
+
+
+class UpstreamEndpoint:
+    """单个上游端点及其健康状态"""
+
+    def __init__(self, role: str, name: str, api_key: str, base_url: str, model: str, weight: float = 1.0):
+        self.role = role
+        self.name = name
+        self.api_key = api_key
+        self.base_url = base_url
+        self.model = model
+        self.weight = max(weight, 0.0)
+
+        # 健康状态
+        self.latency_ewma: float | None = None  # 首包延迟（流式为首 token，JSON 为完整响应）
+        self.error_rate = 0.0
+        self.in_flight = 0
+        self.consecutive_failures = 0
+        self.cooldown_until = 0.0
+        self.total_requests = 0
+        self.total_failures = 0
+        self.last_error: str | None = None
+
+    def is_cooling(self, now: float | None = None) -> bool:
+        """是否处于熔断冷却期"""
+        return (now or time.monotonic()) < self.cooldown_until
+
+    def effective_weight(self, reference_latency: float | None) -> float:
+        """配置权重 × 健康评分（错误率越高、延迟越高，权重越低）"""
+        health = (1 - self.error_rate) ** 2
+        latency_factor = 1.0
+        if reference_latency and self.latency_ewma:
+            latency_factor = reference_latency / self.latency_ewma
+        return max(self.weight * health * latency_factor, self.weight * MIN_WEIGHT_RATIO)
+
+    def begin(self) -> None:
+        self.in_flight += 1
+        self.total_requests += 1
+
+    def end(self) -> None:
+        self.in_flight = max(0, self.in_flight - 1)
+
+    def record_success(self, latency: float) -> None:
+        """记录一次成功（latency 为首包延迟，秒）"""
+        if self.latency_ewma is None:
+            self.latency_ewma = latency
+        else:
+            self.latency_ewma = (1 - LATENCY_ALPHA) * self.latency_ewma + LATENCY_ALPHA * latency
+        self.error_rate = (1 - ERROR_ALPHA) * self.error_rate
+        self.consecutive_failures = 0
+
+    def record_failure(self, error: BaseException | str) -> None:
+        """记录一次失败，连续失败达到阈值后进入冷却"""
+        settings = get_settings()
+        self.error_rate = (1 - ERROR_ALPHA) * self.error_rate + ERROR_ALPHA
+        self.consecutive_failures += 1
+        self.total_failures += 1
+        self.last_error = str(error)[:200]
+        if self.consecutive_failures >= settings.llm_endpoint_failure_threshold:
+            self.cooldown_until = time.monotonic() + settings.llm_endpoint_cooldown_seconds
+            logger.warning(
+                f"[Upstream] 端点熔断: {self.role}/{self.name} "
+                f"(连续失败 {self.consecutive_failures} 次，冷却 {settings.llm_endpoint_cooldown_seconds}s)"
+            )
+
+    def snapshot(self) -> dict:
+        """导出健康状态（不包含 API Key）"""
+        return {
+            "name": self.name,
+            "base_url": self.base_url,
+            "model": self.model,
+            "weight": self.weight,
+            "latency_ms": round(self.latency_ewma * 1000, 1) if self.latency_ewma is not None else None,
+            "error_rate": round(self.error_rate, 4),
+            "in_flight": self.in_flight,
+            "consecutive_failures": self.consecutive_failures,
+            "cooling": self.is_cooling(),
+            "total_requests": self.total_requests,
+            "total_failures": self.total_failures,
+            "last_error": self.last_error,
+        }
+
+
+class EndpointPool:
+    """某个角色的端点池"""
+
+    def __init__(self, role: str, endpoints: list[UpstreamEndpoint]):
+        self.role = role
+        self.endpoints = endpoints
+
+    def __len__(self) -> int:
+        return len(self.endpoints)
+
+    def choose(self, exclude: set[str] | None = None, affinity: str | None = None) -> UpstreamEndpoint:
+        """
+        按有效权重随机选择端点
+
+        优先选择未尝试过且未熔断的端点；都不满足时依次放宽条件。
+        指定 affinity（会话令牌）时按加权最高随机权重哈希固定选择，同一会话落在同一端点上，
+        以命中该端点的提示词前缀缓存。哈希权重同样使用有效权重：端点变慢或错误率升高时，
+        其上的部分会话按比例迁走（熔断或失败时全部换到下一个），健康端点之间的分配保持稳定
+        """
+        exclude = exclude or set()
+        now = time.monotonic()
+        candidates = [e for e in self.endpoints if e.name not in exclude and not e.is_cooling(now)]
+        if not candidates:
+            candidates = [e for e in self.endpoints if e.name not in exclude]
+        if not candidates:
+            candidates = self.endpoints
+        if len(candidates) == 1:
+            return candidates[0]
+
+        latencies = [e.latency_ewma for e in candidates if e.latency_ewma]
+        reference = min(latencies) if latencies else None
+        weights = [e.effective_weight(reference) for e in candidates]
+        if affinity:
+            scores = [self._affinity_score(e, weight, affinity) for e, weight in zip(candidates, weights)]
+            return candidates[scores.index(max(scores))]
+        if sum(weights) <= 0:
+            return random.choice(candidates)
+        return random.choices(candidates, weights=weights, k=1)[0]
+
+    @staticmethod
+    def _affinity_score(endpoint: UpstreamEndpoint, weight: float, affinity: str) -> float:
+        """加权 rendezvous 哈希评分：端点增减或权重变化时只有少量会话需要迁移"""
+        digest = hashlib.blake2b(f"{affinity}|{endpoint.name}".encode(), digest_size=8).digest()
+        unit = (int.from_bytes(digest, "big") + 1) / (2 ** 64 + 1)  # (0, 1)
+        return -weight / math.log(unit) if weight > 0 else 0.0
+
+    def snapshot(self) -> list[dict]:
+        return [e.snapshot() for e in self.endpoints]
+
+
+class UpstreamRouter:
+    """按角色管理端点池（懒加载）"""
+
+    def __init__(self):
+        self._pools: dict[str, EndpointPool] = {}
+
+    def get_pool(self, role: str | None) -> EndpointPool:
+        key = (role or "default").lower()
+        pool = self._pools.get(key)
+        if pool is None:
+            settings = get_settings()
+            endpoints = [
+                UpstreamEndpoint(role=key, **config)
+                for config in settings.get_model_endpoints(role)
+            ]
+            pool = EndpointPool(key, endpoints)
+            self._pools[key] = pool
+        return pool
+
+    def snapshot(self) -> dict[str, list[dict]]:
+        """导出所有已使用角色的端点健康状态"""
+        return {role: pool.snapshot() for role, pool in self._pools.items()}
+
+    def reset(self):
+        """清空端点池（仅用于测试）"""
+        self._pools.clear()
+
+
+# 全局单例
+upstream_router = UpstreamRouter()
@@ -0,0 +1,146 @@
+"""
+Token 用量统计模块
+按角色、上游端点、会话聚合 prompt/completion/缓存命中 token，并记录各提示词构建器的提示词体积
+"""
+import unicodedata
+from collections import OrderedDict
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("cl100k_base")
+except Exception:  # 未安装 tiktoken 或编码文件不可用时使用估算
+    _encoding = None
+
+# 最多保留的会话统计条数（LRU 淘汰）
+MAX_SESSIONS = 10000
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    估算文本的 token 数
+
+    安装了 tiktoken 时使用 cl100k_base 编码精确计算；
+    否则按经验值估算：中日韩字符约 1 token/字，其他字符约 4 字符/token
+    """
+    if not text:
+        return 0
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+    wide = sum(1 for ch in text if unicodedata.east_asian_width(ch) in ("W", "F"))
+    return wide + (len(text) - wide + 3) // 4
+
+
+class UsageTotals:
+    """用量累计"""
+
+    def __init__(self):
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cached_tokens = 0
+        self.estimated_calls = 0  # 上游未返回 usage、使用本地估算的调用次数
+
+    def add(self, prompt_tokens: int, completion_tokens: int, cached_tokens: int, estimated: bool) -> None:
+        self.calls += 1
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
+        self.cached_tokens += cached_tokens
+        if estimated:
+            self.estimated_calls += 1
+
+    def as_dict(self) -> dict:
+        return {
+            "calls": self.calls,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "total_tokens": self.prompt_tokens + self.completion_tokens,
+            "cached_tokens": self.cached_tokens,
+            "cached_ratio": round(self.cached_tokens / self.prompt_tokens, 4) if self.prompt_tokens else None,
+            "estimated_calls": self.estimated_calls,
+        }
+
+
+class PromptStats:
+    """提示词体积统计"""
+
+    def __init__(self):
+        self.calls = 0
+        self.system_chars = 0
+        self.user_chars = 0
+        self.max_user_chars = 0
+
+    def add(self, system_prompt: str, user_prompt: str) -> None:
+        self.calls += 1
+        self.system_chars += len(system_prompt)
+        self.user_chars += len(user_prompt)
+        self.max_user_chars = max(self.max_user_chars, len(user_prompt))
+
+    def as_dict(self) -> dict:
+        return {
+            "calls": self.calls,
+            "avg_system_chars": self.system_chars // self.calls if self.calls else 0,
+            "avg_user_chars": self.user_chars // self.calls if self.calls else 0,
+            "max_user_chars": self.max_user_chars,
+        }
+
+
+class UsageTracker:
+    """用量统计（进程内）"""
+
+    def __init__(self):
+        self._by_role: dict[str, UsageTotals] = {}
+        self._by_endpoint: dict[str, UsageTotals] = {}
+        self._by_session: OrderedDict[str, UsageTotals] = OrderedDict()
+        self._prompts: dict[str, PromptStats] = {}
+
+    def record(
+        self,
+        role: str,
+        endpoint: str,
+        session: str | None,
+        prompt_tokens: int,
+        completion_tokens: int,
+        cached_tokens: int = 0,
+        estimated: bool = False,
+    ) -> None:
+        """记录一次调用的用量"""
+        self._by_role.setdefault(role, UsageTotals()).add(prompt_tokens, completion_tokens, cached_tokens, estimated)
+        self._by_endpoint.setdefault(f"{role}/{endpoint}", UsageTotals()).add(
+            prompt_tokens, completion_tokens, cached_tokens, estimated
+        )
+        if session:
+            totals = self._by_session.get(session)
+            if totals is None:
+                totals = self._by_session[session] = UsageTotals()
+                while len(self._by_session) > MAX_SESSIONS:
+                    self._by_session.popitem(last=False)
+            else:
+                self._by_session.move_to_end(session)
+            totals.add(prompt_tokens, completion_tokens, cached_tokens, estimated)
+
+    def record_prompt(self, label: str, system_prompt: str, user_prompt: str) -> None:
+        """记录提示词体积（label 区分提示词构建器，如 game/narrate）"""
+        self._prompts.setdefault(label, PromptStats()).add(system_prompt, user_prompt)
+
+    def session(self, session: str) -> dict | None:
+        totals = self._by_session.get(session)
+        return totals.as_dict() if totals else None
+
+    def snapshot(self) -> dict:
+        return {
+            "by_role": {k: v.as_dict() for k, v in self._by_role.items()},
+            "by_endpoint": {k: v.as_dict() for k, v in self._by_endpoint.items()},
+            "prompts": {k: v.as_dict() for k, v in self._prompts.items()},
+            "sessions": len(self._by_session),
+        }
+
+    def reset(self):
+        """清空统计（仅用于测试）"""
+        self._by_role.clear()
+        self._by_endpoint.clear()
+        self._by_session.clear()
+        self._prompts.clear()
+
+
+# 全局单例
+usage_tracker = UsageTracker()
@@ -0,0 +1,183 @@
+"""
+排队等候模块
+公共名额已满时，加入请求领取一张排队票据（FIFO）。客户端通过 SSE 或长轮询获取排队位置和预计等待时间；
+名额空出时由后台任务直接分配给队首票据（发放会话令牌），不需要客户端反复轮询抢占。
+长时间没有连接/轮询的票据会过期；已分配但无人领取的名额会被收回并分配给下一位
+
+票据和队伍顺序放在会话存储中（见 session_store），多个 worker 共享同一个队伍：放行队首和收回名额在存储内原子完成，
+每个 worker 的后台任务都可以执行。本进程的变化立即唤醒等待中的连接，其他 worker 的变化在
+ADMIT_INTERVAL_SECONDS 内通过重读存储发现。预计等待时间按本进程观察到的放行间隔估算
+"""
+import asyncio
+import contextlib
+import logging
+import time
+import uuid
+
+from app.config import get_settings
+from app.core.metrics import metrics
+from app.core.session_store import TicketData
+from app.core.traffic_control import traffic_controller
+
+logger = logging.getLogger(__name__)
+
+# 后台检查空闲名额和过期票据的间隔（秒），也是等待连接重读存储的最长间隔
+ADMIT_INTERVAL_SECONDS = 1.0
+
+# 预计等待时间的平滑系数（相邻两次放行间隔的指数加权平均）
+ETA_ALPHA = 0.2
+
+
+class WaitingRoom:
+    """FIFO 排队（数据在会话存储中）"""
+
+    def __init__(self):
+        self._changed = asyncio.Event()
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._last_admit_at: float | None = None
+        self._admit_interval: float | None = None  # 放行间隔的平滑值，用于估算等待时间
+
+    @property
+    def store(self):
+        return traffic_controller.store
+
+    async def waiting(self) -> int:
+        """排队人数"""
+        return await self.store.waiting_count()
+
+    async def enqueue(self) -> TicketData:
+        """
+        领取排队票据
+
+        Raises:
+            ValueError: 队伍已满
+        """
+        settings = get_settings()
+        ticket = await self.store.enqueue_ticket(uuid.uuid4().hex, time.time(), settings.WAITING_ROOM_MAX_SIZE)
+        if ticket is None:
+            raise ValueError("排队人数过多，请稍后重试")
+        metrics.incr("waiting_room_total", outcome="enqueued")
+        logger.info(f"[WaitingRoom] 入队: {ticket.id[:8]} (入队序号: {ticket.seq})")
+        self._wakeup.set()
+        return ticket
+
+    async def get(self, ticket_id: str) -> TicketData | None:
+        return await self.store.get_ticket(ticket_id)
+
+    async def touch(self, ticket_id: str) -> TicketData | None:
+        """刷新票据的最后活跃时间（SSE 连接中或轮询时调用）"""
+        return await self.store.touch_ticket(ticket_id, time.time())
+
+    async def claim(self, ticket_id: str) -> TicketData | None:
+        """客户端取走令牌（票据已放行时），返回票据的最新状态"""
+        ticket, claimed = await self.store.claim_ticket(ticket_id)
+        if claimed:
+            metrics.observe("waiting_room_wait_seconds", ticket.admitted_at - ticket.created_at)
+        return ticket
+
+    async def leave(self, ticket_id: str) -> bool:
+        """主动离开队伍"""
+        if not await self.store.leave_ticket(ticket_id):
+            return False
+        metrics.incr("waiting_room_total", outcome="left")
+        self._notify()
+        return True
+
+    async def position(self, ticket: TicketData) -> int:
+        """排队位置（从 1 开始），不在队伍中时返回 0"""
+        return await self.store.ticket_position(ticket)
+
+    def eta_seconds(self, position: int) -> float | None:
+        """按近期放行间隔估算的等待时间，样本不足时返回 None"""
+        if self._admit_interval is None or position <= 0:
+            return None
+        return round(position * self._admit_interval, 1)
+
+    async def status(self, ticket: TicketData) -> dict:
+        """票据当前状态（SSE 事件和长轮询响应共用）"""
+        data = {"status": ticket.status}
+        if ticket.status == "waiting":
+            position = await self.position(ticket)
+            data.update(position=position, eta_seconds=self.eta_seconds(position))
+        elif ticket.status == "admitted":
+            data.update(token=ticket.token, session_type="public")
+        return data
+
+    async def wait_change(self, timeout: float) -> None:
+        """等待本进程内队伍发生变化（放行、过期、离开），最多等待 ADMIT_INTERVAL_SECONDS 后返回重读存储"""
+        changed = self._changed
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(changed.wait(), min(timeout, ADMIT_INTERVAL_SECONDS))
+
+    def _notify(self) -> None:
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def admit(self) -> int:
+        """把空出的名额依次分配给队首票据，返回放行人数"""
+        admitted = 0
+        while True:
+            ticket = await traffic_controller.admit_queue_head()
+            if ticket is None:
+                break
+            admitted += 1
+            metrics.incr("waiting_room_total", outcome="admitted")
+            if self._last_admit_at is not None:
+                interval = ticket.admitted_at - self._last_admit_at
+                self._admit_interval = interval if self._admit_interval is None else (
+                    ETA_ALPHA * interval + (1 - ETA_ALPHA) * self._admit_interval
+                )
+            self._last_admit_at = ticket.admitted_at
+            logger.info(f"[WaitingRoom] 放行: {ticket.id[:8]}")
+        return admitted
+
+    async def expire(self) -> int:
+        """
+        过期处理：超过 TTL 未连接/轮询的排队票据出队；已分配但未领取的名额收回；
+        已结束的票据保留一个 TTL 供客户端查询结果后删除
+        """
+        ttl = get_settings().WAITING_ROOM_TICKET_TTL_SECONDS
+        expired, reclaimed = await self.store.expire_tickets(time.time(), ttl)
+        if expired:
+            metrics.incr("waiting_room_total", expired, outcome="expired")
+        if reclaimed:
+            metrics.incr("waiting_room_total", reclaimed, outcome="unclaimed")
+        if expired or reclaimed:
+            logger.info(f"[WaitingRoom] {expired} 张排队票据过期，收回 {reclaimed} 个无人领取的名额")
+        return expired + reclaimed
+
+    async def _run(self) -> None:
+        """后台任务：定期（或有人入队时）回收过期票据并分配空出的名额"""
+        while True:
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wakeup.wait(), ADMIT_INTERVAL_SECONDS)
+            self._wakeup.clear()
+            try:
+                if await self.expire() + await self.admit():
+                    self._notify()
+            except Exception as e:
+                logger.error(f"[WaitingRoom] 放行失败: {e}")
+
+    def start(self) -> None:
+        """启动后台放行任务（应用启动时调用）"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        """停止后台放行任务（应用关闭时调用）"""
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+    async def stats(self) -> dict:
+        return {
+            "waiting": await self.waiting(),
+            "admit_interval_seconds": round(self._admit_interval, 2) if self._admit_interval else None,
+        }
+
+
+# 全局单例
+waiting_room = WaitingRoom()
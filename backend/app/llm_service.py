@@ -5,12 +5,44 @@ LLM 服务模块 - 封装 OpenAI API 调用
 1. chat_stream(): 流式输出，用于叙事内容，保持AI创造力
 2. chat_json(): JSON模式输出，用于状态更新，确保结构正确
 """
+import importlib.util
 import json
 from datetime import datetime
 from pathlib import Path
 from typing import AsyncGenerator
+
+import asyncio
+import logging
+import random
+import time
+
+import httpx
 from openai import AsyncOpenAI
 from app.config import get_settings
+from app.core.admission import admission_controller
+from app.core.log_writer import SegmentWriter
+from app.core.metrics import metrics
+from app.core.stream_parser import parse_json_content
+from app.core.streaming import CANCEL_CLIENT_GONE, cancel_reason
+from app.core.usage import estimate_tokens, usage_tracker
+from app.core.upstream import (
+    EndpointPool,
+    LLMStallError,
+    UpstreamEndpoint,
+    is_retryable_error,
+    upstream_router,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class StreamState:
+    """单次流式调用的状态：上游返回的 usage、结束原因和已输出内容"""
+    
+    def __init__(self):
+        self.usage = None
+        self.finish_reason: str | None = None
+        self.output_parts: list[str] = []
 
 
 class LLMService:
@@ -20,67 +52,99 @@ class LLMService:
         self.settings = get_settings()
         # 默认使用通用配置
         self.default_model = self.settings.openai_model
+        # 客户端注册表：按 (api_key, base_url) 复用，避免每次调用重新握手
+        self._clients: dict[tuple[str, str], AsyncOpenAI] = {}
+        self._http_client: httpx.AsyncClient | None = None
+        # 请求上下文转储（非生产环境），后台批量写入压缩分段文件
+        self._context_writer = SegmentWriter(
+            name="llm_context",
+            directory=Path("logs/llm_context"),
+            prefix="context",
+            max_queue=self.settings.llm_context_queue_size,
+            max_segment_bytes=self.settings.llm_context_segment_mb * 1024 * 1024,
+            retain_segments=self.settings.llm_context_retain_segments
+        )
     
-    def _get_client(self, role: str | None = None) -> tuple[AsyncOpenAI, str]:
+    def _get_http_client(self) -> httpx.AsyncClient:
         """
-        创建客户端并返回对应的模型名称
+        获取共享的 httpx 连接池（懒加载）
         
-        Args:
-            role: 角色名称（narrator/judge/ending），如果为None则使用通用配置
-            
-        Returns:
-            (client, model) 二元组
-        """
-        if role:
-            api_key, base_url, model = self.settings.get_model_config(role)
-        else:
-            api_key = self.settings.openai_api_key
-            base_url = self.settings.openai_base_url
-            model = self.default_model
-        
-        client = AsyncOpenAI(
-            api_key=api_key,
-            base_url=base_url
-        )
-        return client, model
+        所有上游客户端共用同一个连接池，开启 keep-alive；
+        安装了 h2 时使用 HTTP/2 多路复用
+        """
+        if self._http_client is None or self._http_client.is_closed:
+            settings = self.settings
+            http2 = settings.llm_http2 and importlib.util.find_spec("h2") is not None
+            self._http_client = httpx.AsyncClient(
+                http2=http2,
+                limits=httpx.Limits(
+                    max_connections=settings.llm_max_connections,
+                    max_keepalive_connections=settings.llm_max_keepalive_connections,
+                    keepalive_expiry=settings.llm_keepalive_expiry,
+                ),
+                timeout=httpx.Timeout(
+                    settings.llm_request_timeout,
+                    connect=settings.llm_connect_timeout,
+                ),
+                follow_redirects=True,
+            )
+        return self._http_client
+    
+    def _get_client(self, endpoint: UpstreamEndpoint) -> AsyncOpenAI:
+        """
+        获取（或创建）端点对应的客户端
+        
+        客户端按 (api_key, base_url) 复用；重试与故障转移由本服务统一处理，
+        因此关闭 SDK 自带的重试
+        """
+        key = (endpoint.api_key, endpoint.base_url)
+        client = self._clients.get(key)
+        if client is None:
+            client = AsyncOpenAI(
+                api_key=endpoint.api_key,
+                base_url=endpoint.base_url,
+                http_client=self._get_http_client(),
+                max_retries=0
+            )
+            self._clients[key] = client
+        return client
+    
+    async def aclose(self) -> None:
+        """关闭共享连接池（应用关闭时调用）"""
+        self._clients.clear()
+        if self._http_client is not None and not self._http_client.is_closed:
+            await self._http_client.aclose()
+        self._http_client = None
 
     def _save_context(self, role: str | None, system_prompt: str, user_prompt: str) -> None:
         """
-        在开发环境下保存请求上下文到文件
+        在开发环境下保存请求上下文（按采样率入队，由后台任务写盘，不阻塞请求）
+        
+        每行一个 JSON：{"timestamp", "role", "system_prompt", "user_prompt"}
         """
         if self.settings.is_production():
             return
-
-        try:
-            # 确保日志目录存在
-            log_dir = Path("logs/llm_context")
-            log_dir.mkdir(parents=True, exist_ok=True)
-
-            # 生成文件名: YYYYMMDD_HHMMSS_role.txt
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
-            role_name = role or "default"
-            filename = f"{timestamp}_{role_name}.txt"
-            file_path = log_dir / filename
-
-            # 写入内容
-            with open(file_path, "w", encoding="utf-8") as f:
-                f.write(f"=== Role: {role_name} ===\n")
-                f.write(f"=== Timestamp: {datetime.now().isoformat()} ===\n\n")
-                f.write("--- SYSTEM PROMPT ---\n")
-                f.write(system_prompt)
-                f.write("\n\n--- USER PROMPT ---\n")
-                f.write(user_prompt)
-                f.write("\n")
-        except Exception as e:
-            # 记录错误但不中断请求
-            print(f"[LLMService] 保存上下文失败: {e}")
+        if random.random() >= self.settings.llm_context_sample_rate:
+            return
+        
+        record = {
+            "timestamp": datetime.now().isoformat(),
+            "role": role or "default",
+            "system_prompt": system_prompt,
+            "user_prompt": user_prompt
+        }
+        self._context_writer.submit(json.dumps(record, ensure_ascii=False))
     
     async def chat_stream(
         self,
         system_prompt: str,
         user_prompt: str,
         temperature: float = 1.0,
-        role: str | None = None
+        role: str | None = None,
+        session: str | None = None,
+        label: str | None = None,
+        stop: list[str] | None = None,
+        extra_messages: list[dict] | None = None
     ) -> AsyncGenerator[str, None]:
         """
         流式输出，用于叙事内容
@@ -90,32 +154,222 @@ class LLMService:
             user_prompt: 用户提示词，包含上下文
             temperature: 创意度，0-2
             role: 角色名称（narrator/judge/ending），用于选择对应的模型配置
+            session: 会话令牌，用于按会话统计 token 用量
+            label: 调用来源（如 game/narrate），用于统计提示词体积
+            stop: 结构化停止序列（如 "</state_update>"），上游在此停止生成；
+                因停止序列结束时会补回被上游吞掉的闭合标签，调用方看到的输出保持完整
+            extra_messages: 追加在用户提示词之后的消息（如续写时的已输出内容和续写指令）
             
         Yields:
             逐块返回的文本内容
         """
         self._save_context(role, system_prompt, user_prompt)
-        client, model = self._get_client(role)
-        stream = await client.chat.completions.create(
-            model=model,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ],
-            temperature=temperature,
-            stream=True
-        )
+        pool = upstream_router.get_pool(role)
+        usage_tracker.record_prompt(label or pool.role, system_prompt, user_prompt)
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
+        ]
+        if extra_messages:
+            messages.extend(extra_messages)
         
-        async for chunk in stream:
-            if chunk.choices and chunk.choices[0].delta.content:
-                yield chunk.choices[0].delta.content
+        ttft_timeout = self.settings.get_role_option(role, "ttft_timeout") or None
+        stall_timeout = self.settings.get_role_option(role, "stall_timeout") or None
+        affinity = session if self.settings.llm_session_affinity else None
+        extra_args = self._output_limits(role, stop)
+        if self.settings.llm_stream_usage:
+            extra_args["stream_options"] = {"include_usage": True}
+        
+        tried: set[str] = set()
+        last_error: BaseException | None = None
+        for attempt in range(max(1, self.settings.llm_failover_attempts)):
+            endpoint = pool.choose(exclude=tried, affinity=affinity)
+            if endpoint.name in tried:
+                await self._backoff(attempt)
+            tried.add(endpoint.name)
+            
+            client = self._get_client(endpoint)
+            started = time.monotonic()
+            endpoint.begin()
+            admission_controller.begin(pool.role, session)
+            stream = None
+            state = StreamState()
+            try:
+                stream = await asyncio.wait_for(
+                    client.chat.completions.create(
+                        model=endpoint.model,
+                        messages=messages,
+                        temperature=temperature,
+                        stream=True,
+                        **extra_args
+                    ),
+                    ttft_timeout
+                )
+                # 首 token 之前的失败（含超时）可以透明地换端点重试
+                remaining = ttft_timeout - (time.monotonic() - started) if ttft_timeout else None
+                first_chunk = await asyncio.wait_for(self._next_content(stream, state), remaining)
+            except BaseException as e:
+                if isinstance(e, asyncio.TimeoutError):
+                    metrics.incr("llm_stall_total", role=pool.role, endpoint=endpoint.name, phase="ttft")
+                    e = LLMStallError(f"首 token 超时（{ttft_timeout}s）")
+                endpoint.end()
+                admission_controller.end(pool.role, session)
+                if stream is not None:
+                    await stream.close()
+                if not isinstance(e, Exception) or not is_retryable_error(e):
+                    raise
+                endpoint.record_failure(e)
+                admission_controller.record_error(pool.role, e)
+                last_error = e
+                logger.warning(f"[LLMService] {pool.role}/{endpoint.name} 首 token 前失败，尝试故障转移: {e}")
+                continue
+            
+            ttft = time.monotonic() - started
+            endpoint.record_success(ttft)
+            admission_controller.record_ttft(pool.role, ttft)
+            metrics.observe("llm_ttft_seconds", ttft, role=pool.role)
+            try:
+                if first_chunk is None:
+                    return
+                state.output_parts.append(first_chunk)
+                yield first_chunk
+                while True:
+                    try:
+                        content = await asyncio.wait_for(self._next_content(stream, state), stall_timeout)
+                    except asyncio.TimeoutError:
+                        # 已有内容转发给客户端，无法透明重启，交由调用方处理
+                        metrics.incr("llm_stall_total", role=pool.role, endpoint=endpoint.name, phase="gap")
+                        endpoint.record_failure("输出中途卡顿")
+                        raise LLMStallError(f"上游输出中断超过 {stall_timeout}s")
+                    if content is None:
+                        break
+                    state.output_parts.append(content)
+                    yield content
+                if state.finish_reason == "length":
+                    metrics.incr("llm_truncated_total", role=pool.role)
+                    logger.warning(f"[LLMService] {pool.role} 输出达到 max_tokens 上限被截断")
+                elif state.finish_reason == "stop" and "stop" in extra_args:
+                    suffix = self._restore_stop_tag("".join(state.output_parts), extra_args["stop"])
+                    if suffix:
+                        yield suffix
+            except asyncio.CancelledError as e:
+                reason = cancel_reason(e)
+                if reason == CANCEL_CLIENT_GONE:
+                    # 客户端断开后调用方取消了生成：已生成的 token 照常计费但没有读者
+                    abandoned = estimate_tokens("".join(state.output_parts))
+                    metrics.incr("llm_aborted_total", role=pool.role)
+                    metrics.incr("llm_abandoned_tokens_total", abandoned, role=pool.role)
+                    logger.info(f"[LLMService] {pool.role} 生成被取消，约 {abandoned} 个 token 作废")
+                else:
+                    # 审核未通过、提前关闭或服务关闭等，不计入客户端断开造成的浪费
+                    metrics.incr("llm_cancelled_total", role=pool.role, reason=reason or "other")
+                raise
+            finally:
+                endpoint.end()
+                admission_controller.end(pool.role, session)
+                await stream.close()
+                self._record_usage(
+                    pool.role, endpoint.name, session, messages, state.usage, state.output_parts,
+                    latency=ttft, mode="stream"
+                )
+            return
+        
+        raise last_error
+    
+    def _output_limits(self, role: str | None, stop: list[str] | None) -> dict:
+        """按角色配置的 max_tokens 和结构化停止序列"""
+        args = {}
+        max_tokens = self.settings.get_role_option(role, "max_tokens")
+        if max_tokens:
+            args["max_tokens"] = max_tokens
+        if stop and self.settings.llm_stop_sequences:
+            args["stop"] = stop
+        return args
+    
+    @staticmethod
+    def _restore_stop_tag(text: str, stop: list[str]) -> str:
+        """
+        上游命中停止序列时不会输出停止序列本身；
+        如果停止序列是闭合标签且对应的开始标签尚未闭合，返回需要补回的闭合标签
+        """
+        lowered = text.lower()
+        for sequence in stop:
+            if not (sequence.startswith("</") and sequence.endswith(">")):
+                continue
+            opening = "<" + sequence[2:]
+            if lowered.rfind(opening.lower()) > lowered.rfind(sequence.lower()):
+                return sequence
+        return ""
+    
+    async def _next_content(self, stream, state: StreamState) -> str | None:
+        """读取下一个非空文本块，流结束时返回 None（顺带记录 usage 和结束原因）"""
+        while True:
+            try:
+                chunk = await stream.__anext__()
+            except StopAsyncIteration:
+                return None
+            if getattr(chunk, "usage", None):
+                state.usage = chunk.usage
+            if not chunk.choices:
+                continue
+            if chunk.choices[0].finish_reason:
+                state.finish_reason = chunk.choices[0].finish_reason
+            if chunk.choices[0].delta.content:
+                return chunk.choices[0].delta.content
+    
+    def _record_usage(
+        self,
+        role: str,
+        endpoint: str,
+        session: str | None,
+        messages: list[dict],
+        usage,
+        output_parts: list[str],
+        latency: float | None = None,
+        mode: str = "stream"
+    ) -> None:
+        """
+        记录 token 用量；上游未返回 usage（或流被提前关闭）时使用本地估算
+        
+        上游返回缓存命中数时，按是否命中前缀缓存分组记录延迟（流式为首 token，JSON 为完整响应），
+        用于确认前缀缓存是否真的降低了延迟
+        """
+        if usage is not None and usage.prompt_tokens is not None:
+            details = getattr(usage, "prompt_tokens_details", None)
+            cached = getattr(details, "cached_tokens", None) if details else None
+            if cached is None:
+                # 部分兼容服务（如 DeepSeek）使用 prompt_cache_hit_tokens 字段
+                cached = getattr(usage, "prompt_cache_hit_tokens", None)
+            usage_tracker.record(
+                role, endpoint, session,
+                prompt_tokens=usage.prompt_tokens,
+                completion_tokens=usage.completion_tokens or 0,
+                cached_tokens=cached or 0
+            )
+            if latency is not None and usage.prompt_tokens:
+                cache = "hit" if (cached or 0) * 2 >= usage.prompt_tokens else "miss"
+                metrics.observe("llm_latency_by_cache_seconds", latency, role=role, mode=mode, cache=cache)
+            return
+        usage_tracker.record(
+            role, endpoint, session,
+            prompt_tokens=sum(estimate_tokens(m["content"]) for m in messages),
+            completion_tokens=estimate_tokens("".join(output_parts)),
+            estimated=True
+        )
+    
+    async def _backoff(self, attempt: int) -> None:
+        """再次尝试同一个端点前做短暂的指数退避"""
+        await asyncio.sleep(min(0.25 * (2 ** (attempt - 1)), 2.0))
     
     async def chat_json(
         self,
         system_prompt: str,
         user_prompt: str,
         temperature: float = 0.7,
-        role: str | None = None
+        role: str | None = None,
+        hedge: bool = False,
+        session: str | None = None,
+        label: str | None = None
     ) -> dict:
         """
         JSON模式输出，用于状态更新
@@ -125,6 +379,9 @@ class LLMService:
             user_prompt: 用户提示词，包含上下文
             temperature: 创意度，0-2
             role: 角色名称（narrator/judge/ending），用于选择对应的模型配置
+            hedge: 是否允许对冲请求（需同时开启 LLM_HEDGE_ENABLED）
+            session: 会话令牌，用于按会话统计 token 用量
+            label: 调用来源（如 game/ending），用于统计提示词体积
             
         Returns:
             解析后的JSON字典
@@ -133,16 +390,74 @@ class LLMService:
             ValueError: 当LLM返回空内容或无效JSON时
         """
         self._save_context(role, system_prompt, user_prompt)
-        client, model = self._get_client(role)
-        response = await client.chat.completions.create(
-            model=model,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ],
-            temperature=temperature,
-            response_format={"type": "json_object"}
-        )
+        pool = upstream_router.get_pool(role)
+        usage_tracker.record_prompt(label or pool.role, system_prompt, user_prompt)
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
+        ]
+        
+        if hedge and self.settings.llm_hedge_enabled:
+            return await self._chat_json_hedged(pool, messages, temperature, session)
+        return await self._chat_json_attempt(pool, messages, temperature, set(), session)
+    
+    async def _chat_json_attempt(
+        self,
+        pool: EndpointPool,
+        messages: list[dict],
+        temperature: float,
+        tried: set[str],
+        session: str | None = None
+    ) -> dict:
+        """
+        执行一次（带故障转移的）JSON 请求并解析结果
+        
+        tried 记录已使用的端点，对冲请求之间共享以便优先选择其他端点
+        """
+        last_error: BaseException | None = None
+        response = None
+        affinity = session if self.settings.llm_session_affinity else None
+        for attempt in range(max(1, self.settings.llm_failover_attempts)):
+            endpoint = pool.choose(exclude=tried, affinity=affinity)
+            if endpoint.name in tried:
+                await self._backoff(attempt)
+            tried.add(endpoint.name)
+            
+            client = self._get_client(endpoint)
+            started = time.monotonic()
+            endpoint.begin()
+            admission_controller.begin(pool.role, session)
+            try:
+                response = await client.chat.completions.create(
+                    model=endpoint.model,
+                    messages=messages,
+                    temperature=temperature,
+                    response_format={"type": "json_object"},
+                    **self._output_limits(pool.role, None)
+                )
+            except Exception as e:
+                if not is_retryable_error(e):
+                    raise
+                endpoint.record_failure(e)
+                admission_controller.record_error(pool.role, e)
+                last_error = e
+                logger.warning(f"[LLMService] {pool.role}/{endpoint.name} 请求失败，尝试故障转移: {e}")
+                continue
+            finally:
+                endpoint.end()
+                admission_controller.end(pool.role, session)
+            latency = time.monotonic() - started
+            endpoint.record_success(latency)
+            metrics.observe("llm_json_latency_seconds", latency, role=pool.role)
+            output = [c.message.content or "" for c in response.choices]
+            self._record_usage(
+                pool.role, endpoint.name, session, messages, response.usage, output,
+                latency=latency, mode="json"
+            )
+            break
+        
+        if response is None:
+            raise last_error
         
         # 检查响应是否有效
         if not response.choices:
@@ -165,61 +480,81 @@ class LLMService:
             # 记录原始内容便于调试
             raise ValueError(f"JSON解析失败: {e}\n原始内容: {content[:500]}")
     
+    def _hedge_delay(self, role: str) -> float:
+        """对冲延迟：该角色近期 JSON 延迟的指定分位数（样本不足时使用默认值）"""
+        settings = self.settings
+        delay = metrics.percentile(
+            "llm_json_latency_seconds",
+            settings.llm_hedge_percentile,
+            min_samples=settings.llm_hedge_min_samples,
+            role=role
+        )
+        if delay is None:
+            delay = settings.llm_hedge_default_delay
+        return min(max(delay, settings.llm_hedge_min_delay), settings.llm_hedge_max_delay)
+    
+    async def _chat_json_hedged(
+        self,
+        pool: EndpointPool,
+        messages: list[dict],
+        temperature: float,
+        session: str | None = None
+    ) -> dict:
+        """
+        对冲请求：首个请求超过分位延迟仍未返回时，再发一个副本（优先发往其他端点）
+        
+        先得到合法 JSON 的一方胜出，另一方被取消
+        """
+        metrics.incr("llm_hedge_eligible_total", role=pool.role)
+        tried: set[str] = set()
+        primary = asyncio.create_task(self._chat_json_attempt(pool, messages, temperature, tried, session))
+        done, _ = await asyncio.wait({primary}, timeout=self._hedge_delay(pool.role))
+        if done:
+            return primary.result()
+        
+        metrics.incr("llm_hedge_fired_total", role=pool.role)
+        backup = asyncio.create_task(self._chat_json_attempt(pool, messages, temperature, tried, session))
+        pending = {primary, backup}
+        errors: list[BaseException] = []
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        winner = "hedge" if task is backup else "primary"
+                        metrics.incr("llm_hedge_wins_total", role=pool.role, winner=winner)
+                        return task.result()
+                    errors.append(task.exception())
+            raise errors[0]
+        finally:
+            for task in pending:
+                task.cancel()
+    
     def _parse_json_content(self, content: str) -> dict:
         """
         清理并解析JSON内容
-        处理常见的LLM输出问题：前导逗号、代码块标记等
-        """
-        text = content.strip()
-        
-        # 移除可能的 markdown 代码块标记
-        if text.startswith("```json"):
-            text = text[7:]
-        if text.startswith("```"):
-            text = text[3:]
-        if text.endswith("```"):
-            text = text[:-3]
-        text = text.strip()
-        
-        # 移除前导逗号（某些模型的常见问题）
-        if text.startswith(","):
-            text = text[1:].strip()
-        
-        # 尝试找到JSON对象的起始位置
-        start_idx = text.find("{")
-        if start_idx > 0:
-            text = text[start_idx:]
-        
-        # 尝试找到JSON对象的结束位置（处理尾部多余内容）
-        # 使用简单的括号匹配
-        brace_count = 0
-        end_idx = -1
-        for i, char in enumerate(text):
-            if char == "{":
-                brace_count += 1
-            elif char == "}":
-                brace_count -= 1
-                if brace_count == 0:
-                    end_idx = i + 1
-                    break
-        
-        if end_idx > 0:
-            text = text[:end_idx]
-        
-        return json.loads(text)
+        处理常见的LLM输出问题：前导逗号、代码块标记等（规则见 parse_json_content）
+        """
+        return parse_json_content(content)
     
     # 保留旧方法名作为别名，兼容现有代码
     async def chat(
         self,
         system_prompt: str,
         user_prompt: str,
-        temperature: float = 1.0
+        temperature: float = 1.0,
+        hedge: bool = False,
+        session: str | None = None,
+        label: str | None = None
     ) -> dict:
         """
         [已废弃] 请使用 chat_json() 代替
         保留此方法以兼容现有代码
         """
-        return await self.chat_json(system_prompt, user_prompt, temperature)
+        return await self.chat_json(
+            system_prompt, user_prompt, temperature,
+            hedge=hedge, session=session, label=label
+        )
 
 
 # 全局单例
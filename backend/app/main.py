@@ -1,18 +1,44 @@
 """
 末世模拟器后端 - FastAPI 主应用入口
 """
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI, HTTPException, status
 from fastapi.middleware.cors import CORSMiddleware
 
+from app.config import get_settings
 from app.routers import game, archive, ice_age, system
+from app.core.deployment import check_deployment
 from app.core.traffic_control import traffic_controller
-from app.config import get_settings
+from app.core.waiting_room import waiting_room
+from app.core.log_writer import close_all_writers
+from app.core.sse_replay import replay_registry
+from app.llm_service import get_llm_service
+from app.moderator_service import get_moderator_service
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """应用生命周期：启动时检查部署方式、加载审核词表并启动会话回收任务，关闭时停止后台任务、释放上游连接池并写完剩余日志"""
+    check_deployment(get_settings())
+    get_moderator_service()
+    traffic_controller.start_reaper()
+    waiting_room.start()
+    yield
+    await waiting_room.stop()
+    await traffic_controller.stop_reaper()
+    await traffic_controller.close()
+    await replay_registry.aclose()
+    await get_llm_service().aclose()
+    await close_all_writers()
+
 
 # 创建应用实例
 app = FastAPI(
     title="末世模拟器 API",
     description="丧尸围城篇 - AI驱动的文字生存游戏后端",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # 配置CORS（允许前端跨域访问）
@@ -45,10 +71,9 @@ async def root():
 async def health_check():
     """
     健康检查
-    如果服务器已满，返回 503 状态码
+    如果服务器已满（或有人排队），返回 503 状态码
     """
-    settings = get_settings()
-    if traffic_controller.public_count >= settings.MAX_PUBLIC_USERS:
+    if await traffic_controller.public_count() >= traffic_controller.max_public_users or await waiting_room.waiting():
         raise HTTPException(
             status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
             detail="Server Full"
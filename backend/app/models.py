@@ -3,7 +3,7 @@
 """
 from enum import Enum
 from typing import Optional
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
 
 
 # ==================== 通用模型 ====================
@@ -121,6 +121,8 @@ class StreamEventType(str, Enum):
     CONTENT = "content"      # 叙事文本片段
     CRISIS = "crisis"        # 危机事件标识
     CHOICES = "choices"      # 选项列表
+    STATE = "state"          # 解析后的状态更新（protocol>=2）
+    HIDDEN = "hidden"        # 不展示给玩家的标签块，如 <hidden>、<notes>（protocol>=2）
     DONE = "done"            # 流式完成
     ERROR = "error"          # 错误事件
 
@@ -134,9 +136,19 @@ class StreamEvent(BaseModel):
     error: Optional[str] = None
 
 
-# ==================== 状态更新模型（前端从流式输出中解析） ====================
-# 注意：这些模型不再用于独立的 API 响应，而是嵌入在流式输出的 <state_update> 标签中
-# 保留这些定义是为了文档说明和类型参考
+# ==================== 状态更新模型（嵌入在流式输出的 <state_update> 标签中） ====================
+# protocol=1 的客户端从流式输出中自行解析；protocol>=2 时由服务端解析校验后通过 state 事件下发
+
+class StateUpdate(BaseModel):
+    """<state_update> 标签内的状态更新"""
+    model_config = ConfigDict(extra="allow")
+
+    score: Optional[int] = Field(default=None, description="行动评分（仅判定输出）")
+    stat_changes: StatChanges = Field(default_factory=StatChanges, description="状态变更")
+    item_changes: ItemChanges = Field(default_factory=ItemChanges, description="物品变更")
+    new_hidden_tags: list[str] = Field(default_factory=list, description="新增的隐藏标签")
+    remove_hidden_tags: list[str] = Field(default_factory=list, description="移除的隐藏标签")
+
 
 # Narrator 状态更新格式（无危机事件时，嵌入在叙事输出末尾）
 # {
@@ -166,3 +178,20 @@ class AccessCheckResponse(BaseModel):
     token: str = Field(..., description="会话令牌")
     type: str = Field(..., description="会话类型：public")
     message: str = Field(..., description="提示信息")
+
+
+class QueueTicketResponse(BaseModel):
+    """排队票据（名额已满且请求排队时返回，HTTP 202）"""
+    ticket: str = Field(..., description="排队票据")
+    position: int = Field(..., description="排队位置，从 1 开始")
+    eta_seconds: Optional[float] = Field(None, description="预计等待时间（秒），样本不足时为空")
+    message: str = Field(..., description="提示信息")
+
+
+class QueueStatusResponse(BaseModel):
+    """排队状态"""
+    status: str = Field(..., description="waiting / admitted / expired / left")
+    position: Optional[int] = Field(None, description="排队位置（waiting 时）")
+    eta_seconds: Optional[float] = Field(None, description="预计等待时间（秒）")
+    token: Optional[str] = Field(None, description="会话令牌（admitted 时）")
+    session_type: Optional[str] = Field(None, description="会话类型（admitted 时）")
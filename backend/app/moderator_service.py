@@ -5,12 +5,74 @@
 - 色情内容
 - 暴力血腥内容
 - 其他不适宜内容
+
+为减少审核调用：
+- 玩家直接选择叙事引擎为该会话生成的预设选项（A-D）时跳过审核（选项由服务端记录，不信任客户端回传的上下文）
+- 本地关键词预审核：命中黑名单直接拒绝，明显无害的短输入直接放行
+- 自由输入的审核结论按归一化文本缓存（LRU + TTL），重复或近似输入直接命中
 """
 import logging
+import re
+import time
+import unicodedata
+from collections import OrderedDict
+from pathlib import Path
+
+from app.config import get_settings
+from app.core.keyword_filter import DEFAULT_LIST_DIR, KeywordFilter
+from app.core.metrics import metrics
+from app.core.stream_parser import CHOICE_LINE_PATTERN
 from app.llm_service import get_llm_service
 
 logger = logging.getLogger(__name__)
 
+OPTIONS_BLOCK_PATTERN = re.compile(r"<options>(.*?)(?:</options>|$)", re.DOTALL)
+
+# 记录预设选项的会话数上限（超出时淘汰最久未更新的会话）
+PRESET_MEMORY_SIZE = 4096
+
+
+def normalize_text(text: str) -> str:
+    """
+    归一化文本用于比较和缓存：全半角统一、忽略大小写、去掉空白和标点
+    """
+    text = unicodedata.normalize("NFKC", text).lower()
+    return "".join(ch for ch in text if unicodedata.category(ch)[0] in ("L", "N"))
+
+
+def extract_preset_choices(event_context: str) -> list[str]:
+    """
+    从叙事输出中提取预设选项（优先解析 <options> 块，兼容 --- 分隔格式）
+    
+    Returns:
+        形如 "A. 选项描述" 的列表
+    """
+    if not event_context:
+        return []
+    block = OPTIONS_BLOCK_PATTERN.search(event_context)
+    if block:
+        text = block.group(1)
+    elif "---" in event_context:
+        text = event_context.split("---", 1)[1]
+    else:
+        text = event_context
+    return [f"{letter}. {content}" for letter, content in CHOICE_LINE_PATTERN.findall(text)]
+
+
+def is_preset_choice(action: str, preset_choices: list[str]) -> bool:
+    """判断玩家行动是否就是某个预设选项（允许省略字母前缀）"""
+    normalized = normalize_text(action)
+    if not normalized:
+        return False
+    for choice in preset_choices:
+        match = CHOICE_LINE_PATTERN.match(choice)
+        if not match:
+            continue
+        letter, content = match.groups()
+        if normalized in (normalize_text(f"{letter}{content}"), normalize_text(content)):
+            return True
+    return False
+
 
 class ModerationResult:
     """审核结果"""
@@ -20,11 +82,30 @@ class ModerationResult:
         self.reason = reason    # 违规原因
 
 
+class ModerationRejectedError(Exception):
+    """内容审核未通过"""
+    
+    def __init__(self, reason: str = ""):
+        super().__init__(f"您的输入包含不适宜的内容，请重新输入。原因：{reason}")
+        self.reason = reason
+
+
 class ModeratorService:
     """内容审核服务"""
     
     def __init__(self):
         self.llm_service = get_llm_service()
+        self.settings = get_settings()
+        # 审核结论缓存：归一化文本 -> (结果, 过期时间)
+        self._cache: OrderedDict[str, tuple[ModerationResult, float]] = OrderedDict()
+        # 服务端为各会话生成的最近一组预设选项：会话令牌 -> (选项列表, 过期时间)
+        self._presets: OrderedDict[str, tuple[list[str], float]] = OrderedDict()
+        # 本地关键词预审核（启动时加载，词表文件变化后自动重载）
+        self.keyword_filter = KeywordFilter(
+            blocklist_path=Path(self.settings.moderation_blocklist_path or DEFAULT_LIST_DIR / "blocklist.txt"),
+            allowlist_path=Path(self.settings.moderation_allowlist_path or DEFAULT_LIST_DIR / "allowlist.txt"),
+            normalize=normalize_text,
+        )
         
         # 审核系统提示词
         self.system_prompt = """你是一个内容安全审核助手。你的任务是判断用户输入是否包含不适宜的内容。
@@ -46,20 +127,115 @@ class ModeratorService:
     "reason": "违规原因（如果is_safe为false）"
 }"""
     
-    async def check_content(self, user_input: str) -> ModerationResult:
+    def _cache_get(self, key: str) -> ModerationResult | None:
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        result, expires_at = entry
+        if time.monotonic() > expires_at:
+            del self._cache[key]
+            return None
+        self._cache.move_to_end(key)
+        return result
+    
+    def _cache_put(self, key: str, result: ModerationResult) -> None:
+        size = self.settings.moderation_cache_size
+        if size <= 0:
+            return
+        self._cache[key] = (result, time.monotonic() + self.settings.moderation_cache_ttl)
+        self._cache.move_to_end(key)
+        while len(self._cache) > size:
+            self._cache.popitem(last=False)
+    
+    def remember_presets(self, session: str | None, narrative: str) -> None:
+        """记录叙事引擎为该会话生成的预设选项（叙事完成后调用），之后只有这些选项可以跳过审核"""
+        if not session:
+            return
+        choices = extract_preset_choices(narrative)
+        if not choices:
+            self._presets.pop(session, None)
+            return
+        self._presets[session] = (choices, time.monotonic() + self.settings.SESSION_TIMEOUT_SECONDS)
+        self._presets.move_to_end(session)
+        while len(self._presets) > PRESET_MEMORY_SIZE:
+            self._presets.popitem(last=False)
+    
+    def issued_presets(self, session: str | None) -> list[str]:
+        """服务端为该会话生成的最近一组预设选项，没有记录时返回空列表"""
+        entry = self._presets.get(session) if session else None
+        if entry is None:
+            return []
+        choices, expires_at = entry
+        if time.monotonic() > expires_at:
+            del self._presets[session]
+            return []
+        return choices
+    
+    def stats(self) -> dict:
+        """审核来源统计及缓存命中率"""
+        counts = {
+            source: int(metrics.get("moderation_requests_total", source=source))
+            for source in ("empty", "preset", "keyword_block", "keyword_allow", "cache", "llm")
+        }
+        lookups = counts["cache"] + counts["llm"]
+        return {
+            **counts,
+            "cache_size": len(self._cache),
+            "cache_hit_rate": round(counts["cache"] / lookups, 4) if lookups else None,
+            "keyword_filter": self.keyword_filter.stats(),
+        }
+    
+    async def check_content(
+        self,
+        user_input: str,
+        preset_choices: list[str] | None = None
+    ) -> ModerationResult:
         """
         检查用户输入是否安全
         
         Args:
             user_input: 用户输入的文本
+            preset_choices: 本回合叙事引擎生成的预设选项（必须来自服务端记录，见 issued_presets），
+                玩家原样选择时跳过审核（仍先经过关键词黑名单；判定提示词中仍保留安全护栏）
             
         Returns:
             ModerationResult: 审核结果
         """
         # 空输入直接通过
         if not user_input or not user_input.strip():
+            metrics.incr("moderation_requests_total", source="empty")
             return ModerationResult(is_safe=True)
         
+        # 本地关键词预审核：明确违规直接拒绝（预设选项也不例外），明显无害直接放行
+        verdict = self.keyword_filter.check(
+            user_input,
+            trivial_length=self.settings.moderation_trivial_length,
+            allow_coverage=self.settings.moderation_allow_coverage,
+        )
+        if verdict.decision == "block":
+            metrics.incr("moderation_requests_total", source="keyword_block")
+            logger.warning(f"内容审核未通过（关键词: {verdict.hits}） - 输入: {user_input[:100]}")
+            return ModerationResult(is_safe=False, reason="包含违规内容")
+        
+        # 预设选项由我们自己的叙事引擎生成，无需再审核
+        if (
+            preset_choices
+            and self.settings.moderation_skip_presets
+            and is_preset_choice(user_input, preset_choices)
+        ):
+            metrics.incr("moderation_requests_total", source="preset")
+            return ModerationResult(is_safe=True)
+        
+        if verdict.decision == "allow":
+            metrics.incr("moderation_requests_total", source="keyword_allow")
+            return ModerationResult(is_safe=True)
+        
+        cache_key = normalize_text(user_input)
+        cached = self._cache_get(cache_key)
+        if cached is not None:
+            metrics.incr("moderation_requests_total", source="cache")
+            return cached
+        
         try:
             # 构建用户提示词
             user_prompt = f"""请审核以下用户输入：
@@ -74,7 +250,9 @@ class ModeratorService:
                 system_prompt=self.system_prompt,
                 user_prompt=user_prompt,
                 temperature=0.3,  # 使用较低的温度以获得更稳定的判断
-                role="moderator"
+                role="moderator",
+                hedge=True,
+                label="moderation"
             )
             
             is_safe = result.get("is_safe", True)
@@ -84,7 +262,10 @@ class ModeratorService:
             if not is_safe:
                 logger.warning(f"内容审核未通过 - 原因: {reason} - 输入: {user_input[:100]}")
             
-            return ModerationResult(is_safe=is_safe, reason=reason)
+            metrics.incr("moderation_requests_total", source="llm")
+            result = ModerationResult(is_safe=is_safe, reason=reason)
+            self._cache_put(cache_key, result)
+            return result
             
         except Exception as e:
             # 审核服务出错时，默认放行（避免影响用户体验）
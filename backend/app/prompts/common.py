@@ -142,6 +142,18 @@ STATE_OUTPUT_FORMAT = """
 
 
 
+# ==================== 用户提示词布局约定 ====================
+#
+# 逐回合调用的提示词按"越稳定越靠前"排列，让上游的前缀缓存尽量命中：
+# 1. 系统提示词（世界观、机制、格式要求，全局不变）
+# 2. 本局常量（职业、避难所、天赋，整局不变）
+# 3. 历史记录（对齐窗口，只在末尾追加）
+#    窗口最多 max_days 条，起点按 ceil(max_days/2) 对齐：历史段每 ceil(max_days/2) 回合跳动一次，
+#    代价是跳动后只剩约一半的历史（5 天窗口在 3~5 条之间），以此换取提示词长度不超过未对齐时
+# 4. 本回合数据（天数、气温、属性、背包、事件、行动等）
+# 随机值（如气温波动、命运骰子）只能出现在第 4 段。
+
+
 # ==================== 上下文格式化工具函数 ====================
 
 def format_stats(stats: Stats) -> str:
@@ -198,15 +210,35 @@ def format_inventory_detailed(inventory: list[InventoryItem]) -> str:
     return "\n".join(lines)
 
 
-def format_history(history: list[HistoryEntry], max_days: int = 5) -> str:
+def recent_window(history: list, max_days: int) -> list:
+    """
+    取最近的历史记录，最多 max_days 条，窗口起点按块对齐
+    
+    直接取最后 N 条时，每过一天窗口整体滑动，提示词中的历史段每回合都会变化，
+    上游的前缀缓存无法命中。起点按 block = ceil(max_days/2) 对齐后，窗口内保留
+    max_days-block+1 ~ max_days 条，每 block 天才跳动一次，其余回合历史段只在末尾追加
+    """
+    if len(history) <= max_days:
+        return history
+    block = (max_days + 1) // 2
+    start = -(-(len(history) - max_days) // block) * block
+    return history[start:]
+
+
+def format_history(history: list[HistoryEntry], max_days: int = 5, aligned: bool = False) -> str:
     """
     格式化历史记录，只取最近N天
     使用XML标签结构化，便于AI理解上下文
+    
+    aligned=True 时使用 recent_window 对齐窗口起点（逐回合调用的叙事/判定提示词使用）
     """
     if not history:
         return "<history>\n  <note>这是末世的第一天，一切才刚刚开始...</note>\n</history>"
     
-    recent = history[-max_days:] if len(history) > max_days else history
+    if aligned:
+        recent = recent_window(history, max_days)
+    else:
+        recent = history[-max_days:] if len(history) > max_days else history
     
     lines = ["<history>"]
     for entry in recent:
@@ -95,8 +95,8 @@ ICE_AGE_MECHANICS = """
 
 # ==================== 通用工具函数 ====================
 
-def calculate_temperature(day: int) -> int:
-    """根据天数计算当前气温（含随机波动）"""
+def calculate_base_temperature(day: int) -> int:
+    """根据天数计算基准气温（不含随机波动）"""
     if day <= 1: 
         base = -5
     elif day <= 10: 
@@ -109,9 +109,13 @@ def calculate_temperature(day: int) -> int:
         # Day 20+: drop to -50
         base = -40 - int((day - 20) * 0.5)
         if base < -55: base = -55
-    
+    return base
+
+
+def calculate_temperature(day: int) -> int:
+    """根据天数计算当前气温（含随机波动，只能放在提示词的本回合数据段）"""
     # 随机波动 +/- 3度
-    return base + random.randint(-3, 3)
+    return calculate_base_temperature(day) + random.randint(-3, 3)
 
 def get_attr(obj: Any, key: str, default: Any = None) -> Any:
     """兼容 字典 和 对象 的属性获取"""
@@ -78,6 +78,9 @@ def build_ice_age_judge_prompt(
 <context>
 ## 当前状态
 
+### 天赋
+{talents_str}
+
 ### 时间与环境
 第 {day} 天，气温 {temperature}°C
 
@@ -85,9 +88,6 @@ def build_ice_age_judge_prompt(
 - HP: {stats.get('hp', 100)}
 - SAN: {stats.get('san', 100)}
 
-### 天赋
-{talents_str}
-
 ### 背包物品
 {inventory_str}
 
@@ -119,3 +119,11 @@ def build_ice_age_judge_prompt(
 
 </instruction>
 """
+
+
+ICE_AGE_JUDGE_CONTINUE_PROMPT = """
+<instruction>
+你上一次的判定输出在中途中断了，已输出的叙事保留在上文。
+请紧接着上文最后一句继续写完判定叙事（不要重复已经输出的内容），然后输出 <state_update> 标签。
+</instruction>
+"""
@@ -16,6 +16,7 @@ from app.prompts.ice_age_common import (
     format_ice_age_inventory,
     format_ice_age_talents
 )
+from app.prompts.common import recent_window
 
 
 # ==================== 批量生成提示词 ====================
@@ -174,20 +175,14 @@ def build_ice_age_narrator_prompt(
         return item_str
 
     history_str = "无" if not history else "\n\n".join(
-        format_history_item(h) for h in history[-5:]
+        format_history_item(h) for h in recent_window(history, 5)
     )
     
+    # 布局：本局常量 → 历史 → 本回合数据（见 common.py 的布局约定）
     return f"""
 <current_state>
 ## 当前状态
 
-### 时间
-末世第 {start_day} 天，当前气温 {current_temp}°C
-
-### 玩家属性
-- HP: {stats.hp}
-- SAN: {stats.san}
-
 ### 天赋
 {talents_str}
 
@@ -197,14 +192,21 @@ def build_ice_age_narrator_prompt(
 ### 避难所特性
 {shelter_hidden if shelter_hidden else '无特殊属性'}
 
+### 近期经历
+{history_str}
+
+### 时间
+末世第 {start_day} 天，当前气温 {current_temp}°C
+
+### 玩家属性
+- HP: {stats.hp}
+- SAN: {stats.san}
+
 ### 背包物品
 {inventory_str}
 
 ### 隐藏标签
 {', '.join(hidden_tags) if hidden_tags else '无'}
-
-### 近期经历
-{history_str}
 </current_state>
 
 <instruction>
@@ -214,3 +216,13 @@ def build_ice_age_narrator_prompt(
 请直接输出JSON格式的结果。
 </instruction>
 """
+
+
+def build_ice_age_continue_prompt(next_day: int) -> str:
+    """构建批量生成中断后的续写指令（已输出的内容作为 assistant 消息放在前面）"""
+    return f"""
+<instruction>
+你上一次的输出在中途中断了，已完整输出的日志保留在上文。
+请紧接着从第{next_day}天开始继续输出 <day_log>，不要重复已经输出的天数，格式要求与之前相同。
+</instruction>
+"""
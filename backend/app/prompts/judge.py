@@ -157,7 +157,7 @@ def build_judge_narrative_prompt(
 {format_profession(profession)}
 
 ### 近期经历（背景参考）
-{format_history(history)}
+{format_history(history, aligned=True)}
 
 ### 当前时间
 末世爆发后第{day}天
@@ -157,7 +157,7 @@ def build_narrator_prompt(
 {shelter_hidden_info}
 
 ### 最近的经历
-{format_history(history)}
+{format_history(history, aligned=True)}
 
 ### 时间
 末世爆发后的第 {day} 天 
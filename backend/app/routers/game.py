@@ -7,11 +7,12 @@
 - Judge: /judge/stream - 流式输出判定叙事，末尾包含 <state_update> 标签
 - 前端从流式输出中解析 <state_update> 标签获取状态更新 JSON
 """
+import asyncio
 import json
 import logging
 import re
 from fastapi import APIRouter, HTTPException
-from fastapi.responses import StreamingResponse
+from fastapi.responses import JSONResponse
 
 # 配置日志
 logger = logging.getLogger(__name__)
@@ -25,6 +26,7 @@ from app.models import (
     JudgeRequest,
     EndingRequest, EndingResponse,
     AccessCheckRequest, AccessCheckResponse,
+    QueueTicketResponse, QueueStatusResponse,
 )
 from app.prompts import (
     NARRATOR_NARRATIVE_SYSTEM_PROMPT,
@@ -34,9 +36,19 @@ from app.prompts import (
     ENDING_SYSTEM_PROMPT, build_ending_prompt
 )
 from app.llm_service import get_llm_service
-from app.moderator_service import get_moderator_service
+from app.moderator_service import (
+    get_moderator_service,
+    ModerationRejectedError,
+)
+from app.core.metrics import metrics
+from app.core.single_flight import flight_key, single_flight
+from app.core.sse_replay import replay_registry, sse_response
+from app.core.stream_parser import NarrativeStreamParser, STRUCTURED_STREAM_PROTOCOL
+from app.core.streaming import gated_stream
+from app.core.session_store import TicketData
 from app.core.traffic_control import traffic_controller
-from fastapi import Header, Query, status
+from app.core.waiting_room import waiting_room
+from fastapi import Header, Query, Request, status
 
 router = APIRouter(prefix="/api/game", tags=["game"])
 
@@ -44,6 +56,16 @@ router = APIRouter(prefix="/api/game", tags=["game"])
 settings = get_settings()
 
 
+# 判定输出的结构化停止序列：状态更新之后不应再有内容
+JUDGE_STOP_SEQUENCE = "</state_update>"
+
+# 排队 SSE 的心跳间隔（秒），位置没有变化时也定期推送
+QUEUE_HEARTBEAT_SECONDS = 10.0
+
+# 连接/轮询期间刷新票据活跃时间的间隔（秒），需小于 WAITING_ROOM_TICKET_TTL_SECONDS
+QUEUE_TOUCH_SECONDS = 5.0
+
+
 # ==================== 辅助函数 ====================
 
 def format_sse_event(event_type: str, data: dict) -> str:
@@ -80,23 +102,130 @@ def parse_narrative_choices(text: str) -> tuple[str, bool, list[str] | None]:
 # ==================== Access 接口 ====================
 
 @router.post("/access", response_model=AccessCheckResponse)
-async def check_access(request: AccessCheckRequest):
+async def check_access(
+    request: AccessCheckRequest,
+    queue: bool = Query(False, description="名额已满时排队（返回 202 和排队票据），否则返回 503")
+):
     """
     检查访问权限并获取令牌
+    
+    名额已满时：
+    - queue=false：返回 503（旧版行为）
+    - queue=true：返回 202 和排队票据，之后通过 /access/queue/{ticket}/events（SSE）
+      或 /access/queue/{ticket}（长轮询）获取排队位置，名额空出时直接下发令牌
+    有人排队时新请求不能插队，直接进入排队（或返回 503）
     """
+    queue_enabled = settings.WAITING_ROOM_ENABLED
     try:
-        token = traffic_controller.try_join()
-        session_type = traffic_controller.sessions[token].type
+        if queue_enabled and await waiting_room.waiting():
+            raise ValueError("服务器爆满，请稍后重试")
+        token = await traffic_controller.try_join()
+        session_type = (await traffic_controller.get_session(token)).type
         return AccessCheckResponse(
             token=token,
             type=session_type,
             message="欢迎进入末世模拟器"
         )
+    except ValueError as e:
+        if not (queue and queue_enabled):
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail=str(e)
+            )
+    
+    try:
+        ticket = await waiting_room.enqueue()
     except ValueError as e:
         raise HTTPException(
             status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
             detail=str(e)
         )
+    position = await waiting_room.position(ticket)
+    response = QueueTicketResponse(
+        ticket=ticket.id,
+        position=position,
+        eta_seconds=waiting_room.eta_seconds(position),
+        message="服务器爆满，已为你排队"
+    )
+    return JSONResponse(status_code=status.HTTP_202_ACCEPTED, content=response.model_dump())
+
+
+async def refresh_ticket(ticket: str, touched_at: float) -> tuple[TicketData | None, float]:
+    """读取票据，距上次刷新超过 QUEUE_TOUCH_SECONDS 时顺带刷新活跃时间（减少对共享存储的写入）"""
+    now = asyncio.get_running_loop().time()
+    if now - touched_at >= QUEUE_TOUCH_SECONDS:
+        return await waiting_room.touch(ticket), now
+    return await waiting_room.get(ticket), touched_at
+
+
+@router.get("/access/queue/{ticket}", response_model=QueueStatusResponse)
+async def queue_status(
+    ticket: str,
+    position: int = Query(None, description="客户端已知的排队位置，位置变化或被放行时才返回"),
+    wait: float = Query(25.0, ge=0, le=60, description="长轮询最长等待时间（秒）")
+):
+    """
+    排队状态（长轮询）
+    
+    带上已知的 position 时，位置没有变化则最多等待 wait 秒；被放行时返回令牌
+    """
+    entry, touched_at = await refresh_ticket(ticket, float("-inf"))
+    
+    deadline = asyncio.get_running_loop().time() + wait
+    while entry is not None and entry.status == "waiting" and await waiting_room.position(entry) == position:
+        remaining = deadline - asyncio.get_running_loop().time()
+        if remaining <= 0:
+            break
+        await waiting_room.wait_change(remaining)
+        entry, touched_at = await refresh_ticket(ticket, touched_at)
+    
+    if entry is not None and entry.status == "admitted":
+        entry = await waiting_room.claim(ticket)
+    if entry is None:
+        raise HTTPException(status_code=404, detail="排队票据不存在或已过期")
+    return QueueStatusResponse(**await waiting_room.status(entry))
+
+
+@router.get("/access/queue/{ticket}/events")
+async def queue_events(ticket: str, http_request: Request):
+    """
+    排队状态（SSE）
+    
+    事件类型 queue：status 为 waiting 时带 position 和 eta_seconds（位置变化时推送，另有心跳）；
+    admitted 时带 token，expired/left 后连接关闭。连接保持期间票据不会过期
+    """
+    if await waiting_room.touch(ticket) is None:
+        raise HTTPException(status_code=404, detail="排队票据不存在或已过期")
+    
+    async def generate():
+        loop = asyncio.get_running_loop()
+        last_sent, sent_at, touched_at = None, 0.0, loop.time()
+        while True:
+            entry, touched_at = await refresh_ticket(ticket, touched_at)
+            if entry is not None and entry.status == "admitted":
+                entry = await waiting_room.claim(ticket)  # 先领取再下发，下发的令牌不会被收回
+            if entry is None:
+                yield format_sse_event("queue", {"status": "expired"})
+                return
+            data = await waiting_room.status(entry)
+            if data != last_sent or loop.time() - sent_at >= QUEUE_HEARTBEAT_SECONDS:
+                yield format_sse_event("queue", data)  # 位置变化或心跳
+                last_sent, sent_at = data, loop.time()
+            if entry.status != "waiting":
+                return
+            await waiting_room.wait_change(QUEUE_HEARTBEAT_SECONDS)
+            if await http_request.is_disconnected():
+                return
+    
+    return sse_response(generate())
+
+
+@router.delete("/access/queue/{ticket}")
+async def leave_queue(ticket: str):
+    """离开排队"""
+    if not await waiting_room.leave(ticket):
+        raise HTTPException(status_code=404, detail="排队票据不存在或已不在队伍中")
+    return {"status": "left"}
 
 
 
@@ -107,7 +236,10 @@ async def check_access(request: AccessCheckRequest):
 @router.post("/narrate/stream")
 async def narrate_stream(
     request: NarrateRequest,
-    token: str = Query(None, description="会话令牌")  # SSE 通常使用 Query 参数传递 Token
+    http_request: Request,
+    token: str = Query(None, description="会话令牌"),  # SSE 通常使用 Query 参数传递 Token
+    protocol: int = Query(1, description="客户端协议版本，>=2 时由服务端解析标签并下发结构化事件"),
+    last_event_id: str = Header(None, alias="Last-Event-ID")
 ):
 
     """
@@ -124,8 +256,28 @@ async def narrate_stream(
     - done: 流式完成
     - error: 错误信息
     
-    前端需要从完整输出中解析 <state_update> 标签获取状态更新 JSON
+    protocol=1：content 为原始输出，前端需要从完整输出中解析 <state_update> 标签获取状态更新 JSON
+    protocol>=2：content 不含 <state_update>/<notes>/<hidden>/<options>，另外下发：
+    - crisis: 检测到选项块（危机事件）
+    - choices: 每完成一行选项发送一次，内容为目前已完成的选项列表
+    - state: 解析校验后的状态更新
+    - hidden: 暂扣的标签块原文
+    
+    选项之后的 <hidden> 或 <state_update> 闭合后即提前关闭上游，不再生成多余内容
+    
+    每个事件带 id；断线后带 Last-Event-ID 请求头重新请求，补发错过的事件并跟随原生成，不会重新生成；
+    无法续传时只返回一个 reset 事件，客户端清空内容后不带 Last-Event-ID 重新请求。
+    客户端断开且在 SSE_DISCONNECT_GRACE 秒内没有重连时，取消生成并关闭上游连接
     """
+    # 断线重连：补发错过的事件并跟随原生成；连点/重试的重复请求接到进行中的相同生成上
+    flight = flight_key(token, "game/narrate", request, protocol)
+    attached = (
+        replay_registry.resume(last_event_id, token, "game/narrate", http_request)
+        or replay_registry.join(flight, "game/narrate", http_request)
+    )
+    if attached is not None:
+        return attached
+    
     is_prod = settings.is_production()
     
     logger.info("="*50)
@@ -159,41 +311,57 @@ async def narrate_stream(
     # 用于收集完整响应的容器
     full_response_chunks = []
     request_data = format_request_for_log(request)
+    parser = NarrativeStreamParser(
+        structured=protocol >= STRUCTURED_STREAM_PROTOCOL,
+        detect_choices=True
+    )
     
     async def generate():
         """SSE流式生成器"""
         try:
-            async for chunk in llm.chat_stream(
+            stream = llm.chat_stream(
                 system_prompt=NARRATOR_NARRATIVE_SYSTEM_PROMPT,
                 user_prompt=user_prompt,
                 temperature=0.9,
-                role="narrator"
-            ):
-                full_response_chunks.append(chunk)
-                yield format_sse_event("content", {"text": chunk})
+                role="narrator",
+                session=token,
+                label="game/narrate"
+            )
+            try:
+                async for chunk in stream:
+                    full_response_chunks.append(chunk)
+                    for event_type, data in parser.feed(chunk):
+                        yield format_sse_event(event_type, data)
+                    if parser.complete:
+                        # 选项和隐藏说明（或状态更新）已经完整，之后的 token 没有用处，提前关闭上游
+                        metrics.incr("llm_early_close_total", role="narrator")
+                        break
+            finally:
+                await stream.aclose()
+            
+            for event_type, data in parser.finish():
+                yield format_sse_event(event_type, data)
             
             # 发送完成信号
             yield format_sse_event("done", {})
             
-            # 记录完整响应到日志文件
+            # 记录本次生成的预设选项（判定时只有这些选项可以跳过审核）和完整响应
             full_response = "".join(full_response_chunks)
+            get_moderator_service().remember_presets(token, full_response)
             log_api_call("narrate/stream", request_data, full_response)
             logger.info("[NARRATE/STREAM] 流式输出完成，已记录到日志文件")
             
+        except asyncio.CancelledError:
+            # 客户端断开且没有重连，生成被中止（上游连接已关闭）
+            logger.info("[NARRATE/STREAM] 客户端已断开，生成中止")
+            log_api_call("narrate/stream", request_data, "".join(full_response_chunks), error="aborted: client disconnected")
+            raise
         except Exception as e:
             logger.error(f"[NARRATE/STREAM] 流式错误: {e}")
             log_api_call("narrate/stream", request_data, error=str(e))
             yield format_sse_event("error", {"error": str(e)})
     
-    return StreamingResponse(
-        generate(),
-        media_type="text/event-stream",
-        headers={
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-            "X-Accel-Buffering": "no",
-        }
-    )
+    return replay_registry.start(token, "game/narrate", generate(), key=flight, client=http_request)
 
 
 # ==================== Judge 接口 ====================
@@ -201,7 +369,10 @@ async def narrate_stream(
 @router.post("/judge/stream")
 async def judge_stream(
     request: JudgeRequest,
-    token: str = Query(None, description="会话令牌")
+    http_request: Request,
+    token: str = Query(None, description="会话令牌"),
+    protocol: int = Query(1, description="客户端协议版本，>=2 时由服务端解析标签并下发结构化事件"),
+    last_event_id: str = Header(None, alias="Last-Event-ID")
 ):
 
     """
@@ -211,10 +382,24 @@ async def judge_stream(
     功能：判定玩家行动的结果，流式输出叙事描述
     叙事末尾包含 <state_update> 标签，包含评分和状态更新 JSON
     
+    开启 JUDGE_SPECULATIVE_MODERATION 后，内容审核与判定生成并行：
+    判定输出先缓存在服务端，审核通过后放行；审核不通过则取消生成并返回错误
+    
     返回：text/event-stream 流式响应（SSE格式）
     
-    前端需要从完整输出中解析 <state_update> 标签获取状态更新 JSON
+    protocol=1：前端需要从完整输出中解析 <state_update> 标签获取状态更新 JSON
+    protocol>=2：状态更新通过 state 事件下发，事件格式同 /narrate/stream
+    断线续传同 /narrate/stream
     """
+    # 断线重连、重复请求：接到已有的生成上（不重复审核）
+    flight = flight_key(token, "game/judge", request, protocol)
+    attached = (
+        replay_registry.resume(last_event_id, token, "game/judge", http_request)
+        or replay_registry.join(flight, "game/judge", http_request)
+    )
+    if attached is not None:
+        return attached
+    
     is_prod = settings.is_production()
     
     logger.info("="*50)
@@ -231,25 +416,35 @@ async def judge_stream(
     
     # 内容审核：检查用户输入是否包含违规内容
     moderator = get_moderator_service()
-    moderation_result = await moderator.check_content(request.action_content)
+    # 预设选项以服务端记录的本会话最近一次叙事为准，客户端回传的 event_context 不可信
+    preset_choices = moderator.issued_presets(token)
+    speculative = settings.judge_speculative_moderation
     
-    if not moderation_result.is_safe:
-        logger.warning(f"[JUDGE/STREAM] 内容审核未通过: {moderation_result.reason}")
-        
-        async def generate_error():
-            """返回审核失败的错误信息"""
-            error_message = f"您的输入包含不适宜的内容，请重新输入。原因：{moderation_result.reason}"
-            yield format_sse_event("error", {"error": error_message})
-        
-        return StreamingResponse(
-            generate_error(),
-            media_type="text/event-stream",
-            headers={
-                "Cache-Control": "no-cache",
-                "Connection": "keep-alive",
-                "X-Accel-Buffering": "no",
-            }
-        )
+    async def moderation_gate():
+        """审核不通过时抛出 ModerationRejectedError"""
+        result = await moderator.check_content(request.action_content, preset_choices=preset_choices)
+        if speculative:
+            metrics.incr("judge_speculative_total", outcome="passed" if result.is_safe else "rejected")
+        if not result.is_safe:
+            logger.warning(f"[JUDGE/STREAM] 内容审核未通过: {result.reason}")
+            raise ModerationRejectedError(result.reason)
+    
+    if not speculative:
+        try:
+            # 连点/重试的重复请求共享同一次审核（审核结论只在调用结束后才进缓存）
+            await single_flight.do(
+                flight_key(token, "game/judge/moderation", request),
+                moderation_gate,
+                endpoint="game/judge/moderation"
+            )
+        except ModerationRejectedError as e:
+            error_message = str(e)
+            
+            async def generate_error():
+                """返回审核失败的错误信息"""
+                yield format_sse_event("error", {"error": error_message})
+            
+            return sse_response(generate_error())
     
     llm = get_llm_service()
     
@@ -267,18 +462,38 @@ async def judge_stream(
     # 用于收集完整响应的容器
     full_response_chunks = []
     request_data = format_request_for_log(request)
+    parser = NarrativeStreamParser(structured=protocol >= STRUCTURED_STREAM_PROTOCOL)
     
     async def generate():
         """SSE流式生成器"""
         try:
-            async for chunk in llm.chat_stream(
+            stream = llm.chat_stream(
                 system_prompt=JUDGE_NARRATIVE_SYSTEM_PROMPT,
                 user_prompt=user_prompt,
                 temperature=0.8,
-                role="judge"
-            ):
-                full_response_chunks.append(chunk)
-                yield format_sse_event("content", {"text": chunk})
+                role="judge",
+                session=token,
+                label="game/judge",
+                stop=[JUDGE_STOP_SEQUENCE]
+            )
+            if speculative:
+                # 审核与判定并行，判定输出在审核通过前缓存在服务端
+                stream = gated_stream(stream, moderation_gate())
+            
+            try:
+                async for chunk in stream:
+                    full_response_chunks.append(chunk)
+                    for event_type, data in parser.feed(chunk):
+                        yield format_sse_event(event_type, data)
+                    if parser.complete:
+                        # </state_update> 已闭合，判定输出到此为止，提前关闭上游
+                        metrics.incr("llm_early_close_total", role="judge")
+                        break
+            finally:
+                await stream.aclose()
+            
+            for event_type, data in parser.finish():
+                yield format_sse_event(event_type, data)
             
             yield format_sse_event("done", {})
             
@@ -287,20 +502,20 @@ async def judge_stream(
             log_api_call("judge/stream", request_data, full_response)
             logger.info("[JUDGE/STREAM] 流式输出完成，已记录到日志文件")
             
+        except asyncio.CancelledError:
+            # 客户端断开且没有重连，生成被中止（上游连接已关闭）
+            logger.info("[JUDGE/STREAM] 客户端已断开，生成中止")
+            log_api_call("judge/stream", request_data, "".join(full_response_chunks), error="aborted: client disconnected")
+            raise
+        except ModerationRejectedError as e:
+            log_api_call("judge/stream", request_data, error=str(e))
+            yield format_sse_event("error", {"error": str(e)})
         except Exception as e:
             logger.error(f"[JUDGE/STREAM] 流式错误: {e}")
             log_api_call("judge/stream", request_data, error=str(e))
             yield format_sse_event("error", {"error": str(e)})
     
-    return StreamingResponse(
-        generate(),
-        media_type="text/event-stream",
-        headers={
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-            "X-Accel-Buffering": "no",
-        }
-    )
+    return replay_registry.start(token, "game/judge", generate(), key=flight, client=http_request)
 
 
 # ==================== Ending 接口 ====================
@@ -345,12 +560,19 @@ async def ending(
             profession=request.profession
         )
         
-        # 调用LLM
-        result = await llm.chat_json(
-            system_prompt=ENDING_SYSTEM_PROMPT,
-            user_prompt=user_prompt,
-            temperature=0.9,  # 高创意度，让评语更有趣
-            role="ending"
+        # 调用LLM（同一会话的重复请求共享同一次调用）
+        result = await single_flight.do(
+            flight_key(x_game_token, "game/ending", request),
+            lambda: llm.chat_json(
+                system_prompt=ENDING_SYSTEM_PROMPT,
+                user_prompt=user_prompt,
+                temperature=0.9,  # 高创意度，让评语更有趣
+                role="ending",
+                hedge=True,
+                session=x_game_token,
+                label="game/ending"
+            ),
+            endpoint="game/ending"
         )
         
         # 打印响应日志
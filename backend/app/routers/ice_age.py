@@ -1,26 +1,39 @@
+import asyncio
 import logging
 import json
 from typing import Optional
-from fastapi import APIRouter
-from fastapi.responses import StreamingResponse
-from pydantic import BaseModel, Field
+from fastapi import APIRouter, Header, Query, Request
+from pydantic import BaseModel, Field, ValidationError, model_validator
 
 from app.config import get_settings
 from app.llm_service import get_llm_service
 from app.api_logger import log_api_call, format_request_for_log
+from app.core.metrics import metrics
+from app.core.single_flight import flight_key, single_flight
+from app.core.sse_replay import replay_registry
+from app.core.stream_parser import (
+    NarrativeStreamParser,
+    TagScanner,
+    STRUCTURED_STREAM_PROTOCOL,
+    parse_json_content,
+    sentence_prefix,
+)
+from app.core.upstream import is_retryable_error
 from app.prompts.ice_age_narrator import (
     ICE_AGE_NARRATOR_SYSTEM_PROMPT,
-    build_ice_age_narrator_prompt
+    build_ice_age_narrator_prompt,
+    build_ice_age_continue_prompt
 )
 from app.prompts.ice_age_judge import (
     ICE_AGE_JUDGE_SYSTEM_PROMPT,
+    ICE_AGE_JUDGE_CONTINUE_PROMPT,
     build_ice_age_judge_prompt
 )
 from app.prompts.ice_age_ending import (
     ICE_AGE_ENDING_SYSTEM_PROMPT,
     build_ice_age_ending_prompt
 )
-from app.models import Stats, InventoryItem
+from app.models import Stats, InventoryItem, StatChanges, ItemChanges
 
 router = APIRouter(prefix="/api/ice-age", tags=["ice-age"])
 
@@ -84,6 +97,40 @@ class IceAgeEndingRequest(BaseModel):
     talents: Optional[list[dict]] = None
 
 
+# 判定输出的结构化停止序列：状态更新之后不应再有内容
+JUDGE_STOP_SEQUENCE = "</state_update>"
+
+# 上游临时故障重试前的等待时间（秒，按尝试次数递增）
+RETRY_BACKOFF_SECONDS = 0.5
+
+
+# ==================== 流式输出模型 ====================
+
+class IceAgeChoice(BaseModel):
+    """危机选项"""
+    text: str
+    risk: str = "Medium"
+
+    @model_validator(mode="before")
+    @classmethod
+    def _from_text(cls, data):
+        # 模型偶尔只输出选项文本
+        return {"text": data} if isinstance(data, str) else data
+
+
+class IceAgeDayLog(BaseModel):
+    """批量叙事中的单日日志（<day_log> 标签内容，解析后通过 day 事件下发，除 day 外均可缺省）"""
+    day: int
+    temperature: Optional[int] = None
+    narration: str = ""
+    has_crisis: bool = False
+    choices: list[IceAgeChoice] = Field(default_factory=list)
+    state_update: StatChanges = Field(default_factory=StatChanges)
+    item_changes: ItemChanges = Field(default_factory=ItemChanges)
+    new_hidden_tags: list[str] = Field(default_factory=list)
+    removed_hidden_tags: list[str] = Field(default_factory=list)
+
+
 # ==================== 辅助函数 ====================
 
 def format_sse_event(event_type: str, data: dict) -> str:
@@ -91,15 +138,109 @@ def format_sse_event(event_type: str, data: dict) -> str:
     return f"data: {json.dumps({**data, 'type': event_type}, ensure_ascii=False)}\n\n"
 
 
+def is_retryable_stream_error(error: Exception) -> bool:
+    """内容安全拦截、网络错误、卡顿、5xx、429 等可以重试"""
+    return "inappropriate content" in str(error).lower() or is_retryable_error(error)
+
+
+def client_units(text: str) -> int:
+    """客户端（JavaScript）计算的字符串长度，按 UTF-16 码元计，rewind 的 offset 使用该单位"""
+    return len(text.encode("utf-16-le")) // 2
+
+
+def continuation_messages(partial: str, prompt: str) -> list[dict]:
+    """续写消息：已输出的内容作为 assistant 消息，再追加续写指令"""
+    return [
+        {"role": "assistant", "content": partial},
+        {"role": "user", "content": prompt}
+    ]
+
+
+# 单个 <day_log> 最多丢弃的非法字段/列表项数，超过后视为无法解析
+MAX_DROPPED_FIELDS = 20
+
+
+def _drop_invalid(data: dict, loc: tuple) -> bool:
+    """
+    删除校验失败的位置：路径上有列表下标时删除最内层的那个列表项（例如一个写错的选项），
+    否则删除顶层字段（回到默认值）
+    """
+    index = max((i for i, key in enumerate(loc) if isinstance(key, int)), default=None)
+    path = loc[:index + 1] if index is not None else loc[:1]
+    if not path:
+        return False
+    container = data
+    try:
+        for key in path[:-1]:
+            container = container[key]
+        del container[path[-1]]
+    except (KeyError, IndexError, TypeError):
+        return False
+    return True
+
+
+def parse_day_log(body: str, expected_day: int) -> dict:
+    """
+    宽松解析单个 <day_log> 块
+
+    缺少 day 时按顺序补上 expected_day；其余字段类型不对时丢弃该字段（或列表中的单项）后使用默认值，
+    只有 JSON 本身无法解析时才返回 error 和原文
+    """
+    try:
+        data = parse_json_content(body)
+    except ValueError as e:
+        return {"error": f"日志解析失败: {e}", "raw": body}
+    if not isinstance(data, dict):
+        return {"error": "日志解析失败: 不是 JSON 对象", "raw": body}
+
+    dropped = []
+    while True:
+        data.setdefault("day", expected_day)
+        try:
+            day_log = IceAgeDayLog.model_validate(data).model_dump()
+        except ValidationError as e:
+            loc = e.errors()[0]["loc"]
+            if len(dropped) >= MAX_DROPPED_FIELDS or not _drop_invalid(data, loc):
+                return {"error": f"日志解析失败: {e}", "raw": body}
+            dropped.append(".".join(str(key) for key in loc))
+            continue
+        if dropped:
+            logger.warning(f"[ICE_AGE/NARRATE] 第 {day_log['day']} 天日志字段有误，已使用默认值: {dropped}")
+            metrics.incr("ice_age_day_log_repaired_total")
+        return day_log
+
+
 # ==================== 批量叙事接口 ====================
 
 @router.post("/narrate-batch/stream")
-async def narrate_batch_stream(request: IceAgeNarrateRequest):
+async def narrate_batch_stream(
+    request: IceAgeNarrateRequest,
+    http_request: Request,
+    token: str = Query(None, description="会话令牌"),
+    protocol: int = Query(1, description="客户端协议版本，>=2 时只下发解析后的 day 事件"),
+    last_event_id: str = Header(None, alias="Last-Event-ID")
+):
     """
     批量生成多天剧情 - 流式输出
     
     返回JSON格式的多天数据
+    事件类型：
+    - content: 原始输出片段（protocol>=2 时只在某天日志无法解析时发送该天原文）
+    - day: 每个 <day_log> 闭合后立即下发解析结果（天数、叙事、危机标记、带风险的选项、状态和物品变化），
+      缺失或类型错误的字段使用默认值
+    - done: 流式完成
+    
+    每个事件带 id；断线后带 Last-Event-ID 请求头重新请求，补发错过的事件并跟随原生成（无法续传时只返回 reset 事件）；
+    客户端断开且没有重连时取消生成并关闭上游连接
     """
+    flight = flight_key(token, "ice-age/narrate-batch", request, protocol)
+    attached = (
+        replay_registry.resume(last_event_id, token, "ice-age/narrate-batch", http_request)
+        or replay_registry.join(flight, "ice-age/narrate-batch", http_request)
+    )
+    if attached is not None:
+        return attached
+    
     logger.info("="*50)
     logger.info("[ICE_AGE/NARRATE] 请求输入:")
     logger.info(f"  开始天数: {request.start_day}")
@@ -131,32 +272,85 @@ async def narrate_batch_stream(request: IceAgeNarrateRequest):
     MAX_RETRIES = 3
     
     async def generate():
+        committed = ""  # 到最后一个完整 </day_log> 为止的输出，重试时从这里续写
+        sent_units = 0  # 客户端当前持有的 content 长度
+        committed_units = 0  # 其中对应 committed 的部分，重试时客户端回退到这里
+        days_done = 0
+        last_day = 0
         for attempt in range(MAX_RETRIES):
+            output = [committed]
             try:
                 # 每次重试稍微调整 temperature 增加随机性
                 temperature = 0.8 - (attempt * 0.1)  # 0.8, 0.7, 0.6
                 
                 if attempt > 0:
-                    logger.warning(f"[ICE_AGE/NARRATE] 第 {attempt + 1} 次尝试 (temperature={temperature})")
-                    yield format_sse_event("retry", {"attempt": attempt + 1, "max_retries": MAX_RETRIES})
+                    # 客户端丢弃 offset 之后的内容（未完成的那一天）
+                    yield format_sse_event("rewind", {"offset": committed_units, "attempt": attempt + 1})
+                    sent_units = committed_units
+                    if committed:
+                        next_day = request.start_day + days_done
+                        logger.warning(f"[ICE_AGE/NARRATE] 第 {attempt + 1} 次尝试，从第 {next_day} 天续写 (temperature={temperature})")
+                        yield format_sse_event("resume", {"attempt": attempt + 1, "max_retries": MAX_RETRIES, "from_day": next_day})
+                    else:
+                        logger.warning(f"[ICE_AGE/NARRATE] 第 {attempt + 1} 次尝试 (temperature={temperature})")
+                        yield format_sse_event("retry", {"attempt": attempt + 1, "max_retries": MAX_RETRIES})
                 
-                full_text = ""
-                full_response_chunks.clear()  # 清空之前的尝试
+                scanner = TagScanner(("day_log",))
+                finished = False
                 
-                async for chunk in llm_service.chat_stream(
+                stream = llm_service.chat_stream(
                     system_prompt=ICE_AGE_NARRATOR_SYSTEM_PROMPT,
                     user_prompt=user_prompt,
-                    temperature=temperature
-                ):
-                    full_text += chunk
-                    full_response_chunks.append(chunk)
-                    yield format_sse_event("content", {"text": chunk})
+                    temperature=temperature,
+                    session=token,
+                    label="ice-age/narrate",
+                    extra_messages=continuation_messages(
+                        committed, build_ice_age_continue_prompt(request.start_day + days_done)
+                    ) if committed else None
+                )
+                try:
+                    async for chunk in stream:
+                        output.append(chunk)
+                        if protocol < STRUCTURED_STREAM_PROTOCOL:
+                            yield format_sse_event("content", {"text": chunk})
+                            sent_units += client_units(chunk)
+                        for kind, _, body in scanner.feed(chunk):
+                            if kind != "block":
+                                continue
+                            text = "".join(output)
+                            committed = text[:text.lower().rfind("</day_log>") + len("</day_log>")]
+                            # 原文作为 content 下发时，已发出的 </day_log> 之后的部分不算已完成
+                            tail = text[len(committed):] if protocol < STRUCTURED_STREAM_PROTOCOL else ""
+                            committed_units = sent_units - client_units(tail)
+                            day_log = parse_day_log(body, max(last_day, request.start_day - 1) + 1)
+                            if isinstance(day_log.get("day"), int) and day_log["day"] <= last_day:
+                                continue  # 续写时模型重复输出了已完成的天数
+                            if "error" in day_log:
+                                # 无法解析的日志：protocol>=2 的客户端收不到原始 content，原文作为 content 下发
+                                logger.warning(f"[ICE_AGE/NARRATE] {day_log['error']}")
+                                if protocol >= STRUCTURED_STREAM_PROTOCOL:
+                                    yield format_sse_event("content", {"text": body})
+                                    sent_units += client_units(body)
+                                    committed_units = sent_units
+                            else:
+                                yield format_sse_event("day", day_log)
+                            days_done += 1
+                            last_day = day_log.get("day") or last_day
+                            # 危机日的 </day_log> 或生成够天数后停止（提示词要求，由服务端强制执行）
+                            if day_log.get("has_crisis") or days_done >= request.days_to_generate:
+                                finished = True
+                                break
+                        if finished:
+                            metrics.incr("llm_early_close_total", role="ice-age/narrate")
+                            break
+                finally:
+                    await stream.aclose()
                 
-                # 成功完成
-                yield format_sse_event("done", {"full_text": full_text})
+                # 成功完成（客户端已通过 content/day 事件拿到全部内容，不再重复下发全文）
+                yield format_sse_event("done", {})
                 
                 # 记录日志
-                full_response = "".join(full_response_chunks)
+                full_response = "".join(output)
                 log_api_call("ice-age/narrate-batch", request_data, full_response)
                 
                 # 打印AI输出摘要（生产环境也显示）
@@ -165,20 +359,28 @@ async def narrate_batch_stream(request: IceAgeNarrateRequest):
                 logger.info("[ICE_AGE/NARRATE] 完成")
                 return  # 成功后退出
                 
+            except asyncio.CancelledError:
+                # 客户端断开且没有重连，生成被中止（上游连接已关闭）
+                logger.info("[ICE_AGE/NARRATE] 客户端已断开，生成中止")
+                log_api_call("ice-age/narrate-batch", request_data, "".join(output), error="aborted: client disconnected")
+                raise
             except Exception as e:
                 error_msg = str(e)
                 
                 # 检查是否是内容安全错误
                 is_content_error = "inappropriate content" in error_msg.lower()
                 
-                # 如果是内容安全错误且还有重试次数
-                if is_content_error and attempt < MAX_RETRIES - 1:
-                    logger.warning(f"[ICE_AGE/NARRATE] 内容安全检查失败，准备重试 ({attempt + 1}/{MAX_RETRIES})")
+                # 内容安全错误和上游临时故障（网络、卡顿、5xx、429）且还有重试次数
+                if is_retryable_stream_error(e) and attempt < MAX_RETRIES - 1:
+                    logger.warning(f"[ICE_AGE/NARRATE] 生成中断，准备重试 ({attempt + 1}/{MAX_RETRIES}): {e}")
+                    metrics.incr("ice_age_retry_total", endpoint="narrate-batch", mode="resume" if committed else "restart")
+                    if not is_content_error:
+                        await asyncio.sleep(RETRY_BACKOFF_SECONDS * (attempt + 1))
                     continue  # 继续下一次重试
                 
-                # 如果不是内容安全错误，或者已达到最大重试次数
+                # 不可重试的错误，或者已达到最大重试次数
                 logger.error(f"[ICE_AGE/NARRATE] 错误: {e}")
-                log_api_call("ice-age/narrate-batch", request_data, error=error_msg)
+                log_api_call("ice-age/narrate-batch", request_data, "".join(output), error=error_msg)
                 
                 if is_content_error and attempt >= MAX_RETRIES - 1:
                     yield format_sse_event("error", {
@@ -189,24 +391,33 @@ async def narrate_batch_stream(request: IceAgeNarrateRequest):
                     yield format_sse_event("error", {"error": error_msg})
                 return
     
-    return StreamingResponse(
-        generate(),
-        media_type="text/event-stream",
-        headers={
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-            "X-Accel-Buffering": "no"
-        }
-    )
+    return replay_registry.start(token, "ice-age/narrate-batch", generate(), key=flight, client=http_request)
 
 
 # ==================== 判定接口 ====================
 
 @router.post("/judge/stream")
-async def judge_stream(request: IceAgeJudgeRequest):
+async def judge_stream(
+    request: IceAgeJudgeRequest,
+    http_request: Request,
+    token: str = Query(None, description="会话令牌"),
+    protocol: int = Query(1, description="客户端协议版本，>=2 时由服务端解析标签并下发结构化事件"),
+    last_event_id: str = Header(None, alias="Last-Event-ID")
+):
     """
     行动判定 - 流式输出
+    
+    protocol>=2 时 content 不含 <state_update>，状态更新通过 state 事件下发
+    断线续传同 /narrate-batch/stream
     """
+    flight = flight_key(token, "ice-age/judge", request, protocol)
+    attached = (
+        replay_registry.resume(last_event_id, token, "ice-age/judge", http_request)
+        or replay_registry.join(flight, "ice-age/judge", http_request)
+    )
+    if attached is not None:
+        return attached
+    
     logger.info("="*50)
     logger.info("[ICE_AGE/JUDGE] 请求输入:")
     logger.info(f"  天数: {request.day}")
@@ -236,32 +447,61 @@ async def judge_stream(request: IceAgeJudgeRequest):
     MAX_RETRIES = 3
     
     async def generate():
+        committed = ""  # 到最后一个完整句子为止的判定叙事，重试时从这里续写
         for attempt in range(MAX_RETRIES):
+            output = [committed]
             try:
                 # 每次重试稍微调整 temperature 增加随机性
                 temperature = 0.7 - (attempt * 0.1)  # 0.7, 0.6, 0.5
                 
-                if attempt > 0:
-                    logger.warning(f"[ICE_AGE/JUDGE] 第 {attempt + 1} 次尝试 (temperature={temperature})")
-                    yield format_sse_event("retry", {"attempt": attempt + 1, "max_retries": MAX_RETRIES})
+                parser = NarrativeStreamParser(structured=protocol >= STRUCTURED_STREAM_PROTOCOL)
+                # 同步解析状态，已发送过的事件不再重复；其中的 content 就是客户端应保留的部分
+                committed_units = sum(
+                    client_units(data["text"]) for event_type, data in parser.feed(committed)
+                    if event_type == "content"
+                )
                 
-                full_text = ""
-                full_response_chunks.clear()  # 清空之前的尝试
+                if attempt > 0:
+                    # 客户端丢弃 offset 之后的内容（不完整的半句）
+                    yield format_sse_event("rewind", {"offset": committed_units, "attempt": attempt + 1})
+                    if committed:
+                        logger.warning(f"[ICE_AGE/JUDGE] 第 {attempt + 1} 次尝试，从已完成的 {len(committed)} 字续写 (temperature={temperature})")
+                        yield format_sse_event("resume", {"attempt": attempt + 1, "max_retries": MAX_RETRIES})
+                    else:
+                        logger.warning(f"[ICE_AGE/JUDGE] 第 {attempt + 1} 次尝试 (temperature={temperature})")
+                        yield format_sse_event("retry", {"attempt": attempt + 1, "max_retries": MAX_RETRIES})
                 
-                async for chunk in llm_service.chat_stream(
+                stream = llm_service.chat_stream(
                     system_prompt=ICE_AGE_JUDGE_SYSTEM_PROMPT,
                     user_prompt=user_prompt,
-                    temperature=temperature
-                ):
-                    full_text += chunk
-                    full_response_chunks.append(chunk)
-                    yield format_sse_event("content", {"text": chunk})
+                    temperature=temperature,
+                    session=token,
+                    label="ice-age/judge",
+                    stop=[JUDGE_STOP_SEQUENCE],
+                    extra_messages=continuation_messages(
+                        committed, ICE_AGE_JUDGE_CONTINUE_PROMPT
+                    ) if committed else None
+                )
+                try:
+                    async for chunk in stream:
+                        output.append(chunk)
+                        for event_type, data in parser.feed(chunk):
+                            yield format_sse_event(event_type, data)
+                        if parser.complete:
+                            # </state_update> 已闭合，提前关闭上游
+                            metrics.incr("llm_early_close_total", role="ice-age/judge")
+                            break
+                finally:
+                    await stream.aclose()
+                
+                for event_type, data in parser.finish():
+                    yield format_sse_event(event_type, data)
                 
                 # 成功完成
-                yield format_sse_event("done", {"full_text": full_text})
+                full_response = "".join(output)
+                yield format_sse_event("done", {"full_text": full_response})
                 
                 # 记录日志
-                full_response = "".join(full_response_chunks)
                 log_api_call("ice-age/judge", request_data, full_response)
                 
                 # 打印AI输出摘要（生产环境也显示）
@@ -270,20 +510,29 @@ async def judge_stream(request: IceAgeJudgeRequest):
                 logger.info("[ICE_AGE/JUDGE] 完成")
                 return  # 成功后退出
                 
+            except asyncio.CancelledError:
+                # 客户端断开且没有重连，生成被中止（上游连接已关闭）
+                logger.info("[ICE_AGE/JUDGE] 客户端已断开，生成中止")
+                log_api_call("ice-age/judge", request_data, "".join(output), error="aborted: client disconnected")
+                raise
             except Exception as e:
                 error_msg = str(e)
                 
                 # 检查是否是内容安全错误
                 is_content_error = "inappropriate content" in error_msg.lower()
                 
-                # 如果是内容安全错误且还有重试次数
-                if is_content_error and attempt < MAX_RETRIES - 1:
-                    logger.warning(f"[ICE_AGE/JUDGE] 内容安全检查失败，准备重试 ({attempt + 1}/{MAX_RETRIES})")
+                # 内容安全错误和上游临时故障（网络、卡顿、5xx、429）且还有重试次数
+                if is_retryable_stream_error(e) and attempt < MAX_RETRIES - 1:
+                    logger.warning(f"[ICE_AGE/JUDGE] 生成中断，准备重试 ({attempt + 1}/{MAX_RETRIES}): {e}")
+                    committed = sentence_prefix("".join(output))
+                    metrics.incr("ice_age_retry_total", endpoint="judge", mode="resume" if committed else "restart")
+                    if not is_content_error:
+                        await asyncio.sleep(RETRY_BACKOFF_SECONDS * (attempt + 1))
                     continue  # 继续下一次重试
                 
-                # 如果不是内容安全错误，或者已达到最大重试次数
+                # 不可重试的错误，或者已达到最大重试次数
                 logger.error(f"[ICE_AGE/JUDGE] 错误: {e}")
-                log_api_call("ice-age/judge", request_data, error=error_msg)
+                log_api_call("ice-age/judge", request_data, "".join(output), error=error_msg)
                 
                 if is_content_error and attempt >= MAX_RETRIES - 1:
                     yield format_sse_event("error", {
@@ -294,21 +543,16 @@ async def judge_stream(request: IceAgeJudgeRequest):
                     yield format_sse_event("error", {"error": error_msg})
                 return
     
-    return StreamingResponse(
-        generate(),
-        media_type="text/event-stream",
-        headers={
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-            "X-Accel-Buffering": "no"
-        }
-    )
+    return replay_registry.start(token, "ice-age/judge", generate(), key=flight, client=http_request)
 
 
 # ==================== 结局接口 ====================
 
 @router.post("/ending")
-async def ending(request: IceAgeEndingRequest):
+async def ending(
+    request: IceAgeEndingRequest,
+    x_game_token: str = Header(None, alias="X-Game-Token")
+):
     """
     结局评价 - 非流式
     """
@@ -330,11 +574,18 @@ async def ending(request: IceAgeEndingRequest):
     )
     
     try:
-        # chat() 方法返回的已经是 dict，无需再次解析
-        response = await llm_service.chat(
-            system_prompt=ICE_AGE_ENDING_SYSTEM_PROMPT,
-            user_prompt=user_prompt,
-            temperature=0.8
+        # chat() 方法返回的已经是 dict，无需再次解析；同一会话的重复请求共享同一次调用
+        response = await single_flight.do(
+            flight_key(x_game_token, "ice-age/ending", request),
+            lambda: llm_service.chat(
+                system_prompt=ICE_AGE_ENDING_SYSTEM_PROMPT,
+                user_prompt=user_prompt,
+                temperature=0.8,
+                hedge=True,
+                session=x_game_token,
+                label="ice-age/ending"
+            ),
+            endpoint="ice-age/ending"
         )
         
         # 记录日志
@@ -1,5 +1,14 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, HTTPException, Query
+from app.core.admission import admission_controller
 from app.core.traffic_control import traffic_controller
+from app.core.waiting_room import waiting_room
+from app.core.log_writer import writers_stats
+from app.core.metrics import metrics
+from app.core.single_flight import single_flight
+from app.core.sse_replay import replay_registry
+from app.core.upstream import upstream_router
+from app.core.usage import usage_tracker
+from app.moderator_service import get_moderator_service
 from app.config import get_settings
 
 router = APIRouter(prefix="/api/system", tags=["System"])
@@ -9,13 +18,77 @@ async def get_user_status():
     """
     返回当前系统的用户限制和活跃用户数
     """
-    settings = get_settings()
-    
-    # 触发一次清理，确保数据准确
-    traffic_controller.cleanup()
+    # 读取时会先回收已过期的会话，数据准确
+    active_users = await traffic_controller.public_count()
+    max_users = traffic_controller.max_public_users
+    waiting_users = await waiting_room.waiting()
     
     return {
-        "max_users": settings.MAX_PUBLIC_USERS,
-        "active_users": traffic_controller.public_count,
-        "status": "ready" if traffic_controller.public_count < settings.MAX_PUBLIC_USERS else "full"
+        "max_users": max_users,
+        "active_users": active_users,
+        "waiting_users": waiting_users,
+        "status": "ready" if active_users < max_users and not waiting_users else "full"
     }
+
+
+@router.get("/admission")
+async def get_admission_stats():
+    """
+    返回自适应准入状态：容量（活跃会话当量）、加权负载、当前名额上限、活跃会话数和各角色进行中的上游调用
+    """
+    settings = get_settings()
+    stats = admission_controller.stats(await traffic_controller.public_count())
+    return {"adaptive": settings.ADMISSION_ADAPTIVE, "max_public_users": traffic_controller.max_public_users, **stats}
+
+
+@router.get("/upstreams")
+async def get_upstream_health():
+    """
+    返回各角色上游端点的健康状态（延迟、错误率、熔断等）
+    """
+    return upstream_router.snapshot()
+
+
+@router.get("/metrics")
+async def get_metrics():
+    """
+    返回运行指标（计数器和延迟分位数）
+    """
+    return metrics.snapshot()
+
+
+@router.get("/moderation")
+async def get_moderation_stats():
+    """
+    返回内容审核的来源统计（预设跳过/缓存命中/LLM 审核）和缓存命中率
+    """
+    return get_moderator_service().stats()
+
+
+@router.get("/usage")
+async def get_usage(session: str = Query(None, description="会话令牌，指定时只返回该会话的用量")):
+    """
+    返回 token 用量统计（按角色、端点聚合，含缓存命中比例和各提示词构建器的体积）
+    """
+    if session:
+        usage = usage_tracker.session(session)
+        if usage is None:
+            raise HTTPException(status_code=404, detail="该会话暂无用量记录")
+        return usage
+    return usage_tracker.snapshot()
+
+
+@router.get("/log-writers")
+async def get_log_writer_stats():
+    """
+    返回后台日志写入器的队列长度、已写入和丢弃条数
+    """
+    return writers_stats()
+
+
+@router.get("/streams")
+async def get_stream_stats():
+    """
+    返回可续传 SSE 流的数量、进行中的生成、订阅者、缓冲占用和正在合并的非流式请求数
+    """
+    return {**replay_registry.stats(), "shared_calls": single_flight.in_flight()}
@@ -0,0 +1,179 @@
+"""
+自适应准入测试：按活跃程度加权的名额上限，以及 AIMD 容量调整（拥塞乘性减小、饱和加性增大、上下限）
+"""
+import time
+from types import SimpleNamespace
+
+import httpx
+import openai
+import pytest
+
+from app.core import admission
+from app.core.admission import AdmissionController
+from app.core.upstream import LLMStallError
+
+INTERVAL = 10.0
+
+
+def status_error(code: int) -> openai.APIStatusError:
+    request = httpx.Request("POST", "http://upstream/v1/chat/completions")
+    return openai.APIStatusError("upstream", response=httpx.Response(code, request=request), body=None)
+
+
+@pytest.fixture
+def settings(monkeypatch):
+    values = SimpleNamespace(
+        ADMISSION_ADAPTIVE=True,
+        MAX_PUBLIC_USERS=10,
+        ADMISSION_MIN_CAPACITY=2.0,
+        ADMISSION_MAX_CAPACITY=20.0,
+        ADMISSION_IDLE_WEIGHT=0.25,
+        ADMISSION_ACTIVE_WINDOW_SECONDS=60.0,
+        ADMISSION_INTERVAL_SECONDS=INTERVAL,
+        ADMISSION_TARGET_TTFT_SECONDS=2.0,
+        ADMISSION_DECREASE_FACTOR=0.5,
+        ADMISSION_INCREASE_STEP=1.0,
+    )
+    monkeypatch.setattr(admission, "get_settings", lambda: values)
+    return values
+
+
+@pytest.fixture
+def controller(settings):
+    return AdmissionController()
+
+
+def end_window(controller: AdmissionController) -> None:
+    """结束当前调整窗口并按窗口内的信号调整一次容量"""
+    controller._update(controller._window_started + INTERVAL)
+
+
+class TestSessionLimit:
+    def test_idle_sessions_weighted(self, controller):
+        # 没有活跃会话时：0 + floor(10 / 0.25)
+        assert controller.session_limit() == 40
+
+    def test_active_sessions_count_fully(self, controller):
+        for session in ("a", "b"):
+            controller.begin("narrator", session)
+        assert controller.active_sessions() == 2
+        assert controller.session_limit() == 2 + 32  # 2 + floor((10 - 2) / 0.25)
+
+    def test_recently_active_sessions_count_until_window_passes(self, controller, settings):
+        controller.begin("narrator", "a")
+        controller.end("narrator", "a")
+        now = time.monotonic()
+        assert controller.active_sessions(now) == 1
+        assert controller.active_sessions(now + settings.ADMISSION_ACTIVE_WINDOW_SECONDS + 1) == 0
+
+    def test_limit_never_below_active(self, controller):
+        for i in range(15):
+            controller.begin("narrator", f"s{i}")
+        assert controller.session_limit() == 15  # 超出容量时不再放行新会话，但已加入的不受影响
+
+    def test_concurrent_calls_of_one_session_count_once(self, controller):
+        controller.begin("narrator", "a")
+        controller.begin("judge", "a")
+        assert controller.active_sessions() == 1
+        controller.end("narrator", "a")
+        assert "a" in controller._session_calls
+        controller.end("judge", "a")
+        assert "a" not in controller._session_calls
+        assert controller.active_sessions() == 1  # 刚结束，仍在活跃窗口内
+
+    def test_mark_active_only_when_adaptive(self, controller, settings):
+        controller.mark_active("a")
+        assert controller.active_sessions() == 1
+        settings.ADMISSION_ADAPTIVE = False
+        controller.mark_active("b")
+        controller.begin("narrator", "c")
+        assert controller.active_sessions() == 1
+
+    def test_load(self, controller):
+        controller.mark_active("a")
+        assert controller.load(online=5) == pytest.approx(1 + 0.25 * 4)
+        assert controller.load(online=0) == 0
+
+
+class TestAIMD:
+    def test_initial_capacity_clamped(self, settings):
+        settings.MAX_PUBLIC_USERS = 100
+        assert AdmissionController().capacity == 20.0
+        settings.MAX_PUBLIC_USERS = 1
+        assert AdmissionController().capacity == 2.0
+
+    @pytest.mark.parametrize("error", [status_error(429), LLMStallError("首 token 超时")])
+    def test_congestion_decreases_multiplicatively(self, controller, error):
+        controller.record_error("narrator", error)
+        end_window(controller)
+        assert controller.capacity == 5.0
+
+    @pytest.mark.parametrize("error", [status_error(500), status_error(401)])
+    def test_other_errors_are_not_congestion(self, controller, error):
+        controller.record_error("narrator", error)
+        end_window(controller)
+        assert controller.capacity == 10.0
+
+    def test_one_decrease_per_window(self, controller):
+        for _ in range(5):
+            controller.record_error("narrator", status_error(429))
+        end_window(controller)
+        assert controller.capacity == 5.0
+        end_window(controller)  # 新窗口没有拥塞信号
+        assert controller.capacity == 5.0
+
+    def test_slow_ttft_decreases(self, controller):
+        controller.record_ttft("narrator", 1.0)
+        controller.record_ttft("narrator", 4.0)  # 平均 2.5s，超过目标 2s
+        controller.record_ttft("judge", 0.5)
+        end_window(controller)
+        assert controller.capacity == 5.0
+
+    def test_fast_ttft_keeps_capacity(self, controller):
+        controller.record_ttft("narrator", 1.9)
+        end_window(controller)
+        assert controller.capacity == 10.0
+
+    def test_saturation_increases_additively(self, controller):
+        controller.mark_saturated()
+        end_window(controller)
+        assert controller.capacity == 11.0
+        end_window(controller)  # 饱和标记只在本窗口有效
+        assert controller.capacity == 11.0
+
+    def test_congestion_wins_over_saturation(self, controller):
+        controller.mark_saturated()
+        controller.record_error("narrator", status_error(429))
+        end_window(controller)
+        assert controller.capacity == 5.0
+
+    def test_clamped_to_bounds(self, controller):
+        for _ in range(10):
+            controller.record_error("narrator", status_error(429))
+            end_window(controller)
+        assert controller.capacity == 2.0
+        for _ in range(50):
+            controller.mark_saturated()
+            end_window(controller)
+        assert controller.capacity == 20.0
+
+    def test_no_adjustment_before_window_ends(self, controller):
+        controller.record_error("narrator", status_error(429))
+        controller._update(controller._window_started + INTERVAL / 2)
+        assert controller.capacity == 10.0
+        end_window(controller)
+        assert controller.capacity == 5.0
+
+    def test_session_limit_follows_capacity(self, controller, settings):
+        settings.ADMISSION_INTERVAL_SECONDS = 0  # 每次读取名额上限都结束一个窗口
+        controller.record_error("narrator", status_error(429))
+        assert controller.session_limit() == 20  # floor(5 / 0.25)
+
+
+def test_activity_tracking_pruned(controller, settings):
+    settings.ADMISSION_ACTIVE_WINDOW_SECONDS = 0.0
+    for i in range(100):
+        controller.mark_active(f"s{i}")
+    time.sleep(0.001)
+    controller.mark_active("last")
+    assert len(controller._last_active) <= 2
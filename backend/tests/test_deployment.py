@@ -0,0 +1,41 @@
+"""
+部署检查测试：共享会话存储必须声明部署方式，多 worker 时不能使用进程内的会话和自适应准入
+"""
+from types import SimpleNamespace
+
+import pytest
+
+from app.core.deployment import check_deployment
+
+
+def settings(**values):
+    defaults = {"WORKER_ROUTING": "", "SESSION_STORE": "memory", "ADMISSION_ADAPTIVE": False}
+    return SimpleNamespace(**{**defaults, **values})
+
+
+@pytest.mark.parametrize("values", [
+    {},
+    {"ADMISSION_ADAPTIVE": True},
+    {"SESSION_STORE": "sqlite", "WORKER_ROUTING": "single", "ADMISSION_ADAPTIVE": True},
+    {"SESSION_STORE": "redis", "WORKER_ROUTING": "sticky"},
+])
+def test_consistent_deployments_start(values, monkeypatch):
+    monkeypatch.delenv("WEB_CONCURRENCY", raising=False)
+    check_deployment(settings(**values))
+
+
+@pytest.mark.parametrize("values, workers", [
+    ({"SESSION_STORE": "sqlite"}, None),  # 共享存储但没有声明部署方式
+    ({"SESSION_STORE": "memory"}, "4"),  # 多 worker 却用进程内会话
+    ({"SESSION_STORE": "sqlite", "WORKER_ROUTING": "single"}, "2"),
+    ({"SESSION_STORE": "memory", "WORKER_ROUTING": "sticky"}, None),
+    ({"SESSION_STORE": "redis", "WORKER_ROUTING": "sticky", "ADMISSION_ADAPTIVE": True}, None),
+    ({"WORKER_ROUTING": "round-robin"}, None),
+])
+def test_inconsistent_deployments_refuse_to_start(values, workers, monkeypatch):
+    if workers is None:
+        monkeypatch.delenv("WEB_CONCURRENCY", raising=False)
+    else:
+        monkeypatch.setenv("WEB_CONCURRENCY", workers)
+    with pytest.raises(RuntimeError):
+        check_deployment(settings(**values))
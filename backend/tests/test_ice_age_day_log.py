@@ -0,0 +1,48 @@
+"""
+冰河末世单日日志解析测试：字段缺失或类型错误时使用默认值，只有 JSON 本身损坏才报错
+"""
+import json
+
+from app.routers.ice_age import parse_day_log
+
+
+def dumps(data: dict) -> str:
+    return json.dumps(data, ensure_ascii=False)
+
+
+def test_complete_log():
+    log = parse_day_log(dumps({
+        "day": 3, "temperature": -40, "narration": "暴雪。", "has_crisis": True,
+        "choices": [{"text": "A. 出门", "risk": "High"}, {"text": "B. 等待"}],
+        "state_update": {"hp": -5}, "item_changes": {"remove": [{"name": "木柴", "count": 2}]},
+    }), expected_day=3)
+    assert log["day"] == 3 and log["has_crisis"]
+    assert log["choices"] == [{"text": "A. 出门", "risk": "High"}, {"text": "B. 等待", "risk": "Medium"}]
+    assert log["state_update"] == {"hp": -5, "san": 0}
+    assert log["item_changes"]["remove"] == [{"name": "木柴", "count": 2}]
+
+
+def test_missing_day_uses_expected():
+    assert parse_day_log(dumps({"narration": "平静的一天。"}), expected_day=7)["day"] == 7
+
+
+def test_invalid_fields_fall_back_to_defaults():
+    log = parse_day_log(dumps({
+        "day": 2, "temperature": "零下四十度", "narration": "风很大。",
+        "choices": ["A. 加固窗户", {"risk": "Low"}, {"text": "C. 睡觉"}],
+        "item_changes": {"add": [{"name": "罐头", "count": "两个"}, {"name": "火柴", "count": 1}]},
+        "new_hidden_tags": "冻伤",
+    }), expected_day=2)
+    assert "error" not in log
+    assert log["temperature"] is None
+    assert log["narration"] == "风很大。"
+    assert [c["text"] for c in log["choices"]] == ["A. 加固窗户", "C. 睡觉"]
+    assert log["item_changes"]["add"] == [{"name": "火柴", "count": 1}]
+    assert log["new_hidden_tags"] == []
+
+
+def test_broken_json_returns_raw():
+    body = '{"day": 4, "narration": "没写完'
+    log = parse_day_log(body, expected_day=4)
+    assert "error" in log and log["raw"] == body
+    assert "error" in parse_day_log("[1, 2]", expected_day=4)
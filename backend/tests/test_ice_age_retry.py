@@ -0,0 +1,108 @@
+"""
+冰河末世流式重试测试：中途失败后 rewind 的 offset 与客户端实际收到的 content 对齐
+"""
+import asyncio
+import json
+
+import httpx
+import pytest
+
+from app.core.upstream import LLMStallError
+from app.main import app
+from app.routers import ice_age
+
+STATE = '<state_update>{"hp_change": 0}</state_update>'
+DAY_1 = '<day_log>{"day": 1, "narration": "雪停了。"}</day_log>'
+DAY_2 = '<day_log>{"day": 2, "narration": "又冷了😀。"}</day_log>'
+
+
+class ScriptedLLM:
+    """按顺序返回预设的输出，每次尝试可以在输出之后抛出错误"""
+
+    def __init__(self, *attempts: tuple[list[str], Exception | None]):
+        self.attempts = list(attempts)
+        self.calls = []
+
+    def chat_stream(self, **kwargs):
+        self.calls.append(kwargs)
+        chunks, error = self.attempts.pop(0)
+
+        async def stream():
+            for chunk in chunks:
+                yield chunk
+            if error is not None:
+                raise error
+
+        return stream()
+
+
+@pytest.fixture
+def llm(monkeypatch):
+    holder = {}
+    monkeypatch.setattr(ice_age, "get_llm_service", lambda: holder["llm"])
+    monkeypatch.setattr(ice_age, "log_api_call", lambda *args, **kwargs: None)
+    monkeypatch.setattr(ice_age, "RETRY_BACKOFF_SECONDS", 0)
+
+    def install(*attempts):
+        holder["llm"] = ScriptedLLM(*attempts)
+        return holder["llm"]
+
+    return install
+
+
+def post_events(path: str, body: dict, protocol: int) -> list[dict]:
+    async def run():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://t") as client:
+            response = await client.post(path, params={"protocol": protocol}, json=body)
+            return response.text
+
+    text = asyncio.run(run())
+    return [
+        json.loads(line[len("data: "):])
+        for block in text.split("\n\n") for line in block.split("\n")
+        if line.startswith("data: ")
+    ]
+
+
+def client_text(events: list[dict]) -> str:
+    """按浏览器的方式拼接 content，rewind 时按 UTF-16 码元截断"""
+    text = ""
+    for event in events:
+        if event["type"] == "content":
+            text += event["text"]
+        elif event["type"] == "rewind":
+            text = text.encode("utf-16-le")[:event["offset"] * 2].decode("utf-16-le")
+    return text
+
+
+@pytest.mark.parametrize("protocol", [1, 2])
+def test_judge_rewind_keeps_sent_sentences(llm, protocol):
+    llm(
+        (["你推开门😀。<notes>谨", "慎</notes>外面很"], LLMStallError("stall")),
+        (["冷。", STATE], None),
+    )
+    events = post_events("/api/ice-age/judge/stream", {
+        "day": 3, "temperature": -30, "event_context": "敲门声", "action_content": "A. 开门", "stats": {},
+    }, protocol)
+    rewind = next(e for e in events if e["type"] == "rewind")
+    assert rewind["offset"] == 7  # 😀 在客户端占两个码元
+    expected = "你推开门😀。冷。" if protocol >= 2 else "你推开门😀。冷。" + STATE
+    assert client_text(events) == expected
+    assert events[-1]["type"] == "done"
+
+
+@pytest.mark.parametrize("protocol", [1, 2])
+def test_narrate_rewind_drops_unfinished_day(llm, protocol):
+    scripted = llm(
+        ([DAY_1 + '<day_log>{"day": 2, "narr'], LLMStallError("stall")),
+        ([DAY_2], None),
+    )
+    events = post_events("/api/ice-age/narrate-batch/stream", {
+        "start_day": 1, "days_to_generate": 2, "stats": {"hp": 100, "san": 100},
+    }, protocol)
+    rewind = next(e for e in events if e["type"] == "rewind")
+    assert rewind["offset"] == (len(DAY_1) if protocol < 2 else 0)  # protocol>=2 时没有下发 content
+    assert client_text(events) == ("" if protocol >= 2 else DAY_1 + DAY_2)
+    assert [e["day"] for e in events if e["type"] == "day"] == [1, 2]
+    assert scripted.calls[1]["extra_messages"][0]["content"] == DAY_1
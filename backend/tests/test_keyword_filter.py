@@ -0,0 +1,133 @@
+"""
+关键词预审核测试：Aho–Corasick 匹配结果与逐个查找一致，黑白名单判定和词表热加载
+"""
+import os
+import random
+
+import pytest
+
+from app.core.keyword_filter import AhoCorasick, KeywordFilter
+from app.moderator_service import normalize_text
+
+
+def brute_force(patterns: list[str], text: str) -> list[tuple[int, str]]:
+    """逐个模式串查找全部（可重叠的）出现位置；重复的模式串各自计一次，与自动机一致"""
+    matches = []
+    for pattern in patterns:
+        start = text.find(pattern)
+        while start != -1:
+            matches.append((start, pattern))
+            start = text.find(pattern, start + 1)
+    return sorted(matches)
+
+
+class TestAhoCorasick:
+    def test_overlapping_and_nested_patterns(self):
+        automaton = AhoCorasick(["he", "she", "his", "hers"])
+        assert sorted(automaton.find_all("ushers")) == [(1, "she"), (2, "he"), (2, "hers")]
+
+    def test_chinese_patterns(self):
+        automaton = AhoCorasick(["丧尸", "尸群", "丧尸群"])
+        assert sorted(automaton.find_all("一大波丧尸群")) == [(3, "丧尸"), (3, "丧尸群"), (4, "尸群")]
+
+    def test_empty_patterns_ignored(self):
+        automaton = AhoCorasick(["", "ab"])
+        assert automaton.find_all("xab") == [(1, "ab")]
+        assert AhoCorasick([]).find_all("任何文本") == []
+
+    def test_matches_brute_force_on_random_text(self):
+        rng = random.Random(7)
+        alphabet = "abc"
+        for _ in range(200):
+            patterns = ["".join(rng.choices(alphabet, k=rng.randint(1, 4))) for _ in range(rng.randint(1, 6))]
+            text = "".join(rng.choices(alphabet, k=rng.randint(0, 30)))
+            assert sorted(AhoCorasick(patterns).find_all(text)) == brute_force(patterns, text), (patterns, text)
+
+
+@pytest.fixture
+def lists(tmp_path):
+    block = tmp_path / "blocklist.txt"
+    allow = tmp_path / "allowlist.txt"
+    block.write_text("# 注释行不是词\n违禁词\n\nBad Word\n", encoding="utf-8")
+    allow.write_text("躲起来\n逃跑\n", encoding="utf-8")
+    return block, allow
+
+
+def make_filter(lists, check_interval: float = 0.0) -> KeywordFilter:
+    block, allow = lists
+    return KeywordFilter(block, allow, normalize=normalize_text, check_interval=check_interval)
+
+
+def decide(keyword_filter: KeywordFilter, text: str) -> str:
+    return keyword_filter.check(text, trivial_length=2, allow_coverage=0.9).decision
+
+
+def rewrite(path, content: str) -> None:
+    """改写词表并推进修改时间（避免同一时间戳内的两次写入被当作未变化）"""
+    stat = path.stat()
+    path.write_text(content, encoding="utf-8")
+    os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+
+
+class TestKeywordFilter:
+    def test_blocklist_hit(self, lists):
+        keyword_filter = make_filter(lists)
+        verdict = keyword_filter.check("我要说违禁词", trivial_length=2, allow_coverage=0.9)
+        assert verdict.decision == "block"
+        assert verdict.hits == ["违禁词"]
+
+    def test_normalization_defeats_spacing_and_width(self, lists):
+        keyword_filter = make_filter(lists)
+        assert decide(keyword_filter, "违 禁，词") == "block"
+        assert decide(keyword_filter, "ＢＡＤ-word!") == "block"
+
+    def test_comments_are_not_patterns(self, lists):
+        assert decide(make_filter(lists), "这是注释行不是词吗") == "unknown"
+
+    def test_trivial_input_allowed_unless_blocked(self, lists):
+        keyword_filter = make_filter(lists)
+        assert decide(keyword_filter, "好的") == "allow"
+        assert decide(keyword_filter, "？？") == "allow"  # 归一化后为空
+        assert decide(keyword_filter, "我去看看") == "unknown"
+
+    def test_allow_coverage(self, lists):
+        keyword_filter = make_filter(lists)
+        assert decide(keyword_filter, "躲起来，逃跑！") == "allow"
+        assert decide(keyword_filter, "躲起来然后放一把火") == "unknown"
+        assert keyword_filter.check("躲起来逃跑", trivial_length=2, allow_coverage=0).decision == "unknown"
+
+    def test_missing_lists_are_empty(self, tmp_path):
+        keyword_filter = KeywordFilter(tmp_path / "无", tmp_path / "无2", normalize=normalize_text)
+        assert keyword_filter.stats()["blocklist_size"] == 0
+        assert decide(keyword_filter, "随便说点什么") == "unknown"
+
+
+class TestHotReload:
+    def test_modified_list_reloaded(self, lists):
+        block, _ = lists
+        keyword_filter = make_filter(lists)
+        assert decide(keyword_filter, "新的敏感词出现了") == "unknown"
+        rewrite(block, "违禁词\n敏感词\n")
+        assert decide(keyword_filter, "新的敏感词出现了") == "block"
+        assert keyword_filter.stats()["blocklist_size"] == 2
+
+    def test_removed_word_no_longer_blocks(self, lists):
+        block, _ = lists
+        keyword_filter = make_filter(lists)
+        rewrite(block, "# 清空\n")
+        assert decide(keyword_filter, "我要说违禁词") == "unknown"
+
+    def test_deleted_list_becomes_empty(self, lists):
+        block, _ = lists
+        keyword_filter = make_filter(lists)
+        block.unlink()
+        assert decide(keyword_filter, "我要说违禁词") == "unknown"
+
+    def test_reload_throttled_by_check_interval(self, lists):
+        block, _ = lists
+        keyword_filter = make_filter(lists, check_interval=3600.0)
+        decide(keyword_filter, "先检查一次")
+        rewrite(block, "违禁词\n敏感词\n")
+        assert decide(keyword_filter, "新的敏感词出现了") == "unknown"  # 检查间隔内不读文件
+        keyword_filter.reload()
+        assert decide(keyword_filter, "新的敏感词出现了") == "block"
@@ -0,0 +1,305 @@
+"""
+LLM 服务测试：对冲请求的触发时机和胜出方，流式调用的首 token 超时重启和中途卡顿
+上游客户端用按调用顺序执行的脚本替代，每一步可以指定延迟、返回内容或抛出的异常
+"""
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from app import llm_service as llm_module
+from app.config import get_settings
+from app.core.admission import admission_controller
+from app.core.metrics import metrics
+from app.core.upstream import EndpointPool, LLMStallError, UpstreamEndpoint
+from app.core.usage import usage_tracker
+from app.llm_service import LLMService
+
+HEDGE_DELAY = 0.05
+STREAM_TIMEOUT = 0.1
+
+
+class Step:
+    """一次上游调用的行为"""
+
+    def __init__(self, delay: float = 0.0, content: str = '{"ok": true}', error: BaseException | None = None):
+        self.delay = delay
+        self.content = content
+        self.error = error
+
+
+class FakeUpstream:
+    """按调用顺序取出 Step 执行，并记录每次调用落在哪个端点、是否被取消"""
+
+    def __init__(self, *steps: Step):
+        self.steps = list(steps)
+        self.calls: list[str] = []
+        self.cancelled: list[str] = []
+
+    def client(self, endpoint: UpstreamEndpoint):
+        async def create(**kwargs):
+            step = self.steps.pop(0)
+            self.calls.append(endpoint.name)
+            try:
+                await asyncio.sleep(step.delay)
+            except asyncio.CancelledError:
+                self.cancelled.append(endpoint.name)
+                raise
+            if step.error is not None:
+                raise step.error
+            message = SimpleNamespace(content=step.content)
+            return SimpleNamespace(choices=[SimpleNamespace(message=message, finish_reason="stop")], usage=None)
+
+        return SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+
+
+def chunk(text: str) -> SimpleNamespace:
+    delta = SimpleNamespace(content=text)
+    return SimpleNamespace(usage=None, choices=[SimpleNamespace(delta=delta, finish_reason=None)])
+
+
+class FakeStream:
+    """按 (延迟, 文本) 依次产出 chunk 的流"""
+
+    def __init__(self, chunks: list[tuple[float, str]]):
+        self.chunks = list(chunks)
+        self.closed = False
+
+    async def __anext__(self):
+        if not self.chunks:
+            raise StopAsyncIteration
+        delay, text = self.chunks.pop(0)
+        await asyncio.sleep(delay)
+        return chunk(text)
+
+    async def close(self):
+        self.closed = True
+
+
+class FakeStreamUpstream:
+    """按调用顺序返回 FakeStream（或抛出异常），记录每次调用落在哪个端点"""
+
+    def __init__(self, *streams: FakeStream | BaseException):
+        self.streams = list(streams)
+        self.calls: list[str] = []
+
+    def client(self, endpoint: UpstreamEndpoint):
+        async def create(**kwargs):
+            self.calls.append(endpoint.name)
+            stream = self.streams.pop(0)
+            if isinstance(stream, BaseException):
+                raise stream
+            return stream
+
+        return SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+
+
+def make_pool() -> EndpointPool:
+    return EndpointPool("judge", [
+        UpstreamEndpoint("judge", name, "key", f"http://{name}/v1", "model", 1.0) for name in "ab"
+    ])
+
+
+@pytest.fixture(autouse=True)
+def clean_state():
+    metrics.reset()
+    usage_tracker.reset()
+    admission_controller.reset()
+    yield
+    metrics.reset()
+    usage_tracker.reset()
+    admission_controller.reset()
+
+
+@pytest.fixture
+def service(monkeypatch):
+    """不连接真实上游的服务实例，对冲延迟固定为 HEDGE_DELAY"""
+    pool = make_pool()
+    monkeypatch.setattr(llm_module, "upstream_router", SimpleNamespace(get_pool=lambda role: pool))
+    instance = LLMService.__new__(LLMService)
+    instance.settings = get_settings().model_copy(update={
+        "llm_context_sample_rate": 0.0,
+        "llm_session_affinity": False,
+        "llm_failover_attempts": 2,
+        "llm_hedge_enabled": True,
+        "llm_hedge_min_samples": 3,
+        "llm_hedge_default_delay": HEDGE_DELAY,
+        "llm_hedge_min_delay": HEDGE_DELAY,
+        "llm_hedge_max_delay": HEDGE_DELAY,
+        "llm_ttft_timeout": STREAM_TIMEOUT,
+        "llm_stall_timeout": STREAM_TIMEOUT,
+        "llm_stream_usage": False,
+    })
+    instance._clients = {}
+    instance._http_client = None
+    return instance
+
+
+def run_json(service: LLMService, upstream: FakeUpstream, monkeypatch) -> dict:
+    monkeypatch.setattr(service, "_get_client", upstream.client)
+    return asyncio.run(service.chat_json("system", "user", role="judge", hedge=True))
+
+
+def run_stream(service: LLMService, upstream: FakeStreamUpstream, monkeypatch, received: list[str]) -> None:
+    """把收到的文本块依次追加到 received（抛出异常时保留已收到的部分）"""
+    monkeypatch.setattr(service, "_get_client", upstream.client)
+
+    async def run():
+        async for text in service.chat_stream("system", "user", role="judge"):
+            received.append(text)
+
+    asyncio.run(run())
+
+
+class TestHedgeDelay:
+    def test_default_until_enough_samples(self, service):
+        service.settings.llm_hedge_min_delay = 0.1
+        service.settings.llm_hedge_max_delay = 10.0
+        service.settings.llm_hedge_default_delay = 3.0
+        metrics.observe("llm_json_latency_seconds", 1.0, role="judge")
+        assert service._hedge_delay("judge") == 3.0
+
+    def test_percentile_of_recent_latency(self, service):
+        service.settings.llm_hedge_min_delay = 0.1
+        service.settings.llm_hedge_max_delay = 10.0
+        service.settings.llm_hedge_default_delay = 3.0
+        service.settings.llm_hedge_percentile = 95.0
+        for latency in (1.0, 2.0, 4.0):
+            metrics.observe("llm_json_latency_seconds", latency, role="judge")
+        assert service._hedge_delay("judge") == 4.0
+        assert service._hedge_delay("narrator") == 3.0  # 按角色分开统计
+
+    def test_clamped_to_bounds(self, service):
+        service.settings.llm_hedge_min_delay = 0.5
+        service.settings.llm_hedge_max_delay = 2.0
+        for latency in (0.01, 0.01, 0.01):
+            metrics.observe("llm_json_latency_seconds", latency, role="judge")
+        assert service._hedge_delay("judge") == 0.5
+        for latency in (30.0, 30.0, 30.0, 30.0):
+            metrics.observe("llm_json_latency_seconds", latency, role="judge")
+        assert service._hedge_delay("judge") == 2.0
+
+
+class TestHedgedChatJson:
+    def test_fast_primary_does_not_hedge(self, service, monkeypatch):
+        upstream = FakeUpstream(Step(delay=0.0, content='{"winner": "primary"}'))
+        assert run_json(service, upstream, monkeypatch) == {"winner": "primary"}
+        assert len(upstream.calls) == 1
+        assert metrics.get("llm_hedge_eligible_total", role="judge") == 1
+        assert metrics.get("llm_hedge_fired_total", role="judge") == 0
+
+    def test_slow_primary_hedged_to_other_endpoint(self, service, monkeypatch):
+        upstream = FakeUpstream(
+            Step(delay=5.0, content='{"winner": "primary"}'),
+            Step(delay=0.0, content='{"winner": "hedge"}'),
+        )
+        assert run_json(service, upstream, monkeypatch) == {"winner": "hedge"}
+        assert sorted(upstream.calls) == ["a", "b"]  # 对冲请求发往另一个端点
+        assert upstream.cancelled == [upstream.calls[0]]  # 落后的首个请求被取消
+        assert metrics.get("llm_hedge_fired_total", role="judge") == 1
+        assert metrics.get("llm_hedge_wins_total", role="judge", winner="hedge") == 1
+
+    def test_hedge_fires_after_delay(self, service, monkeypatch):
+        upstream = FakeUpstream(Step(delay=5.0), Step(delay=0.0))
+        fired_at = []
+
+        async def run():
+            loop = asyncio.get_running_loop()
+            started = loop.time()
+            original = upstream.client
+
+            def client(endpoint):
+                fired_at.append(loop.time() - started)
+                return original(endpoint)
+
+            monkeypatch.setattr(service, "_get_client", client)
+            return await service.chat_json("system", "user", role="judge", hedge=True)
+
+        asyncio.run(run())
+        primary, hedge = fired_at
+        assert primary < HEDGE_DELAY
+        assert HEDGE_DELAY <= hedge < 1.0
+
+    def test_invalid_hedge_lets_primary_win(self, service, monkeypatch):
+        upstream = FakeUpstream(
+            Step(delay=0.2, content='{"winner": "primary"}'),
+            Step(delay=0.0, content="不是 JSON"),
+        )
+        assert run_json(service, upstream, monkeypatch) == {"winner": "primary"}
+        assert upstream.cancelled == []
+        assert metrics.get("llm_hedge_wins_total", role="judge", winner="primary") == 1
+
+    def test_both_fail_raises_first_error(self, service, monkeypatch):
+        upstream = FakeUpstream(Step(delay=0.2, content=""), Step(delay=0.0, content="不是 JSON"))
+        with pytest.raises(ValueError, match="JSON解析失败"):
+            run_json(service, upstream, monkeypatch)
+
+    def test_hedge_disabled_sends_single_request(self, service, monkeypatch):
+        service.settings.llm_hedge_enabled = False
+        upstream = FakeUpstream(Step(delay=0.2, content=json.dumps({"winner": "primary"})))
+        assert run_json(service, upstream, monkeypatch) == {"winner": "primary"}
+        assert len(upstream.calls) == 1
+        assert metrics.get("llm_hedge_eligible_total", role="judge") == 0
+
+
+class TestStreamRestart:
+    def test_ttft_timeout_restarts_on_other_endpoint(self, service, monkeypatch):
+        slow = FakeStream([(5.0, "迟到的")])
+        fast = FakeStream([(0.0, "你推开"), (0.0, "了门。")])
+        upstream = FakeStreamUpstream(slow, fast)
+        received = []
+        run_stream(service, upstream, monkeypatch, received)
+        assert received == ["你推开", "了门。"]
+        assert sorted(upstream.calls) == ["a", "b"]
+        assert slow.closed and fast.closed
+        assert metrics.get("llm_stall_total", role="judge", endpoint=upstream.calls[0], phase="ttft") == 1
+
+    def test_ttft_budget_includes_connect_time(self, service, monkeypatch):
+        # 建立连接和等待首个 chunk 共用同一个首 token 超时预算
+        half = STREAM_TIMEOUT * 0.6
+
+        class SlowConnect(FakeStreamUpstream):
+            def client(self, endpoint):
+                inner = super().client(endpoint)
+
+                async def create(**kwargs):
+                    await asyncio.sleep(half)
+                    return await inner.chat.completions.create(**kwargs)
+
+                return SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+
+        upstream = SlowConnect(FakeStream([(half, "超时")]), FakeStream([(0.0, "重启")]))
+        received = []
+        run_stream(service, upstream, monkeypatch, received)
+        assert received == ["重启"]
+
+    def test_retryable_error_before_first_token_fails_over(self, service, monkeypatch):
+        upstream = FakeStreamUpstream(LLMStallError("连接失败"), FakeStream([(0.0, "正常")]))
+        received = []
+        run_stream(service, upstream, monkeypatch, received)
+        assert received == ["正常"]
+        assert len(upstream.calls) == 2
+
+    def test_all_attempts_time_out(self, service, monkeypatch):
+        upstream = FakeStreamUpstream(FakeStream([(5.0, "a")]), FakeStream([(5.0, "b")]))
+        with pytest.raises(LLMStallError, match="首 token 超时"):
+            run_stream(service, upstream, monkeypatch, [])
+        assert len(upstream.calls) == service.settings.llm_failover_attempts
+
+    def test_stall_after_first_token_is_not_restarted(self, service, monkeypatch):
+        stalled = FakeStream([(0.0, "你推开"), (5.0, "了门。")])
+        upstream = FakeStreamUpstream(stalled, FakeStream([(0.0, "不应被调用")]))
+        received = []
+        with pytest.raises(LLMStallError, match="上游输出中断"):
+            run_stream(service, upstream, monkeypatch, received)
+        assert received == ["你推开"]  # 已转发的内容无法透明重启
+        assert len(upstream.calls) == 1
+        assert stalled.closed
+        assert metrics.get("llm_stall_total", role="judge", endpoint=upstream.calls[0], phase="gap") == 1
+
+    def test_slow_but_steady_stream_is_not_a_stall(self, service, monkeypatch):
+        steady = FakeStream([(STREAM_TIMEOUT / 2, str(i)) for i in range(5)])
+        received = []
+        run_stream(service, FakeStreamUpstream(steady), monkeypatch, received)
+        assert received == ["0", "1", "2", "3", "4"]  # 总时长超过超时，但每个间隔都在限制内
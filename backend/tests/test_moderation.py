@@ -0,0 +1,184 @@
+"""
+内容审核测试：审核结论缓存（归一化、LRU、TTL）和预设选项跳过审核
+LLM 审核用记录调用次数的假服务替代，词表使用临时文件
+"""
+import asyncio
+
+import pytest
+
+from app import moderator_service as moderator_module
+from app.config import get_settings
+from app.core.metrics import metrics
+from app.moderator_service import ModeratorService, extract_preset_choices, is_preset_choice
+
+NARRATIVE = "尸群正在撞门。\n<options>\nA. 从窗户逃走\nB. 加固大门\nC. 躲进地下室\nD. 拿刀正面迎战\n</options>"
+
+
+class FakeLLM:
+    """按输入内容返回审核结论，记录被审核的输入"""
+
+    def __init__(self):
+        self.reviewed: list[str] = []
+        self.unsafe: set[str] = set()
+        self.error: Exception | None = None
+
+    async def chat_json(self, system_prompt: str, user_prompt: str, **kwargs) -> dict:
+        text = user_prompt.split("<user_input>", 1)[1].split("</user_input>", 1)[0]
+        self.reviewed.append(text)
+        if self.error is not None:
+            raise self.error
+        if text in self.unsafe:
+            return {"is_safe": False, "reason": "暴力"}
+        return {"is_safe": True, "reason": ""}
+
+
+@pytest.fixture
+def llm():
+    return FakeLLM()
+
+
+@pytest.fixture
+def settings(tmp_path):
+    (tmp_path / "blocklist.txt").write_text("# 测试黑名单\n违禁词\n", encoding="utf-8")
+    (tmp_path / "allowlist.txt").write_text("", encoding="utf-8")
+    return get_settings().model_copy(update={
+        "moderation_blocklist_path": str(tmp_path / "blocklist.txt"),
+        "moderation_allowlist_path": str(tmp_path / "allowlist.txt"),
+        "moderation_cache_size": 16,
+        "moderation_cache_ttl": 3600.0,
+        "moderation_skip_presets": True,
+        "moderation_trivial_length": 2,
+        "moderation_allow_coverage": 0.9,
+    })
+
+
+@pytest.fixture
+def moderator(monkeypatch, llm, settings):
+    metrics.reset()
+    monkeypatch.setattr(moderator_module, "get_llm_service", lambda: llm)
+    monkeypatch.setattr(moderator_module, "get_settings", lambda: settings)
+    yield ModeratorService()
+    metrics.reset()
+
+
+def check(moderator: ModeratorService, text: str, presets: list[str] | None = None):
+    return asyncio.run(moderator.check_content(text, preset_choices=presets))
+
+
+def source_count(source: str) -> int:
+    return int(metrics.get("moderation_requests_total", source=source))
+
+
+class TestModerationCache:
+    def test_repeated_input_reviewed_once(self, moderator, llm):
+        assert check(moderator, "我去仓库找点吃的").is_safe
+        assert check(moderator, "我去仓库找点吃的").is_safe
+        assert llm.reviewed == ["我去仓库找点吃的"]
+        assert source_count("llm") == 1
+        assert source_count("cache") == 1
+
+    def test_normalized_variants_hit_cache(self, moderator, llm):
+        check(moderator, "Go to the ROOF")
+        for variant in ("go to the roof", "Ｇｏ ｔｏ ｔｈｅ ｒｏｏｆ！", "go,to the-roof..."):
+            assert check(moderator, variant).is_safe
+        assert len(llm.reviewed) == 1
+
+    def test_unsafe_verdict_cached(self, moderator, llm):
+        llm.unsafe.add("一段违规描写")
+        first = check(moderator, "一段违规描写")
+        second = check(moderator, "一段违规描写")
+        assert not first.is_safe and not second.is_safe
+        assert second.reason == "暴力"
+        assert len(llm.reviewed) == 1
+
+    def test_lru_evicts_least_recently_used(self, moderator, llm, settings):
+        settings.moderation_cache_size = 2
+        check(moderator, "输入甲甲")
+        check(moderator, "输入乙乙")
+        check(moderator, "输入甲甲")  # 命中，甲变为最近使用
+        check(moderator, "输入丙丙")  # 淘汰乙
+        check(moderator, "输入甲甲")
+        check(moderator, "输入乙乙")
+        assert llm.reviewed == ["输入甲甲", "输入乙乙", "输入丙丙", "输入乙乙"]
+
+    def test_expired_entry_reviewed_again(self, moderator, llm, settings):
+        settings.moderation_cache_ttl = -1
+        check(moderator, "我去仓库找点吃的")
+        check(moderator, "我去仓库找点吃的")
+        assert len(llm.reviewed) == 2
+        assert len(moderator._cache) == 1  # 过期条目被新结论替换
+
+    def test_cache_disabled(self, moderator, llm, settings):
+        settings.moderation_cache_size = 0
+        check(moderator, "我去仓库找点吃的")
+        check(moderator, "我去仓库找点吃的")
+        assert len(llm.reviewed) == 2
+
+    def test_llm_error_allows_without_caching(self, moderator, llm):
+        llm.error = RuntimeError("上游不可用")
+        assert check(moderator, "我去仓库找点吃的").is_safe
+        llm.error = None
+        check(moderator, "我去仓库找点吃的")
+        assert len(llm.reviewed) == 2
+
+
+class TestPresetBypass:
+    def test_extract_options_block_and_legacy_format(self):
+        expected = ["A. 从窗户逃走", "B. 加固大门", "C. 躲进地下室", "D. 拿刀正面迎战"]
+        assert extract_preset_choices(NARRATIVE) == expected
+        legacy = "尸群正在撞门。\n---\nA. 从窗户逃走\nB. 加固大门\nC. 躲进地下室\nD. 拿刀正面迎战\n"
+        assert extract_preset_choices(legacy) == expected
+        assert extract_preset_choices("") == []
+
+    def test_is_preset_choice(self):
+        choices = extract_preset_choices(NARRATIVE)
+        assert is_preset_choice("B. 加固大门", choices)
+        assert is_preset_choice("加固大门", choices)
+        assert is_preset_choice("b、加固大门！", choices)
+        assert not is_preset_choice("加固大门然后放火", choices)
+        assert not is_preset_choice("", choices)
+
+    def test_issued_preset_skips_review(self, moderator, llm):
+        moderator.remember_presets("s1", NARRATIVE)
+        presets = moderator.issued_presets("s1")
+        assert check(moderator, "B. 加固大门", presets).is_safe
+        assert check(moderator, "从窗户逃走", presets).is_safe
+        assert llm.reviewed == []
+        assert source_count("preset") == 2
+
+    def test_free_input_still_reviewed(self, moderator, llm):
+        moderator.remember_presets("s1", NARRATIVE)
+        check(moderator, "我决定和尸群谈判", moderator.issued_presets("s1"))
+        assert llm.reviewed == ["我决定和尸群谈判"]
+
+    def test_presets_are_per_session(self, moderator, llm):
+        moderator.remember_presets("s1", NARRATIVE)
+        assert moderator.issued_presets("s2") == []
+        assert moderator.issued_presets(None) == []
+        check(moderator, "B. 加固大门", moderator.issued_presets("s2"))
+        assert llm.reviewed == ["B. 加固大门"]
+
+    def test_narrative_without_options_clears_presets(self, moderator):
+        moderator.remember_presets("s1", NARRATIVE)
+        moderator.remember_presets("s1", "这一回合没有选项。")
+        assert moderator.issued_presets("s1") == []
+
+    def test_presets_expire_with_session(self, moderator, settings):
+        settings.SESSION_TIMEOUT_SECONDS = -1
+        moderator.remember_presets("s1", NARRATIVE)
+        assert moderator.issued_presets("s1") == []
+        assert "s1" not in moderator._presets
+
+    def test_blocklist_checked_before_presets(self, moderator, llm):
+        moderator.remember_presets("s1", NARRATIVE.replace("拿刀正面迎战", "用违禁词正面迎战"))
+        result = check(moderator, "D. 用违禁词正面迎战", moderator.issued_presets("s1"))
+        assert not result.is_safe
+        assert source_count("keyword_block") == 1
+        assert source_count("preset") == 0
+        assert llm.reviewed == []
+
+    def test_skip_presets_disabled(self, moderator, llm, settings):
+        settings.moderation_skip_presets = False
+        moderator.remember_presets("s1", NARRATIVE)
+        check(moderator, "B. 加固大门", moderator.issued_presets("s1"))
+        assert llm.reviewed == ["B. 加固大门"]
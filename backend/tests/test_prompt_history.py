@@ -0,0 +1,22 @@
+"""
+历史窗口测试：对齐后的窗口不超过 max_days，且只在块边界跳动
+"""
+import pytest
+
+from app.prompts.common import recent_window
+
+
+@pytest.mark.parametrize("max_days", [1, 2, 5, 8])
+def test_window_never_exceeds_max_days(max_days):
+    for length in range(0, 40):
+        window = recent_window(list(range(length)), max_days)
+        assert len(window) <= max_days
+        assert window == list(range(length))[-len(window):] if window else length == 0
+
+
+def test_window_only_appends_between_jumps():
+    history = list(range(30))
+    starts = [recent_window(history[:n], 5)[0] for n in range(1, 31)]
+    jumps = [n for n, (a, b) in enumerate(zip(starts, starts[1:]), start=2) if a != b]
+    assert all(b - a == 3 for a, b in zip(jumps, jumps[1:]))  # 5 天窗口每 3 回合跳动一次
+    assert min(len(recent_window(history[:n], 5)) for n in range(5, 31)) == 3
@@ -0,0 +1,268 @@
+"""
+会话存储测试：内存存储的增量计数和按活跃时间的过期堆，以及后台清理任务；
+内存和 SQLite 存储的名额检查与加入是原子的（并发加入、多个 worker 共享同一个 SQLite 文件）
+"""
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from app.core import admission, traffic_control
+from app.core.session_store import MemorySessionStore, SessionData, SQLiteSessionStore
+from app.core.traffic_control import traffic_controller
+
+TIMEOUT = 600
+NOW = 1_000_000.0
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def session(session_type: str = "public", at: float = NOW) -> SessionData:
+    return SessionData(session_type, created_at=at)
+
+
+class TestMemoryStoreAccounting:
+    def test_counts_per_type(self):
+        async def scenario():
+            store = MemorySessionStore()
+            for i in range(3):
+                assert await store.try_add(f"p{i}", session(), limit=10, timeout=TIMEOUT)
+            assert await store.try_add("v0", session("vip"), limit=10, timeout=TIMEOUT)
+            assert await store.count("public", NOW, TIMEOUT) == 3
+            assert await store.count("vip", NOW, TIMEOUT) == 1
+            assert await store.remove("p0")
+            assert not await store.remove("p0")  # 重复移除不影响计数
+            assert await store.count("public", NOW, TIMEOUT) == 2
+
+        run(scenario())
+
+    def test_limit_is_per_type(self):
+        async def scenario():
+            store = MemorySessionStore()
+            assert await store.try_add("p0", session(), limit=1, timeout=TIMEOUT)
+            assert not await store.try_add("p1", session(), limit=1, timeout=TIMEOUT)
+            assert await store.try_add("v0", session("vip"), limit=1, timeout=TIMEOUT)
+
+        run(scenario())
+
+    def test_expired_sessions_not_counted(self):
+        async def scenario():
+            store = MemorySessionStore()
+            await store.try_add("old", session(at=NOW), limit=10, timeout=TIMEOUT)
+            await store.try_add("new", session(at=NOW + 300), limit=10, timeout=TIMEOUT)
+            assert await store.count("public", NOW + TIMEOUT + 1, TIMEOUT) == 1
+            assert await store.get("old") is None
+            assert await store.get("new") is not None
+
+        run(scenario())
+
+    def test_touch_postpones_expiry(self):
+        async def scenario():
+            store = MemorySessionStore()
+            await store.try_add("a", session(at=NOW), limit=10, timeout=TIMEOUT)
+            assert await store.touch("a", NOW + 500, TIMEOUT) is not None
+            # 堆中仍有按旧活跃时间排序的条目，弹出时应识别为过期条目并跳过
+            assert await store.cleanup(NOW + TIMEOUT + 1, TIMEOUT) == 0
+            assert await store.count("public", NOW + TIMEOUT + 1, TIMEOUT) == 1
+            assert await store.cleanup(NOW + 500 + TIMEOUT + 1, TIMEOUT) == 1
+            assert await store.count("public", NOW + 500 + TIMEOUT + 1, TIMEOUT) == 0
+
+        run(scenario())
+
+    def test_touch_after_timeout_removes_session(self):
+        async def scenario():
+            store = MemorySessionStore()
+            await store.try_add("a", session(at=NOW), limit=10, timeout=TIMEOUT)
+            assert await store.touch("a", NOW + TIMEOUT + 1, TIMEOUT) is None
+            assert await store.get("a") is None
+            assert await store.count("public", NOW, TIMEOUT) == 0
+            assert await store.touch("不存在", NOW, TIMEOUT) is None
+
+        run(scenario())
+
+    def test_expired_slot_reusable_on_join(self):
+        async def scenario():
+            store = MemorySessionStore()
+            await store.try_add("a", session(at=NOW), limit=1, timeout=TIMEOUT)
+            assert not await store.try_add("b", session(at=NOW + 10), limit=1, timeout=TIMEOUT)
+            assert await store.try_add("b", session(at=NOW + TIMEOUT + 1), limit=1, timeout=TIMEOUT)
+            assert await store.get("a") is None
+
+        run(scenario())
+
+    def test_removed_session_not_double_counted_on_expiry(self):
+        async def scenario():
+            store = MemorySessionStore()
+            await store.try_add("a", session(at=NOW), limit=10, timeout=TIMEOUT)
+            await store.try_add("b", session(at=NOW), limit=10, timeout=TIMEOUT)
+            await store.remove("a")
+            assert await store.cleanup(NOW + TIMEOUT + 1, TIMEOUT) == 1
+            assert await store.count("public", NOW, TIMEOUT) == 0
+
+        run(scenario())
+
+    def test_heap_rebuilt_under_frequent_touches(self):
+        async def scenario():
+            store = MemorySessionStore()
+            for i in range(10):
+                await store.try_add(f"s{i}", session(), limit=100, timeout=TIMEOUT)
+            for step in range(1, 1001):
+                await store.touch(f"s{step % 10}", NOW + step * 0.1, TIMEOUT)
+            assert len(store._expiry) <= 2 * 10 + 64 + 1
+            assert await store.count("public", NOW + 100, TIMEOUT) == 10
+            assert await store.cleanup(NOW + 100 + TIMEOUT + 1, TIMEOUT) == 10
+
+        run(scenario())
+
+
+class TestReaper:
+    @pytest.fixture
+    def controller(self, monkeypatch):
+        settings = SimpleNamespace(
+            SESSION_TIMEOUT_SECONDS=0.05,
+            SESSION_REAP_INTERVAL_SECONDS=0.02,
+            ADMISSION_ADAPTIVE=False,
+            MAX_PUBLIC_USERS=10,
+        )
+        for module in (traffic_control, admission):
+            monkeypatch.setattr(module, "get_settings", lambda: settings)
+        monkeypatch.setattr(traffic_controller, "_store", MemorySessionStore())
+        monkeypatch.setattr(traffic_controller, "_reaper", None)
+        return traffic_controller
+
+    def test_reaper_removes_idle_sessions(self, controller):
+        async def scenario():
+            token = await controller.try_join()
+            controller.start_reaper()
+            try:
+                await asyncio.sleep(0.2)
+                # 直接查看存储，不经过 count() 的顺带清理
+                return token, dict(controller.store._counts)
+            finally:
+                await controller.stop_reaper()
+
+        token, counts = run(scenario())
+        assert counts == {"public": 0}
+        assert run(controller.store.get(token)) is None
+        assert controller._reaper is None
+
+    def test_reaper_survives_store_errors(self, controller, monkeypatch):
+        calls = []
+
+        async def failing_cleanup(now, timeout):
+            calls.append(now)
+            raise RuntimeError("存储不可用")
+
+        monkeypatch.setattr(controller.store, "cleanup", failing_cleanup)
+
+        async def scenario():
+            controller.start_reaper()
+            try:
+                await asyncio.sleep(0.1)
+                return controller._reaper.done()
+            finally:
+                await controller.stop_reaper()
+
+        assert not run(scenario())
+        assert len(calls) >= 2
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    store = MemorySessionStore() if request.param == "memory" else SQLiteSessionStore(tmp_path / "sessions.sqlite3")
+    yield store
+    run(store.close())
+
+
+class TestAtomicJoin:
+    def test_concurrent_joins_never_exceed_limit(self, store):
+        async def scenario():
+            results = await asyncio.gather(*(
+                store.try_add(f"s{i}", session(), limit=10, timeout=TIMEOUT) for i in range(50)
+            ))
+            return results, await store.count("public", NOW, TIMEOUT)
+
+        results, count = run(scenario())
+        assert sum(results) == 10
+        assert count == 10
+
+    def test_expired_sessions_free_slots_atomically(self, store):
+        async def scenario():
+            for i in range(5):
+                await store.try_add(f"old{i}", session(at=NOW), limit=5, timeout=TIMEOUT)
+            later = NOW + TIMEOUT + 1
+            results = await asyncio.gather(*(
+                store.try_add(f"new{i}", session(at=later), limit=5, timeout=TIMEOUT) for i in range(20)
+            ))
+            return results, await store.count("public", later, TIMEOUT)
+
+        results, count = run(scenario())
+        assert sum(results) == 5
+        assert count == 5
+
+    def test_session_operations(self, store):
+        async def scenario():
+            assert await store.try_add("a", session(at=NOW), limit=5, timeout=TIMEOUT)
+            assert (await store.touch("a", NOW + 100, TIMEOUT)).last_active == NOW + 100
+            assert (await store.get("a")).type == "public"
+            assert await store.touch("a", NOW + 100 + TIMEOUT + 1, TIMEOUT) is None
+            assert await store.get("a") is None
+            assert not await store.remove("a")
+
+        run(scenario())
+
+
+class TestSQLiteWorkers:
+    def test_workers_share_one_limit(self, tmp_path):
+        """多个存储实例（各自的连接，模拟多个 worker）并发加入同一个文件，总数不超过上限"""
+        path = tmp_path / "sessions.sqlite3"
+
+        async def scenario():
+            workers = [SQLiteSessionStore(path) for _ in range(4)]
+            try:
+                results = await asyncio.gather(*(
+                    workers[i % 4].try_add(f"s{i}", session(), limit=10, timeout=TIMEOUT) for i in range(60)
+                ))
+                counts = [await worker.count("public", NOW, TIMEOUT) for worker in workers]
+            finally:
+                for worker in workers:
+                    await worker.close()
+            return results, counts
+
+        results, counts = run(scenario())
+        assert sum(results) == 10
+        assert counts == [10] * 4
+
+    def test_token_visible_to_other_workers(self, tmp_path):
+        path = tmp_path / "sessions.sqlite3"
+
+        async def scenario():
+            first, second = SQLiteSessionStore(path), SQLiteSessionStore(path)
+            await first.try_add("a", session(), limit=5, timeout=TIMEOUT)
+            assert await second.touch("a", NOW + 10, TIMEOUT) is not None
+            assert (await first.get("a")).last_active == NOW + 10
+            assert await second.remove("a")
+            assert await first.get("a") is None
+            await first.close()
+            await second.close()
+
+        run(scenario())
+
+    def test_sessions_survive_restart(self, tmp_path):
+        path = tmp_path / "sessions.sqlite3"
+
+        async def scenario():
+            before = SQLiteSessionStore(path)
+            await before.try_add("a", session(), limit=5, timeout=TIMEOUT)
+            await before.close()
+            after = SQLiteSessionStore(path)
+            try:
+                return await after.get("a"), await after.count("public", NOW, TIMEOUT)
+            finally:
+                await after.close()
+
+        restored, count = run(scenario())
+        assert restored is not None and restored.type == "public"
+        assert count == 1
@@ -0,0 +1,225 @@
+"""
+重复请求合并测试：合并键、并发调用共享结果和异常、发起者取消不影响其他等待者，
+以及流式接口的重复请求接到进行中的生成上
+"""
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from pydantic import BaseModel
+
+from app.core import single_flight as single_flight_module
+from app.core import sse_replay
+from app.core.metrics import metrics
+from app.core.single_flight import SingleFlight, flight_key
+from app.core.sse_replay import ReplayRegistry
+
+
+class Body(BaseModel):
+    action: str
+    day: int = 1
+
+
+@pytest.fixture(autouse=True)
+def settings(monkeypatch):
+    values = SimpleNamespace(
+        single_flight_enabled=True,
+        sse_replay_enabled=True,
+        sse_replay_ttl=120,
+        sse_replay_stream_kb=256,
+        sse_replay_streams_per_session=4,
+        sse_replay_max_total_mb=64,
+        sse_disconnect_grace=10.0,
+    )
+    monkeypatch.setattr(single_flight_module, "get_settings", lambda: values)
+    monkeypatch.setattr(sse_replay, "get_settings", lambda: values)
+    metrics.reset()
+    yield values
+    metrics.reset()
+
+
+class TestFlightKey:
+    def test_same_request_same_key(self):
+        assert flight_key("s", "game/ending", Body(action="逃")) == flight_key("s", "game/ending", Body(action="逃"))
+
+    def test_any_difference_changes_key(self):
+        base = flight_key("s", "game/ending", Body(action="逃"), 2)
+        assert flight_key("t", "game/ending", Body(action="逃"), 2) != base
+        assert flight_key("s", "game/judge", Body(action="逃"), 2) != base
+        assert flight_key("s", "game/ending", Body(action="守"), 2) != base
+        assert flight_key("s", "game/ending", Body(action="逃", day=2), 2) != base
+        assert flight_key("s", "game/ending", Body(action="逃"), 1) != base
+
+    def test_no_key_without_session_or_when_disabled(self, settings):
+        assert flight_key(None, "game/ending", Body(action="逃")) is None
+        settings.single_flight_enabled = False
+        assert flight_key("s", "game/ending", Body(action="逃")) is None
+
+
+class Upstream:
+    """可控的上游调用：记录调用次数，等待 release 后返回结果或抛出异常"""
+
+    def __init__(self, result="结局", error: Exception | None = None):
+        self.calls = 0
+        self.result = result
+        self.error = error
+        self.release = asyncio.Event()
+
+    async def __call__(self):
+        self.calls += 1
+        await self.release.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class TestSingleFlight:
+    def test_concurrent_calls_share_one_execution(self):
+        async def run():
+            flights = SingleFlight()
+            upstream = Upstream()
+            waiters = [asyncio.create_task(flights.do("k", upstream, "game/ending")) for _ in range(5)]
+            await asyncio.sleep(0)
+            assert flights.in_flight() == 1
+            upstream.release.set()
+            results = await asyncio.gather(*waiters)
+            return flights, upstream, results
+
+        flights, upstream, results = asyncio.run(run())
+        assert results == ["结局"] * 5
+        assert upstream.calls == 1
+        assert flights.in_flight() == 0
+        assert metrics.get("single_flight_total", endpoint="game/ending", outcome="leader") == 1
+        assert metrics.get("single_flight_total", endpoint="game/ending", outcome="shared") == 4
+
+    def test_error_shared_by_all_waiters(self):
+        async def run():
+            flights = SingleFlight()
+            upstream = Upstream(error=ValueError("上游失败"))
+            waiters = [asyncio.create_task(flights.do("k", upstream)) for _ in range(3)]
+            await asyncio.sleep(0)
+            upstream.release.set()
+            return upstream, await asyncio.gather(*waiters, return_exceptions=True)
+
+        upstream, results = asyncio.run(run())
+        assert upstream.calls == 1
+        assert all(isinstance(r, ValueError) for r in results)
+
+    def test_finished_call_not_reused(self):
+        async def run():
+            flights = SingleFlight()
+            upstream = Upstream()
+            upstream.release.set()
+            await flights.do("k", upstream)
+            await flights.do("k", upstream)
+            return upstream
+
+        assert asyncio.run(run()).calls == 2  # 只合并同时进行的调用，不缓存结果
+
+    def test_different_or_missing_keys_not_shared(self):
+        async def run():
+            flights = SingleFlight()
+            upstream = Upstream()
+            upstream.release.set()
+            await asyncio.gather(flights.do("a", upstream), flights.do("b", upstream))
+            await asyncio.gather(flights.do(None, upstream), flights.do(None, upstream))
+            return flights, upstream
+
+        flights, upstream = asyncio.run(run())
+        assert upstream.calls == 4
+        assert flights.in_flight() == 0
+
+    def test_cancelled_leader_does_not_cancel_others(self):
+        async def run():
+            flights = SingleFlight()
+            upstream = Upstream()
+            leader = asyncio.create_task(flights.do("k", upstream))
+            await asyncio.sleep(0)
+            follower = asyncio.create_task(flights.do("k", upstream))
+            await asyncio.sleep(0)
+            leader.cancel()
+            await asyncio.sleep(0)
+            upstream.release.set()
+            return leader, await follower, upstream
+
+        leader, result, upstream = asyncio.run(run())
+        assert leader.cancelled()
+        assert result == "结局"
+        assert upstream.calls == 1
+
+    def test_call_completes_after_all_waiters_leave(self):
+        async def run():
+            flights = SingleFlight()
+            upstream = Upstream(error=ValueError("没人等待的失败"))
+            waiter = asyncio.create_task(flights.do("k", upstream))
+            await asyncio.sleep(0)
+            waiter.cancel()
+            await asyncio.sleep(0)
+            assert flights.in_flight() == 1  # 调用继续进行，稍后的重复请求仍可共享
+            upstream.release.set()
+            await asyncio.sleep(0.01)
+            return flights
+
+        loop_errors = []
+
+        def run_with_handler():
+            loop = asyncio.new_event_loop()
+            loop.set_exception_handler(lambda _, context: loop_errors.append(context))
+            try:
+                return loop.run_until_complete(run())
+            finally:
+                loop.close()
+
+        flights = run_with_handler()
+        assert flights.in_flight() == 0
+        assert loop_errors == []  # 没有 "exception was never retrieved"
+
+
+async def collect(response) -> list[str]:
+    return [chunk async for chunk in response.body_iterator]
+
+
+class TestStreamJoin:
+    def test_duplicate_stream_joins_running_generation(self):
+        runs = []
+
+        async def source(release: asyncio.Event):
+            runs.append(1)
+            yield "data: 1\n\n"
+            await release.wait()
+            yield "data: 2\n\n"
+
+        async def run():
+            registry = ReplayRegistry()
+            release = asyncio.Event()
+            first = registry.start("s", "game/narrate", source(release), key="k")
+            await asyncio.sleep(0)
+            second = registry.start("s", "game/narrate", source(release), key="k")
+            reader = asyncio.gather(collect(first), collect(second))
+            await asyncio.sleep(0.01)
+            release.set()
+            events = await reader
+            await registry.aclose()
+            return first, second, events
+
+        first, second, (a, b) = asyncio.run(run())
+        assert runs == [1]
+        assert first.headers["X-Stream-Id"] == second.headers["X-Stream-Id"]
+        assert a == b and len(a) == 2
+        assert metrics.get("single_flight_total", endpoint="game/narrate", outcome="shared") == 1
+
+    def test_finished_stream_not_joined(self):
+        async def source():
+            yield "data: 1\n\n"
+
+        async def run():
+            registry = ReplayRegistry()
+            first = registry.start("s", "game/narrate", source(), key="k")
+            await collect(first)
+            second = registry.start("s", "game/narrate", source(), key="k")
+            await collect(second)
+            await registry.aclose()
+            return first, second
+
+        first, second = asyncio.run(run())
+        assert first.headers["X-Stream-Id"] != second.headers["X-Stream-Id"]
@@ -0,0 +1,168 @@
+"""
+可续传 SSE 测试：环形缓冲的续传判断和注册表淘汰
+"""
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from app.core import sse_replay
+from app.core.sse_replay import ReplayRegistry, ReplayStream
+
+
+def event(text: str) -> str:
+    return f"data: {text}\n\n"
+
+
+def reset_reason(response) -> str | None:
+    """读完响应，返回 reset 事件的原因；正常续传的响应返回 None"""
+    async def read():
+        return [chunk async for chunk in response.body_iterator]
+
+    chunks = asyncio.run(read())
+    if "X-Stream-Id" in response.headers:
+        return None
+    (chunk,) = chunks
+    data = json.loads(chunk.removeprefix("data: "))
+    assert data["type"] == "reset"
+    return data["reason"]
+
+
+def event_size(stream: ReplayStream, seq: int, text: str) -> int:
+    return len(f"id: {stream.id}:{seq}\n{event(text)}".encode("utf-8"))
+
+
+@pytest.fixture
+def settings(monkeypatch):
+    values = SimpleNamespace(
+        sse_replay_enabled=True,
+        sse_replay_ttl=120,
+        sse_replay_stream_kb=256,
+        sse_replay_streams_per_session=2,
+        sse_replay_max_total_mb=64,
+        sse_disconnect_grace=10.0,
+    )
+    monkeypatch.setattr(sse_replay, "get_settings", lambda: values)
+    return values
+
+
+class TestReplayStream:
+    def test_can_resume_within_buffer(self):
+        stream = ReplayStream("s", None, "game/narrate", max_bytes=1 << 20)
+        assert stream.can_resume(0)
+        for i in range(3):
+            stream.publish(event(str(i)))
+        assert all(stream.can_resume(after) for after in range(0, 4))
+        assert not stream.can_resume(4)  # 客户端声称收到了尚未产生的事件
+        assert not stream.can_resume(-1)
+
+    def test_ring_drops_oldest_by_bytes(self):
+        stream = ReplayStream("s", None, "game/narrate", max_bytes=1)
+        size = event_size(stream, 1, "x")
+        stream.max_bytes = 3 * size
+        for _ in range(5):
+            stream.publish(event("x"))
+        assert stream.size == 3 * size
+        assert [seq for seq, _ in stream._events] == [3, 4, 5]
+        assert not stream.can_resume(0)
+        assert not stream.can_resume(1)
+        assert stream.can_resume(2)
+        assert stream.can_resume(5)
+
+    def test_publish_returns_size_delta(self):
+        stream = ReplayStream("s", None, "game/narrate", max_bytes=1)
+        size = event_size(stream, 1, "x")
+        stream.max_bytes = size
+        assert stream.publish(event("x")) == size
+        assert stream.publish(event("x")) == 0  # 挤掉一个同样大小的事件
+        assert stream.size == size
+
+    def test_single_oversized_event_is_kept(self):
+        stream = ReplayStream("s", None, "game/narrate", max_bytes=1)
+        stream.publish(event("很长的事件"))
+        assert len(stream._events) == 1
+        assert stream.can_resume(0)
+
+    def test_follow_replays_after_seq(self):
+        async def run():
+            stream = ReplayStream("s", None, "game/narrate", max_bytes=1 << 20)
+            for i in range(4):
+                stream.publish(event(str(i)))
+            stream.finish()
+            return [e async for e in stream.follow(after=2)]
+
+        assert asyncio.run(run()) == ["id: s:3\n" + event("2"), "id: s:4\n" + event("3")]
+
+
+async def finished_source(*payloads: str):
+    for payload in payloads:
+        yield event(payload)
+
+
+class TestReplayRegistryEviction:
+    def run_streams(self, registry: ReplayRegistry, sessions: list[str], payload: str = "x") -> list[str]:
+        """依次运行完各会话的流，返回流 id"""
+        async def run():
+            ids = []
+            for session in sessions:
+                response = registry.start(session, "game/narrate", finished_source(payload))
+                ids.append(response.headers["X-Stream-Id"])
+                async for _ in response.body_iterator:
+                    pass
+            await registry.aclose()
+            return ids
+
+        return asyncio.run(run())
+
+    def test_finished_stream_resumable(self, settings):
+        registry = ReplayRegistry()
+        self.run_streams(registry, ["a"])
+        (stream_id,) = registry._streams
+        assert registry._streams[stream_id].can_resume(1)
+
+    def test_per_session_limit_evicts_oldest(self, settings):
+        registry = ReplayRegistry()
+        self.run_streams(registry, ["a", "a", "a", "b"])
+        sessions = [s.session for s in registry._streams.values()]
+        assert sessions == ["a", "a", "b"]
+
+    def test_age_eviction(self, settings):
+        registry = ReplayRegistry()
+        self.run_streams(registry, ["a", "b"])
+        settings.sse_replay_ttl = -1
+        registry._evict()
+        assert not registry._streams
+        assert registry._size == 0
+
+    def test_memory_eviction_keeps_total_under_limit(self, settings):
+        settings.sse_replay_streams_per_session = 100
+        settings.sse_replay_max_total_mb = 1 / 1024  # 1KB
+        registry = ReplayRegistry()
+        self.run_streams(registry, ["a"] * 10, payload="x" * 300)
+        assert 0 < len(registry._streams) < 10
+        assert registry._size == sum(s.size for s in registry._streams.values())
+        assert registry._size <= 1024
+
+    def test_evicted_stream_not_resumable(self, settings):
+        registry = ReplayRegistry()
+        evicted, kept, _ = self.run_streams(registry, ["a", "a", "a"])
+        assert reset_reason(registry.resume(f"{evicted}:1", "a", "game/narrate")) == sse_replay.RESET_UNKNOWN_STREAM
+        assert reset_reason(registry.resume(f"{kept}:1", "a", "game/narrate")) is None
+        assert reset_reason(registry.resume(f"{kept}:1", "b", "game/narrate")) == sse_replay.RESET_NOT_RESUMABLE  # 会话不匹配
+        assert reset_reason(registry.resume(f"{kept}:1", "a", "game/judge")) == sse_replay.RESET_NOT_RESUMABLE  # 接口不匹配
+        assert reset_reason(registry.resume(f"{kept}:x", "a", "game/narrate")) == sse_replay.RESET_NOT_RESUMABLE
+
+    def test_unknown_stream_resets_instead_of_restarting(self, settings):
+        registry = ReplayRegistry()
+        assert registry.resume(None, "a", "game/narrate") is None  # 新请求照常生成
+        assert reset_reason(registry.resume("不存在:3", "a", "game/narrate")) == sse_replay.RESET_UNKNOWN_STREAM
+        assert not registry._streams
+        settings.sse_replay_enabled = False
+        assert reset_reason(registry.resume("不存在:3", "a", "game/narrate")) == sse_replay.RESET_DISABLED
+
+    def test_disabled_replay_does_not_register(self, settings):
+        settings.sse_replay_enabled = False
+        registry = ReplayRegistry()
+        self.run_streams(registry, ["a"])
+        assert not registry._streams
@@ -0,0 +1,156 @@
+"""
+流式输出解析测试：任意位置切分 chunk，结果都与整段输入一致
+"""
+import json
+from itertools import combinations
+
+import pytest
+
+from app.core.stream_parser import NarrativeStreamParser, TagScanner
+
+STATE = {"score": 60, "stat_changes": {"hp": -10, "san": 5, "hunger": -30}}
+
+JUDGE_OUTPUT = (
+    "你握紧撬棍，推开了门。<notes>玩家谨慎</notes>走廊里一片死寂。a < b 不是标签。"
+    f"<STATE_UPDATE>{json.dumps(STATE, ensure_ascii=False)}</state_update>之后的内容应被丢弃"
+)
+
+CRISIS_OUTPUT = (
+    "尸群正在撞门。\n<options>\nA. 从窗户逃走\nB. 加固大门\nC. 躲进地下室\nD. 正面迎战\n</options>"
+    "<hidden>B 选项最安全</hidden>多余的输出"
+)
+
+LEGACY_CRISIS_OUTPUT = "尸群正在撞门。\n---\nA. 从窗户逃走\nB. 加固大门\nC. 躲进地下室\nD. 正面迎战\n"
+
+
+def split_at(text: str, points: tuple[int, ...]) -> list[str]:
+    bounds = (0, *points, len(text))
+    return [text[a:b] for a, b in zip(bounds, bounds[1:])]
+
+
+def all_splits(text: str, max_cuts: int = 2):
+    """所有一刀、两刀的切分（两刀只在较短文本上穷举）"""
+    yield [text]
+    for cuts in range(1, max_cuts + 1):
+        for points in combinations(range(1, len(text)), cuts):
+            yield split_at(text, points)
+
+
+def scan(chunks: list[str], **kwargs) -> tuple[str, list[tuple[str, str]], str]:
+    """返回 (叙事文本, 标签块列表, stream_tags 的拼接内容)"""
+    scanner = TagScanner(**kwargs)
+    events = []
+    for chunk in chunks:
+        events.extend(scanner.feed(chunk))
+    events.extend(scanner.finish())
+    text = "".join(t for kind, _, t in events if kind == "text")
+    blocks = [(tag, t) for kind, tag, t in events if kind == "block"]
+    body = "".join(t for kind, _, t in events if kind == "body")
+    return text, blocks, body
+
+
+def parse(chunks: list[str], **kwargs) -> dict:
+    """按事件类型汇总解析结果"""
+    parser = NarrativeStreamParser(**kwargs)
+    events = []
+    for chunk in chunks:
+        events.extend(parser.feed(chunk))
+        if parser.complete:
+            break
+    events.extend(parser.finish())
+    return {
+        "content": "".join(d["text"] for t, d in events if t == "content"),
+        "state": [d for t, d in events if t == "state"],
+        "hidden": [d for t, d in events if t == "hidden"],
+        "crisis": sum(1 for t, _ in events if t == "crisis"),
+        "choices": [d["choices"] for t, d in events if t == "choices"][-1:],
+        "complete": parser.complete,
+    }
+
+
+class TestTagScanner:
+    def test_whole_input(self):
+        text, blocks, _ = scan([JUDGE_OUTPUT])
+        assert text == "你握紧撬棍，推开了门。走廊里一片死寂。a < b 不是标签。之后的内容应被丢弃"
+        assert blocks == [("notes", "玩家谨慎"), ("state_update", json.dumps(STATE, ensure_ascii=False))]
+
+    def test_every_split_point(self):
+        expected = scan([JUDGE_OUTPUT])
+        for chunks in all_splits(JUDGE_OUTPUT, max_cuts=1):
+            assert scan(chunks) == expected, chunks
+
+    def test_every_pair_of_split_points(self):
+        source = "前<notes>备注</notes>后<state_update>{}</state_update>"
+        expected = scan([source])
+        for chunks in all_splits(source):
+            assert scan(chunks) == expected, chunks
+
+    def test_single_character_chunks(self):
+        assert scan(list(JUDGE_OUTPUT)) == scan([JUDGE_OUTPUT])
+
+    def test_stream_tag_body_matches_block(self):
+        kwargs = {"held_tags": ("options", "hidden"), "stream_tags": ("options",)}
+        expected = scan([CRISIS_OUTPUT], **kwargs)
+        assert expected[2] == dict(expected[1])["options"]
+        for chunks in all_splits(CRISIS_OUTPUT, max_cuts=1):
+            assert scan(chunks, **kwargs) == expected, chunks
+
+    def test_unclosed_block_returned_on_finish(self):
+        assert scan(["叙事<hidden>没有闭合"]) == ("叙事", [("hidden", "没有闭合")], "")
+
+    def test_trailing_partial_open_tag_is_text(self):
+        assert scan(["结尾<stat"]) == ("结尾<stat", [], "")
+
+
+class TestNarrativeStreamParser:
+    def test_judge_output(self):
+        result = parse([JUDGE_OUTPUT])
+        assert result["content"] == "你握紧撬棍，推开了门。走廊里一片死寂。a < b 不是标签。"
+        assert result["state"][0]["state"]["score"] == 60
+        assert result["state"][0]["state"]["stat_changes"]["hp"] == -10
+        assert result["hidden"] == [{"tag": "notes", "text": "玩家谨慎"}]
+        assert result["complete"]
+
+    @pytest.mark.parametrize("source", [JUDGE_OUTPUT, CRISIS_OUTPUT, LEGACY_CRISIS_OUTPUT])
+    def test_every_split_point(self, source):
+        expected = parse([source], detect_choices=True)
+        for chunks in all_splits(source, max_cuts=1):
+            assert parse(chunks, detect_choices=True) == expected, chunks
+
+    @pytest.mark.parametrize("source", [CRISIS_OUTPUT, LEGACY_CRISIS_OUTPUT])
+    def test_crisis_choices(self, source):
+        result = parse(list(source), detect_choices=True)
+        assert result["crisis"] == 1
+        assert result["choices"] == [["A. 从窗户逃走", "B. 加固大门", "C. 躲进地下室", "D. 正面迎战"]]
+        assert result["content"].strip() == "尸群正在撞门。"  # 选项只通过 choices 下发，不作为叙事转发
+
+    def test_legacy_separator_not_forwarded(self):
+        source = "他喊道--快跑！\n-- 没人回答\n---\nA. 逃\nB. 守\n"
+        expected = "他喊道--快跑！\n-- 没人回答\n"
+        for chunks in all_splits(source, max_cuts=1):
+            result = parse(chunks, detect_choices=True)
+            assert result["content"] == expected, chunks
+            assert result["choices"] == [["A. 逃", "B. 守"]]
+
+    def test_trailing_dashes_without_options_are_content(self):
+        result = parse(["结尾\n--"], detect_choices=True)
+        assert result["content"] == "结尾\n--"
+        assert result["crisis"] == 0
+
+    def test_crisis_completes_after_hidden(self):
+        result = parse([CRISIS_OUTPUT], detect_choices=True)
+        assert result["complete"]
+        assert result["hidden"] == [{"tag": "hidden", "text": "B 选项最安全"}]
+        assert "多余的输出" not in result["content"]
+
+    def test_invalid_state_reports_error(self):
+        result = parse(["文本<state_update>{不是 JSON</state_update>"])
+        assert result["state"][0]["state"] is None
+        assert "error" in result["state"][0]
+
+    def test_unstructured_passes_chunks_through(self):
+        chunks = ["前<state", "_update>{}</state_update>"]
+        parser = NarrativeStreamParser(structured=False)
+        events = [e for chunk in chunks for e in parser.feed(chunk)]
+        assert [d["text"] for _, d in events] == chunks
+        assert parser.complete
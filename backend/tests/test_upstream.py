@@ -0,0 +1,121 @@
+"""
+端点池测试：可重试错误的判断、熔断冷却、故障转移时的端点选择和会话亲和
+"""
+import random
+from collections import Counter
+from types import SimpleNamespace
+
+import httpx
+import openai
+import pytest
+
+from app.core import upstream
+from app.core.upstream import EndpointPool, LLMStallError, UpstreamEndpoint, is_retryable_error
+
+REQUEST = httpx.Request("POST", "http://upstream/v1/chat/completions")
+
+
+def status_error(code: int) -> openai.APIStatusError:
+    return openai.APIStatusError("upstream", response=httpx.Response(code, request=REQUEST), body=None)
+
+
+@pytest.fixture(autouse=True)
+def settings(monkeypatch):
+    values = SimpleNamespace(llm_endpoint_failure_threshold=2, llm_endpoint_cooldown_seconds=30.0)
+    monkeypatch.setattr(upstream, "get_settings", lambda: values)
+    return values
+
+
+def pool(*weights: float) -> EndpointPool:
+    return EndpointPool("narrator", [
+        UpstreamEndpoint("narrator", name, "key", f"http://{name}/v1", "model", weight)
+        for name, weight in zip("abcdef", weights)
+    ])
+
+
+@pytest.mark.parametrize("error", [
+    LLMStallError("首 token 超时"),
+    openai.APIConnectionError(request=REQUEST),
+    httpx.ReadTimeout("timeout"),
+    status_error(500),
+    status_error(503),
+    status_error(429),
+    status_error(401),
+])
+def test_endpoint_errors_are_retryable(error):
+    assert is_retryable_error(error)
+
+
+@pytest.mark.parametrize("error", [status_error(400), status_error(422), ValueError("bad json")])
+def test_request_errors_are_not_retryable(error):
+    assert not is_retryable_error(error)
+
+
+class TestCircuitBreaker:
+    def test_cooldown_after_consecutive_failures(self):
+        endpoint = pool(1).endpoints[0]
+        endpoint.record_failure("502")
+        assert not endpoint.is_cooling()
+        endpoint.record_failure("502")
+        assert endpoint.is_cooling()
+        assert not endpoint.is_cooling(endpoint.cooldown_until + 1)
+
+    def test_success_resets_failure_streak(self):
+        endpoint = pool(1).endpoints[0]
+        endpoint.record_failure("502")
+        endpoint.record_success(0.5)
+        endpoint.record_failure("502")
+        assert not endpoint.is_cooling()
+        assert endpoint.consecutive_failures == 1
+
+    def test_errors_lower_effective_weight_but_keep_a_floor(self):
+        endpoint = pool(1).endpoints[0]
+        for _ in range(100):
+            endpoint.record_failure("502")
+        assert endpoint.effective_weight(None) == pytest.approx(upstream.MIN_WEIGHT_RATIO)
+
+    def test_slower_endpoint_gets_less_weight(self):
+        fast, slow = pool(1, 1).endpoints
+        fast.record_success(0.5)
+        slow.record_success(2.0)
+        assert fast.effective_weight(0.5) == pytest.approx(1.0)
+        assert slow.effective_weight(0.5) == pytest.approx(0.25)
+
+
+class TestChoose:
+    def test_failover_skips_tried_and_cooling_endpoints(self):
+        endpoints = pool(1, 1, 1)
+        a, b, c = endpoints.endpoints
+        b.cooldown_until = float("inf")
+        for _ in range(20):
+            assert endpoints.choose(exclude={"a"}) is c
+
+    def test_relaxes_when_everything_is_excluded_or_cooling(self):
+        endpoints = pool(1, 1)
+        for endpoint in endpoints.endpoints:
+            endpoint.cooldown_until = float("inf")
+        assert endpoints.choose(exclude={"a"}).name == "b"  # 都在冷却时仍优先未尝试过的
+        assert endpoints.choose(exclude={"a", "b"}) in endpoints.endpoints
+
+    def test_weighted_random_follows_weights(self):
+        random.seed(1)
+        endpoints = pool(3, 1)
+        counts = Counter(endpoints.choose().name for _ in range(4000))
+        assert counts["a"] / 4000 == pytest.approx(0.75, abs=0.03)
+
+    def test_affinity_is_stable_and_weighted(self):
+        endpoints = pool(3, 1)
+        sessions = [f"session-{i}" for i in range(4000)]
+        first = {s: endpoints.choose(affinity=s).name for s in sessions}
+        assert first == {s: endpoints.choose(affinity=s).name for s in sessions}
+        assert Counter(first.values())["a"] / len(sessions) == pytest.approx(0.75, abs=0.03)
+
+    def test_affinity_moves_only_sessions_of_a_cooling_endpoint(self):
+        endpoints = pool(1, 1, 1)
+        sessions = [f"session-{i}" for i in range(600)]
+        before = {s: endpoints.choose(affinity=s).name for s in sessions}
+        endpoints.endpoints[0].cooldown_until = float("inf")
+        after = {s: endpoints.choose(affinity=s).name for s in sessions}
+        moved = [s for s in sessions if before[s] != after[s]]
+        assert moved and all(before[s] == "a" for s in moved)
+        assert "a" not in after.values()
@@ -0,0 +1,169 @@
+"""
+排队测试：票据在会话存储中按 FIFO 放行，超时出队，无人领取的名额被收回（内存和 SQLite 存储）
+"""
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from app.core import admission, traffic_control, waiting_room as waiting_room_module
+from app.core.session_store import MemorySessionStore, SessionData, SQLiteSessionStore
+from app.core.traffic_control import traffic_controller
+from app.core.waiting_room import WaitingRoom
+
+TTL = 30
+TIMEOUT = 600
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    store = MemorySessionStore() if request.param == "memory" else SQLiteSessionStore(tmp_path / "sessions.sqlite3")
+    yield store
+    asyncio.run(store.close())
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+async def enqueue(store, *ids: str, now: float):
+    return [await store.enqueue_ticket(ticket_id, now, max_size=100) for ticket_id in ids]
+
+
+async def admit(store, limit: int = 1):
+    return await store.admit_head(f"token-{time.monotonic_ns()}", SessionData("public"), limit, TIMEOUT)
+
+
+async def positions(store, *ids: str) -> list[int]:
+    return [await store.ticket_position(await store.get_ticket(ticket_id)) for ticket_id in ids]
+
+
+def test_fifo_order(store):
+    async def scenario():
+        now = time.time()
+        await enqueue(store, "a", "b", "c", "d", now=now)
+        assert await positions(store, "a", "b", "c", "d") == [1, 2, 3, 4]
+        first, second = await admit(store, limit=2), await admit(store, limit=2)
+        assert (first.id, second.id) == ("a", "b")
+        assert first.status == "admitted" and first.token
+        assert await admit(store, limit=2) is None  # 名额已满，队首保持不变
+        assert await positions(store, "a", "c", "d") == [0, 1, 2]
+        await store.remove(first.token)
+        assert (await admit(store, limit=2)).id == "c"
+        assert await store.waiting_count() == 1
+
+    run(scenario())
+
+
+def test_leave_and_max_size(store):
+    async def scenario():
+        now = time.time()
+        for ticket_id in ("a", "b"):
+            assert await store.enqueue_ticket(ticket_id, now, max_size=2) is not None
+        assert await store.enqueue_ticket("c", now, max_size=2) is None
+        assert await store.leave_ticket("a")
+        assert not await store.leave_ticket("a")
+        assert (await store.get_ticket("a")).status == "left"
+        assert await positions(store, "b") == [1]
+        assert await store.enqueue_ticket("c", now, max_size=2) is not None
+        assert await positions(store, "b", "c") == [1, 2]
+
+    run(scenario())
+
+
+def test_ttl_expiry(store):
+    async def scenario():
+        now = time.time()
+        await enqueue(store, "a", "b", now=now)
+        await store.touch_ticket("b", now + 20)
+        assert await store.expire_tickets(now + TTL + 1, TTL) == (1, 0)
+        assert (await store.get_ticket("a")).status == "expired"
+        assert await positions(store, "a", "b") == [0, 1]
+        assert await store.expire_tickets(now + 20 + TTL + 1, TTL) == (1, 0)
+        assert await store.waiting_count() == 0
+        await store.expire_tickets(now + 2 * TTL + 1, TTL)  # 结束的票据再保留一个 TTL 后删除
+        assert await store.get_ticket("a") is None
+        assert await store.get_ticket("b") is not None
+
+    run(scenario())
+
+
+def test_unclaimed_slot_reclaimed(store):
+    async def scenario():
+        now = time.time()
+        await enqueue(store, "a", "b", now=now)
+        ticket = await admit(store)
+        assert ticket.id == "a"
+        assert await store.count("public", now, TIMEOUT) == 1
+        await store.touch_ticket("b", now + 20)
+        assert await store.expire_tickets(now + TTL + 1, TTL) == (0, 1)
+        assert await store.count("public", now, TIMEOUT) == 0
+        assert await store.get(ticket.token) is None
+        reclaimed, claimed = await store.claim_ticket("a")
+        assert reclaimed.status == "expired" and not claimed  # 过期后不能再领取
+        assert (await admit(store)).id == "b"  # 收回的名额分配给下一位
+
+    run(scenario())
+
+
+def test_claimed_slot_kept(store):
+    async def scenario():
+        now = time.time()
+        await enqueue(store, "a", now=now)
+        ticket = await admit(store)
+        assert (await store.claim_ticket("a"))[1]
+        assert not (await store.claim_ticket("a"))[1]
+        assert await store.expire_tickets(now + TTL + 1, TTL) == (0, 0)
+        assert await store.get(ticket.token) is not None
+
+    run(scenario())
+
+
+def test_sqlite_queue_shared_between_workers(tmp_path):
+    async def scenario():
+        path = tmp_path / "sessions.sqlite3"
+        workers = [SQLiteSessionStore(path), SQLiteSessionStore(path)]
+        now = time.time()
+        for i in range(6):
+            await workers[i % 2].enqueue_ticket(f"t{i}", now, max_size=100)
+        assert await positions(workers[1], "t0", "t3", "t5") == [1, 4, 6]
+        admitted = [await admit(workers[i % 2], limit=3) for i in range(4)]
+        assert [t.id if t else None for t in admitted] == ["t0", "t1", "t2", None]
+        for worker in workers:
+            await worker.close()
+
+    run(scenario())
+
+
+class TestWaitingRoom:
+    @pytest.fixture
+    def room(self, store, monkeypatch):
+        settings = SimpleNamespace(
+            MAX_PUBLIC_USERS=1,
+            SESSION_TIMEOUT_SECONDS=TIMEOUT,
+            ADMISSION_ADAPTIVE=False,
+            WAITING_ROOM_MAX_SIZE=10,
+            WAITING_ROOM_TICKET_TTL_SECONDS=TTL,
+        )
+        for module in (traffic_control, waiting_room_module, admission):
+            monkeypatch.setattr(module, "get_settings", lambda: settings)
+        monkeypatch.setattr(traffic_controller, "_store", store)
+        return WaitingRoom()
+
+    def test_admits_in_order_and_hands_out_token(self, room):
+        async def scenario():
+            tickets = [await room.enqueue() for _ in range(3)]
+            assert await room.admit() == 1
+            first = await room.claim(tickets[0].id)
+            assert await room.status(first) == {"status": "admitted", "token": first.token, "session_type": "public"}
+            assert await room.status(await room.get(tickets[1].id)) == {
+                "status": "waiting", "position": 1, "eta_seconds": None,
+            }
+            assert await room.admit() == 0
+            await traffic_controller.release(first.token)
+            assert await room.admit() == 1
+            assert (await room.get(tickets[1].id)).status == "admitted"
+            assert await room.waiting() == 1
+
+        run(scenario())
@@ -0,0 +1,3 @@
+"""
+开发辅助工具（本地压测、故障注入等），不随应用部署
+"""
@@ -0,0 +1,398 @@
+"""
+HTTP 层 SSE 压测与延迟基准工具
+
+模拟 N 个并发玩家，按真实游戏流程依次调用：
+    /api/game/access → /api/game/narrate/stream → /api/game/judge/stream → /api/game/ending
+    → /api/ice-age/narrate-batch/stream → /api/archive/submit、list、like
+
+统计每个接口的：
+- TTFT（首个 content 事件耗时，流式接口）
+- 相邻 chunk 间隔（inter-chunk gap）
+- 总耗时、吞吐量（请求/秒、chunk/秒）
+- p50 / p95 / p99
+
+结果保存为 JSON，可与基线对比，p95 劣化超过阈值时以非零状态码退出。
+
+用法（建议先启动本地替身上游 tools.fake_llm_server）：
+    python -m tools.fake_llm_server --port 9100 &
+    OPENAI_BASE_URL=http://127.0.0.1:9100/v1 uvicorn app.main:app --port 8000 &
+    python -m tools.bench --players 20 --rounds 2 --output bench.json
+    python -m tools.bench --players 20 --baseline bench.json
+"""
+import argparse
+import asyncio
+import json
+import math
+import sys
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+
+import httpx
+
+
+ALL_ENDPOINTS = [
+    "access",
+    "narrate/stream",
+    "judge/stream",
+    "ending",
+    "ice-age/narrate-batch/stream",
+    "archive/submit",
+    "archive/list",
+    "archive/like",
+]
+
+
+# ==================== 请求样例 ====================
+
+SAMPLE_STATS = {"hp": 80, "san": 65}
+SAMPLE_INVENTORY = [
+    {"name": "压缩饼干", "count": 6, "description": "高热量干粮"},
+    {"name": "瓶装水", "count": 8},
+    {"name": "棒球棍", "count": 1, "hidden": "近战武器，对单只丧尸有效"},
+]
+SAMPLE_HISTORY = [
+    {"day": 1, "log": "末世爆发，你躲进了出租屋，锁好了门窗。", "event_result": "none"},
+    {"day": 2, "log": "楼下传来尖叫声，你没有出门。", "event_result": "none"},
+]
+SAMPLE_EVENT = """门外传来撞门声。
+
+<options>
+A. 用棒球棍顶住房门
+B. 从后窗逃走
+C. 大声呼救
+D. 保持安静
+</options>"""
+
+
+def narrate_payload(day: int) -> dict:
+    return {
+        "day": day,
+        "stats": SAMPLE_STATS,
+        "inventory": SAMPLE_INVENTORY,
+        "hidden_tags": [],
+        "history": SAMPLE_HISTORY,
+    }
+
+
+def judge_payload(day: int) -> dict:
+    return {
+        "day": day,
+        "event_context": SAMPLE_EVENT,
+        "action_content": "A. 用棒球棍顶住房门",
+        "stats": SAMPLE_STATS,
+        "inventory": SAMPLE_INVENTORY,
+        "history": SAMPLE_HISTORY,
+    }
+
+
+def ending_payload(day: int) -> dict:
+    return {
+        "days_survived": day,
+        "high_light_moment": "用棒球棍守住了房门",
+        "final_stats": {"hp": 0, "san": 30},
+        "final_inventory": SAMPLE_INVENTORY,
+        "history": SAMPLE_HISTORY,
+    }
+
+
+def ice_age_payload(day: int) -> dict:
+    return {
+        "start_day": day,
+        "days_to_generate": 5,
+        "stats": SAMPLE_STATS,
+        "inventory": [{"name": "罐头", "count": 10}, {"name": "桶装水", "count": 10}, {"name": "木柴", "count": 20}],
+        "hidden_tags": [],
+        "history": [],
+        "shelter": {"name": "出租屋", "hiddenDescription": "保温差"},
+    }
+
+
+def archive_payload(player: int) -> dict:
+    return {
+        "nickname": f"bench-{player}",
+        "epithet": "压测幸存者",
+        "days_survived": 3,
+        "is_victory": False,
+        "cause_of_death": "压测",
+        "comment": "基准测试生成的档案",
+        "radar_chart": [5, 5, 5, 5, 5],
+        "game_type": "zombie",
+    }
+
+
+# ==================== 统计 ====================
+
+@dataclass
+class Sample:
+    """单次请求的测量结果"""
+    ok: bool
+    total: float
+    ttft: float | None = None
+    gaps: list[float] = field(default_factory=list)
+    chunks: int = 0
+    error: str | None = None
+
+
+def percentile(values: list[float], pct: float) -> float | None:
+    """最近秩法计算分位数"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, math.ceil(pct / 100 * len(ordered)) - 1))
+    return ordered[rank]
+
+
+def summarize(values: list[float]) -> dict:
+    """返回 p50/p95/p99/max（毫秒）"""
+    def ms(v: float | None) -> float | None:
+        return round(v * 1000, 2) if v is not None else None
+    return {
+        "p50": ms(percentile(values, 50)),
+        "p95": ms(percentile(values, 95)),
+        "p99": ms(percentile(values, 99)),
+        "max": ms(max(values)) if values else None,
+    }
+
+
+class Recorder:
+    """按接口聚合测量结果"""
+
+    def __init__(self):
+        self.samples: dict[str, list[Sample]] = {}
+
+    def add(self, endpoint: str, sample: Sample) -> None:
+        self.samples.setdefault(endpoint, []).append(sample)
+
+    def report(self, wall_time: float) -> dict:
+        endpoints = {}
+        for name, samples in self.samples.items():
+            ok = [s for s in samples if s.ok]
+            errors: dict[str, int] = {}
+            for s in samples:
+                if not s.ok:
+                    key = (s.error or "unknown")[:80]
+                    errors[key] = errors.get(key, 0) + 1
+            entry = {
+                "requests": len(samples),
+                "errors": len(samples) - len(ok),
+                "error_samples": errors,
+                "throughput_rps": round(len(ok) / wall_time, 3) if wall_time else None,
+                "total_ms": summarize([s.total for s in ok]),
+            }
+            ttfts = [s.ttft for s in ok if s.ttft is not None]
+            if ttfts:
+                gaps = [g for s in ok for g in s.gaps]
+                chunks = sum(s.chunks for s in ok)
+                entry["ttft_ms"] = summarize(ttfts)
+                entry["gap_ms"] = summarize(gaps)
+                entry["chunks"] = chunks
+                entry["chunks_per_second"] = round(chunks / wall_time, 2) if wall_time else None
+            endpoints[name] = entry
+        return endpoints
+
+
+# ==================== 请求执行 ====================
+
+async def run_stream(client: httpx.AsyncClient, url: str, payload: dict, params: dict) -> Sample:
+    """执行一次 SSE 请求并记录 TTFT 和 chunk 间隔"""
+    start = time.perf_counter()
+    ttft = None
+    last = None
+    gaps: list[float] = []
+    chunks = 0
+    try:
+        async with client.stream("POST", url, json=payload, params=params) as response:
+            if response.status_code != 200:
+                await response.aread()
+                return Sample(ok=False, total=time.perf_counter() - start, error=f"HTTP {response.status_code}")
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                try:
+                    event = json.loads(line[5:].strip())
+                except json.JSONDecodeError:
+                    continue
+                now = time.perf_counter()
+                event_type = event.get("type")
+                if event_type == "error":
+                    return Sample(ok=False, total=now - start, ttft=ttft, gaps=gaps,
+                                  chunks=chunks, error=str(event.get("error")))
+                if event_type == "content":
+                    chunks += 1
+                    if ttft is None:
+                        ttft = now - start
+                    else:
+                        gaps.append(now - last)
+                    last = now
+    except httpx.HTTPError as e:
+        return Sample(ok=False, total=time.perf_counter() - start, error=type(e).__name__)
+    return Sample(ok=ttft is not None, total=time.perf_counter() - start, ttft=ttft,
+                  gaps=gaps, chunks=chunks, error=None if ttft is not None else "no content")
+
+
+async def run_json(client: httpx.AsyncClient, method: str, url: str, **kwargs) -> tuple[Sample, dict | list | None]:
+    """执行一次普通 JSON 请求"""
+    start = time.perf_counter()
+    try:
+        response = await client.request(method, url, **kwargs)
+        total = time.perf_counter() - start
+        if response.status_code >= 400:
+            return Sample(ok=False, total=total, error=f"HTTP {response.status_code}"), None
+        return Sample(ok=True, total=total), response.json()
+    except (httpx.HTTPError, json.JSONDecodeError) as e:
+        return Sample(ok=False, total=time.perf_counter() - start, error=type(e).__name__), None
+
+
+async def simulate_player(
+    player: int,
+    client: httpx.AsyncClient,
+    recorder: Recorder,
+    endpoints: set[str],
+    rounds: int,
+) -> None:
+    """模拟一个玩家的完整流程"""
+    token = None
+    if "access" in endpoints:
+        sample, body = await run_json(client, "POST", "/api/game/access", json={})
+        recorder.add("access", sample)
+        if isinstance(body, dict):
+            token = body.get("token")
+    params = {"token": token} if token else {}
+    headers = {"X-Game-Token": token} if token else {}
+
+    for day in range(1, rounds + 1):
+        if "narrate/stream" in endpoints:
+            recorder.add("narrate/stream", await run_stream(client, "/api/game/narrate/stream", narrate_payload(day), params))
+        if "judge/stream" in endpoints:
+            recorder.add("judge/stream", await run_stream(client, "/api/game/judge/stream", judge_payload(day), params))
+
+    if "ending" in endpoints:
+        sample, _ = await run_json(client, "POST", "/api/game/ending", json=ending_payload(rounds), headers=headers)
+        recorder.add("ending", sample)
+
+    if "ice-age/narrate-batch/stream" in endpoints:
+        recorder.add("ice-age/narrate-batch/stream",
+                     await run_stream(client, "/api/ice-age/narrate-batch/stream", ice_age_payload(1), params))
+
+    archive_id = None
+    if "archive/submit" in endpoints:
+        sample, body = await run_json(client, "POST", "/api/archive/submit", json=archive_payload(player))
+        recorder.add("archive/submit", sample)
+        if isinstance(body, dict):
+            archive_id = body.get("id")
+    if "archive/list" in endpoints:
+        sample, _ = await run_json(client, "GET", "/api/archive/list", params={"limit": 12})
+        recorder.add("archive/list", sample)
+    if "archive/like" in endpoints and archive_id:
+        sample, _ = await run_json(client, "POST", "/api/archive/like", json={"archive_id": archive_id})
+        recorder.add("archive/like", sample)
+
+
+async def run_benchmark(args: argparse.Namespace) -> dict:
+    endpoints = set(args.endpoints)
+    recorder = Recorder()
+    limits = httpx.Limits(max_connections=args.players * 2, max_keepalive_connections=args.players)
+    timeout = httpx.Timeout(args.timeout, connect=10)
+    semaphore = asyncio.Semaphore(args.players)
+
+    async with httpx.AsyncClient(base_url=args.base_url, limits=limits, timeout=timeout) as client:
+        async def guarded(player: int) -> None:
+            async with semaphore:
+                if args.ramp_up > 0:
+                    await asyncio.sleep(args.ramp_up * (player % args.players) / args.players)
+                await simulate_player(player, client, recorder, endpoints, args.rounds)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(guarded(i) for i in range(args.players * args.iterations)))
+        wall_time = time.perf_counter() - start
+
+    return {
+        "meta": {
+            "timestamp": datetime.now().isoformat(),
+            "base_url": args.base_url,
+            "players": args.players,
+            "iterations": args.iterations,
+            "rounds": args.rounds,
+            "wall_time_s": round(wall_time, 3),
+        },
+        "endpoints": recorder.report(wall_time),
+    }
+
+
+# ==================== 基线对比 ====================
+
+COMPARE_METRICS = [("ttft_ms", "p95"), ("gap_ms", "p95"), ("total_ms", "p95"), ("total_ms", "p99")]
+
+
+def compare_with_baseline(result: dict, baseline: dict, threshold: float) -> list[str]:
+    """返回劣化超过阈值的指标描述"""
+    regressions = []
+    for name, current in result["endpoints"].items():
+        base = baseline.get("endpoints", {}).get(name)
+        if not base:
+            continue
+        for metric, stat in COMPARE_METRICS:
+            old = (base.get(metric) or {}).get(stat)
+            new = (current.get(metric) or {}).get(stat)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            if change > threshold:
+                regressions.append(f"{name} {metric}.{stat}: {old}ms -> {new}ms (+{change:.0%})")
+        if current["errors"] > base.get("errors", 0):
+            regressions.append(f"{name} errors: {base.get('errors', 0)} -> {current['errors']}")
+    return regressions
+
+
+def print_report(result: dict) -> None:
+    meta = result["meta"]
+    print(f"\n玩家数: {meta['players']}  轮数: {meta['rounds']}  总耗时: {meta['wall_time_s']}s")
+    header = f"{'接口':<30}{'请求':>6}{'错误':>6}{'TTFT p50/p95/p99 (ms)':>30}{'总耗时 p50/p95/p99 (ms)':>32}{'最大间隔':>10}"
+    print(header)
+    print("-" * len(header))
+    for name, entry in result["endpoints"].items():
+        ttft = entry.get("ttft_ms")
+        total = entry["total_ms"]
+        ttft_str = f"{ttft['p50']}/{ttft['p95']}/{ttft['p99']}" if ttft else "-"
+        total_str = f"{total['p50']}/{total['p95']}/{total['p99']}"
+        gap = (entry.get("gap_ms") or {}).get("max")
+        print(f"{name:<30}{entry['requests']:>6}{entry['errors']:>6}{ttft_str:>30}{total_str:>32}{str(gap or '-'):>10}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="末世模拟器 SSE 压测工具")
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--players", type=int, default=10, help="并发玩家数")
+    parser.add_argument("--iterations", type=int, default=1, help="每个并发槽位运行的玩家次数")
+    parser.add_argument("--rounds", type=int, default=1, help="每个玩家的 narrate+judge 回合数")
+    parser.add_argument("--endpoints", nargs="+", default=ALL_ENDPOINTS, choices=ALL_ENDPOINTS)
+    parser.add_argument("--ramp-up", type=float, default=0, help="玩家启动的分散时间（秒）")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--output", help="结果保存路径（JSON）")
+    parser.add_argument("--baseline", help="基线结果路径，用于对比")
+    parser.add_argument("--threshold", type=float, default=0.15, help="允许的劣化比例")
+    args = parser.parse_args()
+
+    result = asyncio.run(run_benchmark(args))
+    print_report(result)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"\n结果已保存: {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare_with_baseline(result, baseline, args.threshold)
+        if regressions:
+            print("\n⚠️ 相对基线出现劣化：")
+            for line in regressions:
+                print(f"  - {line}")
+            sys.exit(1)
+        print("\n✅ 未发现超过阈值的劣化")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,368 @@
+"""
+本地 OpenAI 兼容替身服务 - 用于压测和故障注入
+
+实现 /v1/chat/completions 协议（SSE 流式 + json_object 模式），
+可替代 narrator/judge/ending/moderator 任意角色的 BASE_URL，无需联网、无需付费。
+
+功能：
+- 可配置首 token 延迟（TTFT）和输出速率（tokens/秒）
+- 按系统提示词识别角色，返回符合格式的预置输出：
+  <options> A-D 选项、<state_update>、<day_log> 等
+- 故障注入：429 限流、5xx 错误、卡顿（首 token 前 / 中途）、中途断连
+- 支持 stop、max_tokens、stream_options.include_usage
+
+启动：
+    python -m tools.fake_llm_server --port 9100 --ttft-ms 300 --tps 40
+
+然后在 .env 中将角色指向替身服务：
+    OPENAI_BASE_URL=http://127.0.0.1:9100/v1
+
+运行中可通过 GET/POST /_config 查看或修改配置（例如临时调高 429 比例）：
+    curl -X POST localhost:9100/_config -H 'Content-Type: application/json' -d '{"rate_429": 0.3}'
+"""
+import argparse
+import asyncio
+import json
+import random
+import re
+import time
+import uuid
+from typing import AsyncGenerator
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel, Field
+
+
+class FakeLLMConfig(BaseModel):
+    """替身服务配置（所有比例取值 0-1）"""
+    ttft_ms: float = Field(default=300, description="首 token 延迟（毫秒）")
+    tokens_per_second: float = Field(default=40, description="输出速率，0 表示不限速")
+    chars_per_token: int = Field(default=2, ge=1, description="每个 token 包含的字符数")
+    json_latency_ms: float = Field(default=800, description="json_object 模式的响应延迟（毫秒）")
+    jitter: float = Field(default=0.2, ge=0, description="延迟随机抖动比例")
+    rate_429: float = Field(default=0, description="返回 429 的比例")
+    rate_5xx: float = Field(default=0, description="返回 5xx 的比例")
+    rate_stall: float = Field(default=0, description="首 token 前卡顿的比例")
+    rate_mid_stall: float = Field(default=0, description="输出中途卡顿的比例")
+    stall_seconds: float = Field(default=60, description="卡顿持续时间（秒）")
+    rate_disconnect: float = Field(default=0, description="输出中途断连的比例")
+    ice_age_days: int = Field(default=3, ge=1, description="冰河叙事默认生成天数（最后一天为危机日）")
+    seed: int | None = Field(default=None, description="随机种子，便于复现")
+
+
+# ==================== 预置输出 ====================
+
+ZOMBIE_NARRATOR_TEXT = """第{day}天。清晨的楼道里传来断断续续的拖拽声，你贴着门缝听了很久，那声音时远时近。背包里的压缩饼干又少了一块，水桶见底前你必须想办法。
+
+中午时分，对面楼顶有人用镜子向你打信号，三短三长。紧接着，楼下的铁门被什么东西撞得哐哐作响。
+
+<options>
+A. 用棒球棍顶住房门，屏住呼吸等待
+B. 回应镜子信号，尝试与对面幸存者联系
+C. 从后窗爬到隔壁阳台，绕开楼道
+D. 往楼下扔一个闹钟吸引注意力
+</options>
+
+<hidden>
+C选项高风险，体力不足时可能坠楼。
+</hidden>
+"""
+
+ZOMBIE_JUDGE_TEXT = """你屏住呼吸，把全身重量压在门板上。撞击声持续了几分钟，门框的螺丝一颗颗松动。就在你以为要守不住时，外面的声音忽然转向了楼上。你瘫坐在地，手心全是汗。
+<notes>
+消耗食物和水各一份，理智小幅下降。
+</notes>
+<state_update>
+{{"score": 62, "stat_changes": {{"hp": 0, "san": -8}}, "item_changes": {{"remove": [{{"name": "压缩饼干", "count": 1}}, {{"name": "瓶装水", "count": 1}}], "add": []}}, "new_hidden_tags": ["被吓到了"], "remove_hidden_tags": []}}
+</state_update>
+"""
+
+ICE_AGE_JUDGE_TEXT = """你裹紧大衣推开被冰封的门，寒风像刀子一样割在脸上。你在雪堆里摸索了很久，终于拖回半捆还算干燥的木柴，但手指已经冻得失去知觉。
+
+<state_update>
+{"stat_changes": {"hp": -5, "san": 3}, "item_changes": {"remove": [], "add": [{"name": "木柴", "count": 3}]}, "new_hidden_tags": ["冻伤"], "remove_hidden_tags": []}
+</state_update>
+"""
+
+ENDING_JSON = {
+    "cause_of_death": "在第{day}天的寒夜里耗尽了最后一根木柴",
+    "epithet": "冰原过客",
+    "comment": "你把希望囤在了仓库里，却忘了给勇气留个位置。",
+    "radar_chart": [6, 5, 7, 4, 6],
+}
+
+MODERATION_JSON = {"is_safe": True, "reason": ""}
+
+
+def _ice_age_day_log(day: int, is_crisis: bool) -> str:
+    """构造一天的 <day_log> 输出"""
+    entry = {
+        "day": day,
+        "temperature": -5 - day * 2,
+        "narration": f"第{day}天，窗外的雪又厚了一层。你把最后一块木柴塞进炉子，听着风声数着剩下的罐头。",
+        "has_crisis": is_crisis,
+        "state_update": {"hp": -2, "san": -3},
+        "item_changes": {
+            "remove": [
+                {"name": "罐头", "count": 1},
+                {"name": "桶装水", "count": 1},
+                {"name": "木柴", "count": 2},
+            ],
+            "add": [],
+        },
+        "new_hidden_tags": [],
+        "removed_hidden_tags": [],
+    }
+    if is_crisis:
+        entry["narration"] = f"第{day}天深夜，门外传来敲门声，一个沙哑的声音请求你开门。"
+        entry["choices"] = [
+            {"text": "A. 隔着门询问来意", "risk": "Low"},
+            {"text": "B. 开门让他进来", "risk": "High"},
+            {"text": "C. 熄灭炉火假装没人", "risk": "Medium"},
+            {"text": "D. 拿起斧头主动开门威慑", "risk": "Extreme"},
+        ]
+    return f"<day_log>\n{json.dumps(entry, ensure_ascii=False, indent=2)}\n</day_log>\n\n"
+
+
+def _extract_int(pattern: str, text: str, default: int) -> int:
+    match = re.search(pattern, text)
+    return int(match.group(1)) if match else default
+
+
+def build_canned_text(system_prompt: str, user_prompt: str, config: FakeLLMConfig) -> str:
+    """根据系统提示词识别角色并生成预置的流式输出"""
+    if "冰河末世" in system_prompt and "叙事引擎" in system_prompt:
+        start_day = _extract_int(r"从第(\d+)天开始", user_prompt, 1)
+        count = _extract_int(r"开始的(\d+)天", user_prompt, config.ice_age_days)
+        count = max(1, min(count, config.ice_age_days))
+        return "".join(
+            _ice_age_day_log(start_day + i, is_crisis=(i == count - 1))
+            for i in range(count)
+        )
+    if "冰河末世" in system_prompt:
+        return ICE_AGE_JUDGE_TEXT
+    if "冷酷DM" in system_prompt:
+        return ZOMBIE_JUDGE_TEXT.format()
+    day = _extract_int(r"第\s*(\d+)\s*天", user_prompt, 1)
+    return ZOMBIE_NARRATOR_TEXT.format(day=day)
+
+
+def build_canned_json(system_prompt: str, user_prompt: str) -> dict:
+    """json_object 模式的预置输出"""
+    if "审核" in system_prompt:
+        return dict(MODERATION_JSON)
+    day = _extract_int(r"(\d+)\s*天", user_prompt, 1)
+    result = dict(ENDING_JSON)
+    result["cause_of_death"] = result["cause_of_death"].format(day=day)
+    return result
+
+
+def estimate_tokens(text: str, config: FakeLLMConfig) -> int:
+    """按配置的字符数粗略换算 token 数"""
+    return max(1, (len(text) + config.chars_per_token - 1) // config.chars_per_token)
+
+
+# ==================== 协议实现 ====================
+
+def _error_response(status_code: int, message: str, error_type: str) -> JSONResponse:
+    headers = {"Retry-After": "1"} if status_code == 429 else None
+    return JSONResponse(
+        status_code=status_code,
+        content={"error": {"message": message, "type": error_type, "code": status_code}},
+        headers=headers,
+    )
+
+
+def _apply_stop(text: str, stop: str | list[str] | None) -> tuple[str, bool]:
+    """按 stop 序列截断输出，返回 (截断后文本, 是否命中)"""
+    if not stop:
+        return text, False
+    stops = [stop] if isinstance(stop, str) else stop
+    positions = [text.find(s) for s in stops if s and s in text]
+    if not positions:
+        return text, False
+    return text[:min(positions)], True
+
+
+def create_app(config: FakeLLMConfig | None = None) -> FastAPI:
+    """创建替身服务应用"""
+    app = FastAPI(title="Fake LLM Server")
+    app.state.config = config or FakeLLMConfig()
+    app.state.stats = {"requests": 0, "streams": 0, "json": 0, "injected": {}}
+    rng = random.Random(app.state.config.seed)
+
+    def roll(rate: float) -> bool:
+        return rate > 0 and rng.random() < rate
+
+    def jittered(seconds: float) -> float:
+        jitter = app.state.config.jitter
+        if jitter <= 0:
+            return seconds
+        return max(0.0, seconds * (1 + rng.uniform(-jitter, jitter)))
+
+    def record(kind: str) -> None:
+        injected = app.state.stats["injected"]
+        injected[kind] = injected.get(kind, 0) + 1
+
+    @app.get("/_config")
+    async def get_config():
+        return {"config": app.state.config.model_dump(), "stats": app.state.stats}
+
+    @app.post("/_config")
+    async def update_config(patch: dict):
+        app.state.config = app.state.config.model_copy(update=patch)
+        return {"config": app.state.config.model_dump()}
+
+    @app.get("/v1/models")
+    @app.get("/models")
+    async def list_models():
+        return {"object": "list", "data": [{"id": "fake-model", "object": "model", "owned_by": "fake"}]}
+
+    @app.post("/v1/chat/completions")
+    @app.post("/chat/completions")
+    async def chat_completions(request: Request):
+        cfg: FakeLLMConfig = app.state.config
+        body = await request.json()
+        app.state.stats["requests"] += 1
+
+        if roll(cfg.rate_429):
+            record("429")
+            return _error_response(429, "Rate limit reached (injected)", "rate_limit_exceeded")
+        if roll(cfg.rate_5xx):
+            record("5xx")
+            status_code = rng.choice([500, 502, 503])
+            return _error_response(status_code, "Upstream error (injected)", "server_error")
+
+        messages = body.get("messages", [])
+        system_prompt = next((m.get("content", "") for m in messages if m.get("role") == "system"), "")
+        user_prompt = "\n".join(m.get("content", "") for m in messages if m.get("role") == "user")
+        model = body.get("model", "fake-model")
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+        created = int(time.time())
+        prompt_tokens = estimate_tokens(system_prompt + user_prompt, cfg)
+
+        response_format = body.get("response_format") or {}
+        if response_format.get("type") == "json_object" or not body.get("stream"):
+            app.state.stats["json"] += 1
+            await asyncio.sleep(jittered(cfg.json_latency_ms / 1000))
+            if response_format.get("type") == "json_object":
+                content = json.dumps(build_canned_json(system_prompt, user_prompt), ensure_ascii=False)
+            else:
+                content = build_canned_text(system_prompt, user_prompt, cfg)
+            return {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": content},
+                    "finish_reason": "stop",
+                }],
+                "usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": estimate_tokens(content, cfg),
+                    "total_tokens": prompt_tokens + estimate_tokens(content, cfg),
+                },
+            }
+
+        app.state.stats["streams"] += 1
+        text, _ = _apply_stop(build_canned_text(system_prompt, user_prompt, cfg), body.get("stop"))
+        max_tokens = body.get("max_tokens") or body.get("max_completion_tokens")
+        include_usage = bool((body.get("stream_options") or {}).get("include_usage"))
+
+        stall_first = roll(cfg.rate_stall)
+        stall_mid = roll(cfg.rate_mid_stall)
+        disconnect = roll(cfg.rate_disconnect)
+        for kind, hit in (("stall", stall_first), ("mid_stall", stall_mid), ("disconnect", disconnect)):
+            if hit:
+                record(kind)
+
+        def chunk_payload(delta: dict, finish_reason: str | None = None, usage: dict | None = None) -> str:
+            payload = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [] if usage else [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }
+            if usage:
+                payload["usage"] = usage
+            return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+        async def generate() -> AsyncGenerator[str, None]:
+            step = cfg.chars_per_token
+            pieces = [text[i:i + step] for i in range(0, len(text), step)]
+            finish_reason = "stop"
+            if max_tokens and len(pieces) > max_tokens:
+                pieces = pieces[:max_tokens]
+                finish_reason = "length"
+            interval = 1 / cfg.tokens_per_second if cfg.tokens_per_second > 0 else 0
+            cut_at = rng.randint(1, max(1, len(pieces) - 1)) if (stall_mid or disconnect) else -1
+
+            await asyncio.sleep(jittered(cfg.ttft_ms / 1000))
+            if stall_first:
+                await asyncio.sleep(cfg.stall_seconds)
+            yield chunk_payload({"role": "assistant", "content": ""})
+
+            for index, piece in enumerate(pieces):
+                if index == cut_at:
+                    if disconnect:
+                        # 直接抛错让服务器中断连接，模拟上游断流
+                        raise ConnectionResetError("injected mid-stream disconnect")
+                    await asyncio.sleep(cfg.stall_seconds)
+                yield chunk_payload({"content": piece})
+                if interval:
+                    await asyncio.sleep(jittered(interval))
+
+            yield chunk_payload({}, finish_reason=finish_reason)
+            if include_usage:
+                completion_tokens = len(pieces)
+                yield chunk_payload({}, usage={
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens,
+                })
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(generate(), media_type="text/event-stream")
+
+    return app
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="本地 OpenAI 兼容替身服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--ttft-ms", type=float, default=300)
+    parser.add_argument("--tps", type=float, default=40, help="每秒输出 token 数，0 表示不限速")
+    parser.add_argument("--json-latency-ms", type=float, default=800)
+    parser.add_argument("--rate-429", type=float, default=0)
+    parser.add_argument("--rate-5xx", type=float, default=0)
+    parser.add_argument("--rate-stall", type=float, default=0)
+    parser.add_argument("--rate-mid-stall", type=float, default=0)
+    parser.add_argument("--stall-seconds", type=float, default=60)
+    parser.add_argument("--rate-disconnect", type=float, default=0)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    config = FakeLLMConfig(
+        ttft_ms=args.ttft_ms,
+        tokens_per_second=args.tps,
+        json_latency_ms=args.json_latency_ms,
+        rate_429=args.rate_429,
+        rate_5xx=args.rate_5xx,
+        rate_stall=args.rate_stall,
+        rate_mid_stall=args.rate_mid_stall,
+        stall_seconds=args.stall_seconds,
+        rate_disconnect=args.rate_disconnect,
+        seed=args.seed,
+    )
+
+    import uvicorn
+    uvicorn.run(create_app(config), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()